@@ -12,6 +12,8 @@ import subprocess
 import sys
 
 from . import fusionator, preprocessor, segmentor
+from .util import filemanager
+from .util.dicom_import import import_dicom
 
 
 def list_dockers():
@@ -84,6 +86,108 @@ def fusion():
         print("ERROR DETAIL: ", e)
 
 
+def _add_segmentation_args(parser, parallel_help):
+    """Adds the options shared by brats-segment and brats-batch-segment"""
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Verbose mode outputs log info to the command line.",
+    )
+    parser.add_argument(
+        "-c", "--config", help="Add a path to a custom config file for dockers here."
+    )
+    parser.add_argument(
+        "-g",
+        "--gpu",
+        action="store_true",
+        help="Pass this flag if your Docker version already supports the --gpus flag.",
+    )
+    parser.add_argument(
+        "-gi",
+        "--gpuid",
+        help="Specify the GPU bus ID to be used, several as comma separated list, e.g. 0,1,2.",
+    )
+    parser.add_argument(
+        "--gpu-slots",
+        type=int,
+        help="Maximum number of containers sharing one GPU at the same time.",
+    )
+    parser.add_argument(
+        "--scratch",
+        help="Directory to stage the inputs in, e.g. a tmpfs or local NVMe disk. Defaults to $BRATS_SCRATCH or the system temp directory.",
+    )
+    parser.add_argument(
+        "--history",
+        nargs="?",
+        const=True,
+        help="Record the container runtimes in this SQLite database, without a path in $BRATS_RUNTIME_HISTORY or ~/.cache/brats_toolkit/runtime_history.sqlite. Only recorded if given or $BRATS_RUNTIME_HISTORY is set.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Kill containers running longer than this many seconds, unless their config sets a timeout.",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        help="Kill containers not writing any output for this many seconds, unless their config sets an idle_timeout.",
+    )
+    parser.add_argument(
+        "--cache",
+        help="Directory for the result cache. Reruns with unchanged inputs and container images reuse the stored segmentations.",
+    )
+    parser.add_argument(
+        "--cpu-slots",
+        type=int,
+        help="Pin concurrently running containers to this many disjoint cpusets.",
+    )
+    parser.add_argument(
+        "-p",
+        "--parallel",
+        type=int,
+        default=1,
+        help=parallel_help,
+    )
+    parser.add_argument(
+        "--runtime",
+        default="docker",
+        choices=["docker", "docker-api", "fake"],
+        help="Container runtime backend. docker-api talks to the Docker Engine API on $DOCKER_HOST or /var/run/docker.sock instead of starting docker CLI processes and falls back to the CLI. fake runs a local stand-in writing deterministic segmentations, e.g. for benchmarks without Docker.",
+    )
+    parser.add_argument(
+        "--update",
+        choices=["never", "ttl", "always"],
+        default="never",
+        help="Pull the container images whose registry digest changed before running: never (default), ttl (check at most once a day) or always.",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Also write a Chrome trace-event timeline next to the JSON run report.",
+    )
+
+
+def _segmentor_from_args(args):
+    """Creates the Segmentor configured by the options of _add_segmentation_args"""
+    return segmentor.Segmentor(
+        config=args.config,
+        verbose=args.verbose,
+        newdocker=args.gpu,
+        gpu=args.gpuid or "0",
+        gpu_slots=args.gpu_slots,
+        cache_root=args.cache,
+        scratch_root=args.scratch,
+        runtime_history=args.history,
+        timeout=args.timeout,
+        idle_timeout=args.idle_timeout,
+        cpu_slots=args.cpu_slots,
+        max_parallel=args.parallel,
+        runtime=args.runtime,
+        trace=args.trace,
+    )
+
+
 def segmentation():
     parser = argparse.ArgumentParser(
         description="Runs the Docker orchestra to segment and fuse segmentations based on the"
@@ -122,22 +226,21 @@ def segmentation():
     parser.add_argument(
         "-o", "--output", required=True, help="Path to the desired output file."
     )
-    parser.add_argument(
-        "-v",
-        "--verbose",
-        action="store_true",
-        help="Verbose mode outputs log info to the command line.",
+    _add_segmentation_args(
+        parser,
+        parallel_help="Number of containers to run at the same time when fusing (mav, simple, all).",
     )
     parser.add_argument(
-        "-c", "--config", help="Add a path to a custom config file for dockers here."
+        "--budget",
+        type=float,
+        help="Wall clock budget in seconds for mav and simple: only the containers fitting into it by their recorded runtimes are run and whatever finished in time is fused.",
     )
     parser.add_argument(
-        "-g",
-        "--gpu",
-        action="store_true",
-        help="Pass this flag if your Docker version already supports the --gpus flag.",
+        "--min-ensemble",
+        type=int,
+        default=2,
+        help="Number of segmentations to fuse at least when running with --budget.",
     )
-    parser.add_argument("-gi", "--gpuid", help="Specify the GPU bus ID to be used.")
     try:
         if "-l" in sys.argv[1:] or "--list" in sys.argv[1:]:
             list_docker_ids()
@@ -159,12 +262,8 @@ def segmentation():
         sys.exit(e.code)
     try:
         # runs the segmentation with all the settings wished for by the user
-        seg = segmentor.Segmentor(
-            config=args.config,
-            verbose=args.verbose,
-            newdocker=args.gpu,
-            gpu=str(args.gpuid),
-        )
+        seg = _segmentor_from_args(args)
+        seg.update_images(args.docker, policy=args.update)
         seg.segment(
             t1=args.t1,
             t1c=args.t1c,
@@ -172,6 +271,8 @@ def segmentation():
             fla=args.fla,
             cid=args.docker,
             outputPath=args.output,
+            budget=args.budget,
+            min_ensemble=args.min_ensemble,
         )
     except subprocess.CalledProcessError as e:
         # Ignoring errors happening in the Docker Process, otherwise we'd e.g. get error messages on exiting the Docker via CTRL+D.
@@ -180,6 +281,129 @@ def segmentation():
         print("ERROR DETAIL: ", e)
 
 
+def print_plan(plan):
+    totals = {}
+    for job in plan["jobs"]:
+        totals.setdefault(job["cid"], []).append(job["seconds"])
+    print("predicted seconds per container (mean over cases):")
+    for cid, seconds in sorted(totals.items(), key=lambda t: -sum(t[1])):
+        print("  {}: {:.1f}".format(cid, sum(seconds) / len(seconds)))
+    if plan["unknown"]:
+        print(
+            "{} of {} jobs have no runtime history, assuming typical runtimes".format(
+                plan["unknown"], len(plan["jobs"])
+            )
+        )
+    print(
+        "predicted makespan with {} parallel containers: {:.0f}s".format(
+            plan["slots"], plan["makespan"]
+        )
+    )
+
+
+def batchsegmentation():
+    parser = argparse.ArgumentParser(
+        description="Runs the Docker orchestra on a folder of cases, one case per subfolder. "
+        "With --queue the work is distributed over all nodes running a worker on the same shared queue directory."
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        required=True,
+        help="The input directory with one subfolder per case.",
+    )
+    parser.add_argument(
+        "--pattern",
+        default="*{}.nii.gz",
+        help="Glob for the modalities inside a case folder, {} is replaced by t1, t1c, t2 and fla.",
+    )
+    parser.add_argument(
+        "-d",
+        "--docker",
+        required=True,
+        help="Container ID or method used for fusion. (mav, simple, all). Run brats-segment --list to display all options.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="Output directory, results go to <output>/<case>/<docker>.nii.gz.",
+    )
+    _add_segmentation_args(
+        parser,
+        parallel_help="Number of containers to run at the same time on this node.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Cases per launch of containers with batch_mount in their config. Defaults to the config's batch_size or all cases.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Dry run: print the predicted runtimes and makespan of the cohort from the runtime history and exit.",
+    )
+    parser.add_argument(
+        "--queue",
+        help="Work queue directory on a filesystem shared by all nodes.",
+    )
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="Only fill the queue, don't start a worker.",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Only work on the queue, don't enqueue the cases.",
+    )
+    parser.add_argument(
+        "--stale-after",
+        type=int,
+        default=300,
+        help="Seconds without heartbeat after which the claim of a worker is given to another one.",
+    )
+    try:
+        args = parser.parse_args()
+    except SystemExit as e:
+        if e.code == 2:
+            parser.print_help()
+        sys.exit(e.code)
+    if args.plan and args.history is None:
+        # planning needs the history, read the default one
+        args.history = True
+    try:
+        seg = _segmentor_from_args(args)
+        cases = []
+        if not args.worker:
+            cases = filemanager.find_cases(
+                args.input,
+                pattern=args.pattern,
+                outputRoot=args.output,
+                outputName=args.docker + ".nii.gz",
+            )
+            print("found {} cases".format(len(cases)))
+        if args.plan:
+            print_plan(seg.plan(cases, cid=args.docker))
+            return
+        seg.update_images(args.docker, policy=args.update)
+        if args.queue is None:
+            results = seg.segment_batch(
+                cases, cid=args.docker, batch_size=args.batch_size
+            )
+            print("{} of {} cases succeeded".format(sum(results), len(results)))
+            return
+        if not args.worker:
+            seg.enqueue_batch(args.queue, cases, cid=args.docker)
+        if not args.enqueue:
+            seg.run_worker(args.queue, stale_after=args.stale_after)
+    except subprocess.CalledProcessError as e:
+        # Ignoring errors happening in the Docker Process, otherwise we'd e.g. get error messages on exiting the Docker via CTRL+D.
+        pass
+    except Exception as e:
+        print("ERROR DETAIL: ", e)
+
+
 def batchpreprocess():
     parser = argparse.ArgumentParser(
         description="Runs the preprocessing for MRI scans on a folder of images."
@@ -212,6 +436,43 @@ def batchpreprocess():
         help="Pass this flag if you want to use GPU computations.",
     )
     parser.add_argument("-gi", "--gpuid", help="Specify the GPU bus ID to be used.")
+    parser.add_argument(
+        "--update",
+        choices=["never", "ttl", "always"],
+        default="ttl",
+        help="When to check the registry for a newer backend image, it is only pulled if its digest changed: never, ttl (default, at most once a day) or always.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default="auto",
+        help='Number of preprocessing workers to request from the backend, advisory as the backend image decides. "auto" (default) sizes them by the available cores and memory.',
+    )
+    parser.add_argument(
+        "--report",
+        help="JSON file to write the progress metrics of the exams to: start and end per exam, stage durations, throughput and ETA.",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        help="OpenMetrics textfile kept up to date with the progress, e.g. in the directory of the node exporter's textfile collector.",
+    )
+    parser.add_argument(
+        "-r",
+        "--resume",
+        action="store_true",
+        help="If passed, only exams that are new, changed or not done according to the manifest in the output directory are processed, e.g. to continue an interrupted batch.",
+    )
+    parser.add_argument(
+        "--dicom",
+        help="A DICOM tree to convert into the input directory first, one exam folder per study with t1, t1c, t2 and FLAIR series. The conversion runs locally in parallel.",
+    )
+    parser.add_argument(
+        "-b",
+        "--backends",
+        type=int,
+        default=1,
+        help="Number of backends to run side by side, the exams are split between them. With several backends --gpuid may list several comma separated GPUs.",
+    )
     try:
         args = parser.parse_args()
     except SystemExit as e:
@@ -220,7 +481,21 @@ def batchpreprocess():
         sys.exit(e.code)
     try:
         # runs the preprocessing with all the settings wished for by the user
-        pre = preprocessor.Preprocessor()
+        if args.dicom:
+            import_dicom(args.dicom, args.input)
+        if args.backends > 1:
+            pre = preprocessor.PreprocessorPool(
+                backends=args.backends,
+                updatePolicy=args.update,
+                reportPath=args.report,
+                metricsTextfile=args.metrics_textfile,
+            )
+        else:
+            pre = preprocessor.Preprocessor(
+                updatePolicy=args.update,
+                reportPath=args.report,
+                metricsTextfile=args.metrics_textfile,
+            )
         if args.gpu:
             mode = "gpu"
         else:
@@ -236,6 +511,8 @@ def batchpreprocess():
             confirm=args.confirm,
             skipUpdate=args.skipupdate,
             gpuid=gpuid,
+            workers=args.workers,
+            resume=args.resume,
         )
     except subprocess.CalledProcessError as e:
         # Ignoring errors happening in the Docker Process, otherwise we'd e.g. get error messages on exiting the Docker via CTRL+D.
@@ -274,6 +551,30 @@ def singlepreprocess():
         help="Pass this flag if you want to use GPU computations.",
     )
     parser.add_argument("-gi", "--gpuid", help="Specify the GPU bus ID to be used.")
+    parser.add_argument(
+        "--scratch",
+        help="Directory to stage the inputs in, e.g. a tmpfs or local NVMe disk. Defaults to $BRATS_SCRATCH or the system temp directory.",
+    )
+    parser.add_argument(
+        "--update",
+        choices=["never", "ttl", "always"],
+        default="ttl",
+        help="When to check the registry for a newer backend image, it is only pulled if its digest changed: never, ttl (default, at most once a day) or always.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default="auto",
+        help='Number of preprocessing workers to request from the backend, advisory as the backend image decides. "auto" (default) sizes them by the available cores and memory.',
+    )
+    parser.add_argument(
+        "--report",
+        help="JSON file to write the progress metrics of the exams to: start and end per exam, stage durations, throughput and ETA.",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        help="OpenMetrics textfile kept up to date with the progress, e.g. in the directory of the node exporter's textfile collector.",
+    )
     try:
         args = parser.parse_args()
     except SystemExit as e:
@@ -282,7 +583,12 @@ def singlepreprocess():
         sys.exit(e.code)
     try:
         # runs the preprocessing with all the settings wished for by the user
-        pre = preprocessor.Preprocessor()
+        pre = preprocessor.Preprocessor(
+            scratchRoot=args.scratch,
+            updatePolicy=args.update,
+            reportPath=args.report,
+            metricsTextfile=args.metrics_textfile,
+        )
         if args.gpu:
             mode = "gpu"
         else:
@@ -301,6 +607,7 @@ def singlepreprocess():
             confirm=args.confirm,
             skipUpdate=args.skipupdate,
             gpuid=gpuid,
+            workers=args.workers,
         )
     except subprocess.CalledProcessError as e:
         # Ignoring errors happening in the Docker Process, otherwise we'd e.g. get error messages on exiting the Docker via CTRL+D.
@@ -9,11 +9,13 @@ import logging
 import math
 import os
 import os.path as op
+import threading
 
 import numpy as np
 
 from .util import filemanager as fm
 from .util import own_itk as oitk
+from .util import timing
 from .util.citation_reminder import citation_reminder
 
 
@@ -386,6 +388,7 @@ class Fusionator(object):
             )
         return result
 
+    @timing.timed("fusion")
     def _dirFuse(self, directory, method="mav", outputPath=None, labels=None):
         """
         dirFuse [summary]
@@ -462,6 +465,7 @@ class Fusionator(object):
                 "Issues while saving the resulting segmentation: {}".format(str(e))
             )
 
+    @timing.timed("fusion")
     def fuse(self, segmentations, outputPath, method="mav", weights=None, labels=None):
         """
         fuse [summary]
@@ -586,3 +590,147 @@ class Fusionator(object):
         if np.isnan(score) or math.isnan(score):
             score = 0
         return score
+
+
+class FusionAccumulator(object):
+    """
+    Fuses segmentations one at a time as they become available, e.g. while
+    the other containers of an ensemble are still running.
+
+    For majority voting only the weighted votes per label are kept, so memory
+    doesn't grow with the number of members. SIMPLE needs all candidates for
+    its iterations, they are kept in memory and fused in result().
+    add() may be called from several threads.
+
+    Members added with a name keep a packed whole tumor mask, agreement()
+    scores them against the fusion.
+    """
+
+    METHODS = ["mav", "simple", "brats-simple"]
+
+    def __init__(self, method="mav", labels=None, verbose=True):
+        if method not in self.METHODS:
+            raise ValueError(
+                "Unknown fusion method {}, choose one of {}".format(
+                    method, self.METHODS
+                )
+            )
+        self.method = method
+        self.labels = None if labels is None else [l for l in labels if l != 0]
+        self.verbose = verbose
+        self.count = 0
+        self.shape = None
+        self.geometry = None
+        self._totalWeight = 0.0
+        self._votes = {}
+        self._candidates = []
+        self._weights = []
+        self._masks = {}
+        self._lock = threading.Lock()
+
+    def add(self, candidate, weight=1, geometry=None, name=None):
+        """
+        add folds one segmentation into the fusion
+
+        Args:
+            candidate (array): the segmentation as numpy array
+            weight (float, optional): weight of its votes. Defaults to 1.
+            geometry (tuple, optional): origin, spacing and direction for the output
+            name (str, optional): name of the member for agreement()
+        """
+        candidate = np.asarray(candidate)
+        with self._lock:
+            if self.shape is None:
+                self.shape = candidate.shape
+                self.geometry = geometry
+            elif candidate.shape != self.shape:
+                raise ValueError(
+                    "Cannot fuse a segmentation of shape {} into shape {}".format(
+                        candidate.shape, self.shape
+                    )
+                )
+            if self.method == "mav":
+                self._vote(candidate, weight)
+            else:
+                self._candidates.append(candidate)
+                self._weights.append(weight)
+            if name is not None:
+                self._masks[name] = np.packbits(candidate > 0)
+            self._totalWeight += weight
+            self.count += 1
+
+    def _vote(self, candidate, weight):
+        labels = self.labels
+        if labels is None:
+            labels = [l for l in np.unique(candidate).astype(int) if l != 0]
+        for l in labels:
+            if l not in self._votes:
+                # earlier members didn't vote for labels they don't contain
+                self._votes[l] = np.zeros(self.shape, dtype=np.float32)
+            self._votes[l][candidate == l] += weight
+
+    def add_file(self, path, weight=1, name=None):
+        """Loads a segmentation from path and adds it, returns its array"""
+        image = oitk.get_itk_image(path)
+        geometry = (image.GetOrigin(), image.GetSpacing(), image.GetDirection())
+        candidate = oitk.get_itk_array(image)
+        self.add(candidate, weight=weight, geometry=geometry, name=name)
+        if self.verbose:
+            print("Added to the {} fusion: {}".format(self.method, path))
+        return candidate
+
+    def result(self):
+        """Returns the fusion of all segmentations added so far"""
+        with self._lock:
+            if self.count == 0:
+                raise IOError("No valid segmentations passed for fusion")
+            if self.method == "mav":
+                result = np.zeros(self.shape)
+                # same precedence as Fusionator._mav, higher labels first
+                for l in sorted(self._votes, reverse=True):
+                    result[self._votes[l] >= (self._totalWeight / 2.0)] = l
+                return result
+            fusion = Fusionator(verbose=self.verbose)
+            if self.method == "simple":
+                return fusion._simple(list(self._candidates), list(self._weights))
+            return fusion._brats_simple(list(self._candidates), list(self._weights))
+
+    def agreement(self, fused=None):
+        """
+        agreement scores the named members against the fusion
+
+        Args:
+            fused (array, optional): the fusion, computed if not passed
+
+        Returns:
+            dict: name -> whole tumor dice of the member with the fusion
+        """
+        if fused is None:
+            fused = self.result()
+        truth = np.packbits(fused > 0)
+        # popcount per byte, the packed masks are compared without unpacking
+        bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(1)
+        scores = {}
+        for name, mask in self._masks.items():
+            overlap = bits[mask & truth].sum()
+            total = bits[mask].sum() + bits[truth].sum()
+            scores[name] = 2.0 * overlap / total if total else 1.0
+        return scores
+
+    def write(self, outputPath):
+        """Writes the fusion to outputPath, returns the fused array"""
+        result = self.result()
+        image = oitk.make_itk_image(result, verbose=self.verbose)
+        if self.geometry is not None:
+            origin, spacing, direction = self.geometry
+            image.SetOrigin(origin)
+            image.SetSpacing(spacing)
+            image.SetDirection(direction)
+        os.makedirs(op.dirname(op.abspath(outputPath)), exist_ok=True)
+        oitk.write_itk_image(image, outputPath)
+        logging.info(
+            "Segmentation Fusion with method {} of {} segmentations saved as {}.".format(
+                self.method, self.count, outputPath
+            )
+        )
+        return result
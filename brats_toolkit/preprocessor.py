@@ -1,7 +1,14 @@
+import asyncio
+import functools
 import os
-import sys
-import tempfile
+import platform
+import re
+import shutil
+import threading
+import uuid
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
+from typing import Callable, Dict, List, Tuple, Union
 
 import socketio
 
@@ -9,29 +16,281 @@ from brats_toolkit.util.citation_reminder import (
     citation_reminder,
     deprecated_preprocessor,
 )
-from brats_toolkit.util.docker_functions import start_docker, stop_docker, update_docker
-from brats_toolkit.util.prep_utils import tempFiler
+from brats_toolkit.util.dicom_import import import_dicom
+from brats_toolkit.util.docker_functions import (
+    BACKEND_NAME,
+    BACKEND_PORT,
+    DASHBOARD_PORT,
+    start_docker,
+    stop_docker,
+    update_docker,
+)
+from brats_toolkit.util.prep_utils import (
+    linkFile,
+    tempFileName,
+    tempFiler,
+)
+from brats_toolkit.util.exam_manifest import ExamManifest
+from brats_toolkit.util.prep_metrics import EXAM_DONE, EXAM_FAILED, PreprocessingMetrics
+from brats_toolkit.util.readiness import free_ports, port_open, wait_for_backend
+from brats_toolkit.util.scheduling import (
+    available_cpus,
+    available_memory,
+    parse_devices,
+    preprocessing_workers,
+)
+from brats_toolkit.util.scratch import scratch_dir, scratch_root
+
+# times a pool member is started on new ports when its free ports got taken
+PORT_RETRIES = 3
+
+
+def _abspath(path: str) -> str:
+    return None if path is None else os.path.abspath(path)
+
+
+def _stage_exam(
+    inputFiles: List[str], tempFolder: str, mount: bool = False
+) -> List[Tuple[str, str]]:
+    """
+    Stage the four modalities with the suffixes the backend expects,
+    as reflinks where possible instead of copies. The backend mounts the
+    import folder writable, so the originals are never hardlinked.
+
+    Parameters:
+    - inputFiles (List[str]): The t1, t1c, t2 and FLAIR files.
+    - tempFolder (str): The exam folder to stage in.
+    - mount (bool): Whether files that can't be linked are left to bind mounts instead of copied.
+
+    Returns:
+    - List[Tuple[str, str]]: The files to bind mount as (source, staged path).
+    """
+    mounts: List[Tuple[str, str]] = []
+    for inputFile, modality in zip(inputFiles, ["t1", "t1c", "t2", "fla"]):
+        if tempFiler(inputFile, modality, tempFolder, copy=not mount) is None:
+            target = os.path.join(tempFolder, tempFileName(inputFile, modality))
+            # the placeholder makes docker mount a file, not a directory
+            open(target, "a").close()
+            mounts.append((inputFile, target))
+    return mounts
+
+
+def _move_results(exported: str, outputFolder: str) -> str:
+    """
+    Move the results of an exam from the export folder to outputFolder,
+    unless they are there already. Returns where the results are.
+    """
+    target: str = os.path.abspath(outputFolder)
+    if os.path.abspath(exported) != target:
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(exported, target)
+    return target
+
+
+def _exam_folders(exam_import_folder: str) -> List[str]:
+    """
+    The exam folders in an import folder, sorted by name.
+    """
+    return sorted(
+        e.path for e in os.scandir(os.path.abspath(exam_import_folder)) if e.is_dir()
+    )
+
+
+def _shard_exams(examFolders: List[str], shards: int) -> List[List[str]]:
+    """
+    Split exam folders into shards of about the same size: the largest
+    exams first, each into the shard with the fewest bytes so far.
+    """
+    sizes: Dict[str, int] = {
+        folder: sum(e.stat().st_size for e in os.scandir(folder) if e.is_file())
+        for folder in examFolders
+    }
+    result: List[List[str]] = [[] for _ in range(shards)]
+    totals: List[int] = [0] * shards
+    for folder in sorted(examFolders, key=lambda f: (-sizes[f], f)):
+        i = totals.index(min(totals))
+        result[i].append(folder)
+        totals[i] += sizes[folder]
+    return result
+
+
+def _stage_shard(
+    examFolders: List[str], shardFolder: str, mount: bool = False
+) -> List[Tuple[str, str]]:
+    """
+    Stage exam folders in the import folder of one backend, as reflinks
+    where possible instead of copies. The backend mounts the import folder
+    writable, so the originals are never hardlinked.
+
+    Parameters:
+    - examFolders (List[str]): The exam folders of the shard.
+    - shardFolder (str): The import folder of the backend.
+    - mount (bool): Whether files that can't be linked are left to bind mounts instead of copied.
+
+    Returns:
+    - List[Tuple[str, str]]: The files to bind mount as (source, staged path).
+    """
+    mounts: List[Tuple[str, str]] = []
+    for examFolder in examFolders:
+        target: str = os.path.join(shardFolder, os.path.basename(examFolder))
+        os.makedirs(target)
+        for entry in os.scandir(examFolder):
+            if not entry.is_file():
+                continue
+            staged: str = os.path.join(target, entry.name)
+            if linkFile(entry.path, staged) is not None:
+                continue
+            if mount:
+                # the placeholder makes docker mount a file, not a directory
+                open(staged, "a").close()
+                mounts.append((entry.path, staged))
+            else:
+                shutil.copyfile(entry.path, staged)
+    return mounts
+
+
+def _start_backend(
+    stack: ExitStack,
+    noDocker: bool,
+    skipUpdate: bool,
+    url: str,
+    startupTimeout: float,
+    updatePolicy: str = "ttl",
+    updateTTL: float = None,
+    name: str = BACKEND_NAME,
+    **dockerArgs,
+) -> None:
+    """
+    Start the backend container, unless noDocker is set, and wait until it
+    answers. Stopping the container is registered on stack.
+    """
+    if noDocker != True:
+        stop_docker(name=name)
+        if skipUpdate != True:
+            update_docker(policy=updatePolicy, ttl=updateTTL)
+        start_docker(name=name, **dockerArgs)
+        stack.callback(stop_docker, name=name)
+        print("backend started, requested {} workers".format(dockerArgs["workers"]))
+
+    # wait as long as the backend needs, but not longer
+    waited: float = wait_for_backend(url, timeout=startupTimeout)
+    print("backend ready after {:.1f}s".format(waited))
 
 
 class Preprocessor:
     """
     Class for preprocessing medical imaging data.
+
+    batch_preprocess and single_preprocess start the backend, process and
+    shut it down again. To process many exams with one backend, open a
+    session first, e.g. with the Preprocessor as context manager:
+
+        with Preprocessor() as prep:
+            prep.start_session(exam_export_folder="out", mode="cpu")
+            for exam in exams:
+                prep.single_preprocess(...)
     """
 
     @citation_reminder
     @deprecated_preprocessor
-    def __init__(self, noDocker: bool = False):
+    def __init__(
+        self,
+        noDocker: bool = False,
+        scratchRoot: str = None,
+        startupTimeout: float = 300,
+        updatePolicy: str = "ttl",
+        updateTTL: float = None,
+        backendName: str = BACKEND_NAME,
+        port: int = BACKEND_PORT,
+        dashboardPort: int = DASHBOARD_PORT,
+        reportPath: str = None,
+        metricsTextfile: str = None,
+    ):
         """
         Initialize the Preprocessor instance.
 
         Parameters:
         - noDocker (bool): Flag indicating whether Docker is used.
+        - scratchRoot (Optional[str]): Directory to stage inputs in, e.g. a tmpfs. Defaults to $BRATS_SCRATCH or the system temp directory.
+        - startupTimeout (float): Seconds to wait for the backend to get ready.
+        - updatePolicy (str): When to check the registry for a newer backend image: "never", "ttl" (default) or "always". It is only pulled if its digest changed.
+        - updateTTL (Optional[float]): Seconds a registry check stays valid with "ttl", defaults to a day.
+        - backendName (str): Name of the backend container.
+        - port (int): Host port of the backend.
+        - dashboardPort (int): Host port of the backend's job dashboard.
+        - reportPath (Optional[str]): JSON file to write the progress metrics of the exams to after every processing run.
+        - metricsTextfile (Optional[str]): OpenMetrics textfile to keep up to date with the progress, e.g. for the node exporter.
+        """
+        self._setup(
+            noDocker=noDocker,
+            scratchRoot=scratchRoot,
+            startupTimeout=startupTimeout,
+            updatePolicy=updatePolicy,
+            updateTTL=updateTTL,
+            backendName=backendName,
+            port=port,
+            dashboardPort=dashboardPort,
+            reportPath=reportPath,
+            metricsTextfile=metricsTextfile,
+        )
+
+    @classmethod
+    def attach(
+        cls,
+        backendName: str = BACKEND_NAME,
+        port: int = BACKEND_PORT,
+        dashboardPort: int = DASHBOARD_PORT,
+        **settings,
+    ) -> "Preprocessor":
+        """
+        Create a Preprocessor for the backend backendName on port and
+        dashboardPort without printing the notes of __init__, e.g. for the
+        members of a PreprocessorPool, which prints them once.
+
+        Parameters:
+        - backendName (str): Name of the backend container.
+        - port (int): Host port of the backend.
+        - dashboardPort (int): Host port of the backend's job dashboard.
+        - settings: The other parameters of __init__.
+
+        Returns:
+        - Preprocessor: The new instance.
+        """
+        prep = cls.__new__(cls)
+        prep._setup(
+            backendName=backendName, port=port, dashboardPort=dashboardPort, **settings
+        )
+        return prep
+
+    def _setup(
+        self,
+        noDocker: bool = False,
+        scratchRoot: str = None,
+        startupTimeout: float = 300,
+        updatePolicy: str = "ttl",
+        updateTTL: float = None,
+        backendName: str = BACKEND_NAME,
+        port: int = BACKEND_PORT,
+        dashboardPort: int = DASHBOARD_PORT,
+        reportPath: str = None,
+        metricsTextfile: str = None,
+    ) -> None:
+        """
+        Initialize the instance, without the notes __init__ prints.
         """
         # settings
         self.clientVersion: str = "0.0.1"
         self.confirmationRequired: bool = True
         self.mode: str = "cpu"
         self.gpuid: str = "0"
+        self.workers: int = None
+        self.backendName: str = backendName
+        self._use_ports(port, dashboardPort)
+        self.startupTimeout: float = startupTimeout
+        self.updatePolicy: str = updatePolicy
+        self.updateTTL: float = updateTTL
 
         # init sio client
         self.sio: socketio.Client = socketio.Client()
@@ -39,6 +298,25 @@ class Preprocessor:
         # set docker usage
         self.noDocker: bool = noDocker
 
+        # where single_preprocess stages its inputs
+        self.scratchRoot: str = scratchRoot
+
+        # the running session, see start_session
+        self.session: dict = None
+        self._sessionStack: ExitStack = None
+        self._identified = threading.Event()
+        self._finished = threading.Event()
+        self._processing = threading.Event()
+        self._error: str = None
+        self._exams: List[str] = []
+
+        # progress of the exams, its callbacks get every update
+        self.reportPath: str = reportPath
+        self.metrics = PreprocessingMetrics(textfile=metricsTextfile)
+
+        # called with the event name and data of every status and ipstatus event
+        self.listeners: List[Callable[[str, dict], None]] = [self.metrics]
+
         @self.sio.event
         def connect() -> None:
             """
@@ -63,6 +341,10 @@ class Preprocessor:
             Event handler for disconnection.
             """
             print("disconnected from server")
+            if self._processing.is_set() and not self._finished.is_set():
+                # the exams won't be reported as completed anymore
+                self._error = "lost the connection to the backend while processing"
+                self._finished.set()
 
         @self.sio.on("message")
         def message(data: dict) -> None:
@@ -77,28 +359,32 @@ class Preprocessor:
             Event handler for status update.
             """
             print("status received: ", data)
+            self._notify("status", data)
             if data["message"] == "client ID json generation finished!":
-                self._inspect_input()
+                self._identified.set()
             elif data["message"] == "input inspection finished!":
-                if "data" in data:
-                    print("input inspection found the following exams: ", data["data"])
-                    if self.confirmationRequired:
-                        confirmation = input(
-                            'press "y" to continue or "n" to scan the input folder again.'
-                        ).lower()
-                    else:
-                        confirmation = "y"
+                if not data.get("data"):
+                    print("input inspection found no exams")
+                    self._exams = []
+                    self._finished.set()
+                    return
+                print("input inspection found the following exams: ", data["data"])
+                if self.confirmationRequired:
+                    confirmation = input(
+                        'press "y" to continue or "n" to scan the input folder again.'
+                    ).lower()
+                else:
+                    confirmation = "y"
 
-                    if confirmation == "n":
-                        self._inspect_input()
+                if confirmation == "n":
+                    self._inspect_input()
 
-                    if confirmation == "y":
-                        self._process_start()
+                if confirmation == "y":
+                    self._exams = list(data["data"])
+                    self._process_start()
 
             elif data["message"] == "image processing successfully completed.":
-                self.sio.disconnect()
-                stop_docker()
-                sys.exit(0)
+                self._finished.set()
 
         @self.sio.on("client_outdated")
         def outdated(data: dict) -> None:
@@ -113,9 +399,10 @@ class Preprocessor:
                 "from:",
             )
             print("https://neuronflow.github.io/brats-preprocessor/")
-            self.sio.disconnect()
-            stop_docker()
-            sys.exit(0)
+            self._error = "client version {} is outdated".format(self.clientVersion)
+            # wake up whoever waits, the session can't be used
+            self._identified.set()
+            self._finished.set()
 
         @self.sio.on("ipstatus")
         def on_ipstatus(data: dict) -> None:
@@ -124,6 +411,7 @@ class Preprocessor:
             """
             print("image processing status received:")
             print(data["examid"], ": ", data["ipstatus"])
+            self._notify("ipstatus", data)
 
     def single_preprocess(
         self,
@@ -136,6 +424,7 @@ class Preprocessor:
         confirm: bool = False,
         skipUpdate: bool = False,
         gpuid: str = "0",
+        workers: Union[int, str] = "auto",
     ) -> None:
         """
         Process a single set of input files.
@@ -148,41 +437,83 @@ class Preprocessor:
         - outputFolder (str): Output folder path.
         - mode (str): Processing mode (e.g., "cpu", "gpu").
         - confirm (bool): Whether confirmation is required.
-        - skipUpdate (bool): Whether to skip Docker update.
+        - skipUpdate (bool): Whether to skip Docker update, regardless of the update policy.
         - gpuid (str): GPU ID.
+        - workers (Union[int, str]): Number of backend workers to request (advisory, passed as BRATS_WORKERS), "auto" sizes them by the available cores and memory.
 
         Returns:
         - None
+
+        In a running session the exam is processed with its backend, mode,
+        skipUpdate and gpuid are the ones the session was started with then.
         """
         # assign name to file
         print("basename:", os.path.basename(outputFolder))
+        inputFiles = [t1File, t1cFile, t2File, flaFile]
+        if self.session is not None:
+            self._single_in_session(inputFiles, outputFolder, confirm)
+            return
+
         outputPath: Path = Path(outputFolder)
         dockerOutputFolder: str = os.path.abspath(outputPath.parent)
 
-        # create temp dir
-        storage: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
-        # TODO this is a potential security hazzard as all users can access the files now, but currently it seems the only way to deal with bad configured docker installations
-        os.chmod(storage.name, 0o777)
-        dockerFolder: str = os.path.abspath(storage.name)
-        tempFolder: str = os.path.join(dockerFolder, os.path.basename(outputFolder))
-
-        os.makedirs(tempFolder, exist_ok=True)
-        print("tempFold:", tempFolder)
-
-        # create temp Files
-        tempFiler(t1File, "t1", tempFolder)
-        tempFiler(t1cFile, "t1c", tempFolder)
-        tempFiler(t2File, "t2", tempFolder)
-        tempFiler(flaFile, "fla", tempFolder)
-
-        self.batch_preprocess(
-            exam_import_folder=dockerFolder,
-            exam_export_folder=dockerOutputFolder,
-            mode=mode,
-            confirm=confirm,
-            skipUpdate=skipUpdate,
-            gpuid=gpuid,
-        )
+        # files that can't be linked are bind mounted into the backend we
+        # start, the windows script doesn't support that so they are copied
+        mount: bool = self.noDocker != True and platform.system() != "Windows"
+
+        # create temp dir, it is removed again even if the processing fails
+        root: str = scratch_root(self.scratchRoot)
+        required: int = 0
+        if not mount:
+            required = sum(os.path.getsize(f) for f in inputFiles)
+        with scratch_dir(root, required=required) as dockerFolder:
+            tempFolder: str = os.path.join(dockerFolder, os.path.basename(outputFolder))
+
+            os.makedirs(tempFolder, exist_ok=True)
+            print("tempFold:", tempFolder)
+
+            # create temp Files
+            mounts = _stage_exam(inputFiles, tempFolder, mount=mount)
+
+            self.start_session(
+                exam_import_folder=dockerFolder,
+                exam_export_folder=dockerOutputFolder,
+                mode=mode,
+                skipUpdate=skipUpdate,
+                gpuid=gpuid,
+                workers=workers,
+                mounts=mounts,
+            )
+            try:
+                self.process_exams(confirm=confirm)
+            finally:
+                self.close_session()
+
+    def _single_in_session(
+        self, inputFiles: List[str], outputFolder: str, confirm: bool
+    ) -> None:
+        """
+        Process one exam with the backend of the running session.
+
+        The exam is staged in the session's import folder and removed from it
+        again once processed, the results are moved to outputFolder if it is
+        not in the session's export folder.
+        """
+        examName: str = os.path.basename(os.path.normpath(outputFolder))
+        tempFolder: str = os.path.join(self.session["exam_import_folder"], examName)
+        if os.path.exists(tempFolder):
+            raise FileExistsError(
+                "{} is already staged in the session".format(examName)
+            )
+        os.makedirs(tempFolder)
+        try:
+            _stage_exam(inputFiles, tempFolder)
+            self.process_exams(confirm=confirm)
+        finally:
+            shutil.rmtree(tempFolder, ignore_errors=True)
+        exported: str = os.path.join(self.session["exam_export_folder"], examName)
+        if os.path.exists(exported):
+            _move_results(exported, outputFolder)
 
     def batch_preprocess(
         self,
@@ -194,6 +525,9 @@ class Preprocessor:
         confirm: bool = True,
         skipUpdate: bool = False,
         gpuid: str = "0",
+        workers: Union[int, str] = "auto",
+        localImport: bool = False,
+        resume: bool = False,
     ) -> None:
         """
         Process multiple sets of input files, potentially using Docker.
@@ -205,41 +539,287 @@ class Preprocessor:
         - nifti_export_folder (Optional[str]): NIfTI export folder path.
         - mode (str): Processing mode (e.g., "cpu", "gpu").
         - confirm (bool): Whether confirmation is required.
-        - skipUpdate (bool): Whether to skip Docker update.
+        - skipUpdate (bool): Whether to skip Docker update, regardless of the update policy.
         - gpuid (str): GPU ID.
+        - workers (Union[int, str]): Number of backend workers to request (advisory, passed as BRATS_WORKERS), "auto" sizes them by the available cores and memory.
+        - localImport (bool): Whether to convert dicom_import_folder into exam_import_folder here, in parallel, instead of in the backend. nifti_export_folder is not used then.
+        - resume (bool): Whether to process only the exams that are new, changed or not done according to the manifest in exam_export_folder. The manifest is kept either way.
 
         Returns:
         - None
+
+        In a running session the exams are processed with its backend, the
+        folders have to be the ones of the session then.
+        """
+        if localImport == True:
+            if dicom_import_folder is None or exam_import_folder is None:
+                raise ValueError(
+                    "localImport converts dicom_import_folder into exam_import_folder"
+                )
+            import_dicom(dicom_import_folder, exam_import_folder)
+            dicom_import_folder = None
+            nifti_export_folder = None
+
+        if resume == True:
+            if self.session is not None or dicom_import_folder is not None:
+                raise ValueError(
+                    "resume processes exam_import_folder, without a running session"
+                )
+            self._resume_batch(
+                exam_import_folder,
+                exam_export_folder,
+                mode=mode,
+                confirm=confirm,
+                skipUpdate=skipUpdate,
+                gpuid=gpuid,
+                workers=workers,
+            )
+            return
+
+        if self.session is not None:
+            if _abspath(exam_import_folder) != self.session["exam_import_folder"] or (
+                _abspath(exam_export_folder) != self.session["exam_export_folder"]
+            ):
+                raise ValueError(
+                    "The running session processes {} into {}".format(
+                        self.session["exam_import_folder"],
+                        self.session["exam_export_folder"],
+                    )
+                )
+            self.process_exams(confirm=confirm)
+            return
+
+        # the backend converts the DICOM files into exams of its own
+        manifest: ExamManifest = None
+        recorded: Dict[str, str] = {}
+        if dicom_import_folder is None:
+            manifest = ExamManifest(exam_export_folder)
+            recorded = manifest.fingerprints(_exam_folders(exam_import_folder))
+        self.start_session(
+            exam_import_folder=exam_import_folder,
+            exam_export_folder=exam_export_folder,
+            dicom_import_folder=dicom_import_folder,
+            nifti_export_folder=nifti_export_folder,
+            mode=mode,
+            skipUpdate=skipUpdate,
+            gpuid=gpuid,
+            workers=workers,
+        )
+        try:
+            with self._recording(manifest, recorded):
+                self.process_exams(confirm=confirm)
+        finally:
+            self.close_session()
+
+    @contextmanager
+    def _recording(self, manifest: ExamManifest, exams: Dict[str, str]):
+        """
+        Record the exams (exam folder -> fingerprint) of a batch in the
+        manifest: submitted, then done or failed by their ipstatus events
+        and, once the batch finished, by their results.
         """
-        if confirm != True:
-            self.confirmationRequired = False
+        if manifest is None:
+            yield
+            return
+        manifest.submit(exams)
+        self.listeners.append(manifest)
+        try:
+            yield
+        finally:
+            self.listeners.remove(manifest)
+        manifest.complete(os.path.basename(folder) for folder in exams)
+
+    def _resume_batch(
+        self,
+        exam_import_folder: str,
+        exam_export_folder: str,
+        **sessionArgs,
+    ) -> None:
+        """
+        Process the exams of the import folder the manifest of the export
+        folder doesn't know as done, staged in a scratch directory.
+        """
+        confirm: bool = sessionArgs.pop("confirm")
+        manifest = ExamManifest(exam_export_folder)
+        examFolders: List[str] = _exam_folders(exam_import_folder)
+        pending: Dict[str, str] = manifest.pending(examFolders)
+        print(
+            "{} of {} exams are new, changed or incomplete".format(
+                len(pending), len(examFolders)
+            )
+        )
+        if not pending:
+            return
+        mount: bool = self.noDocker != True and platform.system() != "Windows"
+        with scratch_dir(self.scratchRoot) as stagingFolder:
+            mounts = _stage_shard(list(pending), stagingFolder, mount=mount)
+            with self._recording(manifest, pending):
+                self.start_session(
+                    exam_import_folder=stagingFolder,
+                    exam_export_folder=exam_export_folder,
+                    mounts=mounts,
+                    **sessionArgs,
+                )
+                try:
+                    self.process_exams(confirm=confirm)
+                finally:
+                    self.close_session()
+
+    def start_session(
+        self,
+        exam_import_folder: str = None,
+        exam_export_folder: str = None,
+        dicom_import_folder: str = None,
+        nifti_export_folder: str = None,
+        mode: str = "cpu",
+        skipUpdate: bool = False,
+        gpuid: str = "0",
+        workers: Union[int, str] = "auto",
+        mounts: List[Tuple[str, str]] = None,
+    ) -> None:
+        """
+        Start the backend and connect to it, once for many exams.
+
+        Parameters:
+        - exam_import_folder (Optional[str]): Import folder path. Defaults to a scratch directory single_preprocess stages its exams in.
+        - exam_export_folder (str): Export folder path.
+        - dicom_import_folder (Optional[str]): DICOM import folder path.
+        - nifti_export_folder (Optional[str]): NIfTI export folder path.
+        - mode (str): Processing mode (e.g., "cpu", "gpu").
+        - skipUpdate (bool): Whether to skip Docker update, regardless of the update policy.
+        - gpuid (str): GPU ID.
+        - workers (Union[int, str]): Number of backend workers to request (advisory, passed as BRATS_WORKERS), "auto" sizes them by the available cores and memory.
+        - mounts (Optional[List[Tuple[str, str]]]): Files to bind mount into the exam import folder, as (host file, path in exam_import_folder).
+
+        Returns:
+        - None
+        """
+        if self.session is not None:
+            raise RuntimeError("A preprocessing session is already running")
+        if exam_export_folder is None and nifti_export_folder is None:
+            raise ValueError("exam_export_folder is required")
         self.mode = mode
         self.gpuid = gpuid
+        self.workers = preprocessing_workers(workers, mode)
+        self.metrics.reset()
+        self._sessionStack = ExitStack()
+        if exam_import_folder is None and dicom_import_folder is None:
+            exam_import_folder = self._sessionStack.enter_context(
+                scratch_dir(self.scratchRoot)
+            )
 
-        if self.noDocker != True:
-            stop_docker()
-            if skipUpdate != True:
-                update_docker()
-            start_docker(
+        try:
+            _start_backend(
+                self._sessionStack,
+                noDocker=self.noDocker,
+                skipUpdate=skipUpdate,
+                url=self.url,
+                startupTimeout=self.startupTimeout,
+                updatePolicy=self.updatePolicy,
+                updateTTL=self.updateTTL,
                 exam_import_folder=exam_import_folder,
                 exam_export_folder=exam_export_folder,
                 dicom_import_folder=dicom_import_folder,
                 nifti_export_folder=nifti_export_folder,
                 mode=self.mode,
                 gpuid=self.gpuid,
+                mounts=mounts,
+                workers=self.workers,
+                name=self.backendName,
+                port=self.port,
+                dashboard_port=self.dashboardPort,
             )
 
-        # setup connection
-        # TODO do this in a more elegant way and somehow check whether docker is up and running before connect
-        self.sio.sleep(8)  # wait 8 secs for docker to start
-        self._connect_client()
-        self.sio.wait()
+            # setup connection, the backend answers by now
+            self._identified.clear()
+            self._error = None
+            self._connect_client()
+            self._sessionStack.callback(self.sio.disconnect)
+            if not self._identified.wait(self.startupTimeout):
+                raise TimeoutError("The backend did not identify the client")
+            self._raise_error()
+        except BaseException:
+            self._sessionStack.close()
+            self._sessionStack = None
+            raise
+
+        self.session = {
+            "exam_import_folder": _abspath(exam_import_folder or dicom_import_folder),
+            "exam_export_folder": _abspath(exam_export_folder or nifti_export_folder),
+        }
+
+    def process_exams(self, confirm: bool = False, timeout: float = None) -> List[str]:
+        """
+        Process the exams in the import folder of the running session and
+        return once the backend reports that they are completed.
+
+        Parameters:
+        - confirm (bool): Whether confirmation is required.
+        - timeout (Optional[float]): Seconds to wait for the backend to complete the exams, raises a TimeoutError after that. Waits without limit by default.
+
+        Returns:
+        - List[str]: The exams found by the input inspection.
+
+        Raises a RuntimeError if the connection to the backend is lost
+        before the exams are completed.
+        """
+        if self.session is None:
+            raise RuntimeError("No preprocessing session, call start_session first")
+        self.confirmationRequired = confirm == True
+        self._finished.clear()
+        self._error = None
+        self._processing.set()
+        try:
+            self._inspect_input()
+            if not self._finished.wait(timeout):
+                raise TimeoutError(
+                    "The backend did not complete the exams within {} seconds".format(
+                        timeout
+                    )
+                )
+        finally:
+            self._processing.clear()
+            if self.reportPath is not None:
+                self.metrics.write_json(self.reportPath)
+        self._raise_error()
+        return self._exams
+
+    def close_session(self) -> None:
+        """
+        Disconnect from the backend and shut it down.
+        """
+        stack, self._sessionStack = self._sessionStack, None
+        self.session = None
+        if stack is not None:
+            stack.close()
+
+    def __enter__(self) -> "Preprocessor":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close_session()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError(self._error)
+
+    def _use_ports(self, port: int, dashboardPort: int) -> None:
+        """
+        Set the host ports the backend is started on, outside of a session.
+        """
+        self.port: int = port
+        self.dashboardPort: int = dashboardPort
+        self.url: str = "http://localhost:{}".format(port)
+
+    def _notify(self, event: str, data: dict) -> None:
+        for listener in list(self.listeners):
+            listener(event, data)
 
     def _connect_client(self) -> None:
         """
         Connect to the server using SocketIO.
         """
-        self.sio.connect("http://localhost:5000")
+        self.sio.connect(self.url)
         print("sid:", self.sio.sid)
 
     def _inspect_input(self) -> None:
@@ -255,3 +835,731 @@ class Preprocessor:
         """
         print("sending processing request!")
         self.sio.emit("brats_processing", {"hurray": "yes"})
+
+
+class PreprocessorPool:
+    """
+    Several preprocessing backends side by side on one host, each with a
+    generated container name and its own ports. batch_preprocess shards the
+    exams of a cohort over the backends and aggregates their status:
+
+        pool = PreprocessorPool(backends=4)
+        status = pool.batch_preprocess("exams", "preprocessed", mode="cpu")
+    """
+
+    @citation_reminder
+    @deprecated_preprocessor
+    def __init__(
+        self,
+        backends: int = 2,
+        noDocker: bool = False,
+        scratchRoot: str = None,
+        startupTimeout: float = 300,
+        updatePolicy: str = "ttl",
+        updateTTL: float = None,
+        ports: List[int] = None,
+        reportPath: str = None,
+        metricsTextfile: str = None,
+    ):
+        """
+        Initialize the PreprocessorPool instance.
+
+        Parameters:
+        - backends (int): Number of backends.
+        - noDocker (bool): Flag indicating whether Docker is used. The backends have to run on ports then.
+        - scratchRoot (Optional[str]): Directory to stage the shards in. Defaults to $BRATS_SCRATCH or the system temp directory.
+        - startupTimeout (float): Seconds to wait for a backend to get ready.
+        - updatePolicy (str): When to check the registry for a newer backend image: "never", "ttl" (default) or "always".
+        - updateTTL (Optional[float]): Seconds a registry check stays valid with "ttl", defaults to a day.
+        - ports (Optional[List[int]]): Host ports of the backends, defaults to free ones.
+        - reportPath (Optional[str]): JSON file to write the progress metrics of all backends to after every batch.
+        - metricsTextfile (Optional[str]): OpenMetrics textfile to keep up to date with the progress, e.g. for the node exporter.
+        """
+        if int(backends) < 1:
+            raise ValueError("At least one backend is needed, got {}".format(backends))
+        backends = int(backends)
+        # generated ports may be taken by others before the backends start
+        self._portsGenerated: bool = ports is None
+        if ports is None:
+            if noDocker == True:
+                raise ValueError("Without docker the ports of the backends are needed")
+            ports = free_ports(2 * backends)
+            dashboardPorts: List[int] = ports[backends:]
+            ports = ports[:backends]
+        else:
+            if len(ports) != backends:
+                raise ValueError(
+                    "{} ports given for {} backends".format(len(ports), backends)
+                )
+            dashboardPorts = free_ports(backends)
+        self.noDocker: bool = noDocker
+        self.scratchRoot: str = scratchRoot
+        self.updatePolicy: str = updatePolicy
+        self.updateTTL: float = updateTTL
+
+        # exam -> backend processing it and its latest ipstatus
+        self.status: Dict[str, dict] = {}
+        self._statusLock = threading.Lock()
+
+        # progress of the exams of all backends, its callbacks get every update
+        self.reportPath: str = reportPath
+        self.metrics = PreprocessingMetrics(textfile=metricsTextfile)
+
+        self.members: List[Preprocessor] = []
+        for port, dashboardPort in zip(ports, dashboardPorts):
+            # the notes are printed once for the pool
+            member: Preprocessor = Preprocessor.attach(
+                backendName="{}_{}".format(BACKEND_NAME, uuid.uuid4().hex[:6]),
+                port=port,
+                dashboardPort=dashboardPort,
+                noDocker=noDocker,
+                scratchRoot=scratchRoot,
+                startupTimeout=startupTimeout,
+                updatePolicy=updatePolicy,
+                updateTTL=updateTTL,
+            )
+            member.listeners += [functools.partial(self._record, member), self.metrics]
+            self.members.append(member)
+
+    def batch_preprocess(
+        self,
+        exam_import_folder: str,
+        exam_export_folder: str,
+        mode: str = "cpu",
+        confirm: bool = True,
+        skipUpdate: bool = False,
+        gpuid: str = "0",
+        workers: Union[int, str] = "auto",
+        resume: bool = False,
+    ) -> Dict[str, dict]:
+        """
+        Process the exams in the import folder with all backends at once.
+
+        Parameters:
+        - exam_import_folder (str): Import folder path, one folder per exam.
+        - exam_export_folder (str): Export folder path, shared by the backends.
+        - mode (str): Processing mode (e.g., "cpu", "gpu").
+        - confirm (bool): Whether confirmation of the shards is required.
+        - skipUpdate (bool): Whether to skip Docker update, regardless of the update policy.
+        - gpuid (str): GPU ID, or comma separated IDs the backends are spread over.
+        - workers (Union[int, str]): Number of workers to request per backend (advisory, passed as BRATS_WORKERS), "auto" sizes them by each backend's share of the cores and memory.
+        - resume (bool): Whether to process only the exams that are new, changed or not done according to the manifest in exam_export_folder. The manifest is kept either way.
+
+        Returns:
+        - Dict[str, dict]: Per exam the backend that processed it and its latest ipstatus.
+        """
+        examFolders: List[str] = _exam_folders(exam_import_folder)
+        manifest = ExamManifest(exam_export_folder)
+        if resume == True:
+            pending: Dict[str, str] = manifest.pending(examFolders)
+            print(
+                "{} of {} exams are new, changed or incomplete".format(
+                    len(pending), len(examFolders)
+                )
+            )
+        else:
+            pending = manifest.fingerprints(examFolders)
+        examFolders = list(pending)
+        if not examFolders:
+            print("no exams to process in", exam_import_folder)
+            return {}
+        # more backends than exams would idle
+        members: List[Preprocessor] = self.members[: len(examFolders)]
+        shards: List[List[str]] = _shard_exams(examFolders, len(members))
+        with self._statusLock:
+            self.status = {}
+            for member, shard in zip(members, shards):
+                for examFolder in shard:
+                    self.status[os.path.basename(examFolder)] = {
+                        "backend": member.backendName,
+                        "ipstatus": None,
+                    }
+        for member, shard in zip(members, shards):
+            print(
+                "{} (port {}): {} exams".format(
+                    member.backendName, member.port, len(shard)
+                )
+            )
+        if confirm == True:
+            if input('press "y" to continue.').lower() != "y":
+                return {}
+
+        if str(workers) == "auto":
+            # the backends share the host, each gets its share of it
+            memory: int = available_memory()
+            workers = preprocessing_workers(
+                "auto",
+                mode,
+                cpus=max(1, len(available_cpus()) // len(members)),
+                memory=None if memory is None else memory // len(members),
+            )
+        devices: List[str] = parse_devices(gpuid)
+        # update once, not once per backend
+        if self.noDocker != True and skipUpdate != True:
+            update_docker(policy=self.updatePolicy, ttl=self.updateTTL)
+        mount: bool = self.noDocker != True and platform.system() != "Windows"
+
+        errors: Dict[str, Exception] = {}
+        self.metrics.reset()
+        manifest.submit(pending)
+        for member in members:
+            member.listeners.append(manifest)
+
+        def run(member: Preprocessor, shard: List[str], device: str) -> None:
+            try:
+                with scratch_dir(self.scratchRoot) as shardFolder:
+                    mounts = _stage_shard(shard, shardFolder, mount=mount)
+                    self._start_member(
+                        member,
+                        exam_import_folder=shardFolder,
+                        exam_export_folder=exam_export_folder,
+                        mode=mode,
+                        skipUpdate=True,
+                        gpuid=device,
+                        workers=workers,
+                        mounts=mounts,
+                    )
+                    try:
+                        member.process_exams(confirm=False)
+                    finally:
+                        member.close_session()
+                manifest.complete(os.path.basename(f) for f in shard)
+            except Exception as e:
+                errors[member.backendName] = e
+
+        threads: List[threading.Thread] = [
+            threading.Thread(
+                target=run,
+                args=(member, shard, devices[i % len(devices)]),
+                name=member.backendName,
+            )
+            for i, (member, shard) in enumerate(zip(members, shards))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for member in members:
+            member.listeners.remove(manifest)
+        if self.reportPath is not None:
+            self.metrics.write_json(self.reportPath)
+
+        if errors:
+            raise RuntimeError(
+                "{} of {} backends failed: {}".format(
+                    len(errors),
+                    len(members),
+                    "; ".join("{}: {}".format(n, e) for n, e in errors.items()),
+                )
+            ) from next(iter(errors.values()))
+        with self._statusLock:
+            return dict(self.status)
+
+    def _start_member(self, member: Preprocessor, **sessionArgs) -> None:
+        """
+        Start the session of a member, on new free ports if another process
+        took the generated ones meanwhile.
+        """
+        for attempt in range(PORT_RETRIES + 1):
+            try:
+                member.start_session(**sessionArgs)
+                return
+            except Exception:
+                taken: bool = port_open("localhost", member.port) or port_open(
+                    "localhost", member.dashboardPort
+                )
+                if not self._portsGenerated or not taken or attempt == PORT_RETRIES:
+                    raise
+            port, dashboardPort = free_ports(2)
+            print(
+                "ports of {} are in use, retrying on {} and {}".format(
+                    member.backendName, port, dashboardPort
+                )
+            )
+            member._use_ports(port, dashboardPort)
+
+    def _record(self, member: Preprocessor, event: str, data: dict) -> None:
+        if event != "ipstatus":
+            return
+        with self._statusLock:
+            self.status[data["examid"]] = {
+                "backend": member.backendName,
+                "ipstatus": data["ipstatus"],
+            }
+
+
+class AsyncPreprocessor:
+    """
+    Preprocessor on the asyncio socket.IO client, for async services.
+
+    Every submitted exam gets a future that resolves from the ipstatus
+    events of the backend, so the next stage can work on one exam while
+    the following ones are still being preprocessed:
+
+        async with AsyncPreprocessor() as prep:
+            await prep.start_session(exam_export_folder="out", mode="cpu")
+            futures = [await prep.submit(*exam, outputFolder=...) for exam in exams]
+            for result in asyncio.as_completed(futures):
+                outputFolder = await result
+
+    The backend processes the exams in rounds of inspection and processing,
+    exams submitted during a round are processed in the next one. Needs
+    aiohttp, the asyncio transport of python-socketio.
+    """
+
+    # ipstatus messages resolving the future of an exam, other messages are progress
+    examDone: re.Pattern = EXAM_DONE
+    examFailed: re.Pattern = EXAM_FAILED
+
+    @citation_reminder
+    @deprecated_preprocessor
+    def __init__(
+        self,
+        noDocker: bool = False,
+        scratchRoot: str = None,
+        startupTimeout: float = 300,
+        updatePolicy: str = "ttl",
+        updateTTL: float = None,
+        backendName: str = BACKEND_NAME,
+        port: int = BACKEND_PORT,
+        dashboardPort: int = DASHBOARD_PORT,
+        reportPath: str = None,
+        metricsTextfile: str = None,
+        inspectionTimeout: float = 300,
+    ):
+        """
+        Initialize the AsyncPreprocessor instance.
+
+        Parameters:
+        - noDocker (bool): Flag indicating whether Docker is used.
+        - scratchRoot (Optional[str]): Directory to stage inputs in, e.g. a tmpfs. Defaults to $BRATS_SCRATCH or the system temp directory.
+        - startupTimeout (float): Seconds to wait for the backend to get ready.
+        - updatePolicy (str): When to check the registry for a newer backend image: "never", "ttl" (default) or "always". It is only pulled if its digest changed.
+        - updateTTL (Optional[float]): Seconds a registry check stays valid with "ttl", defaults to a day.
+        - backendName (str): Name of the backend container.
+        - port (int): Host port of the backend.
+        - dashboardPort (int): Host port of the backend's job dashboard.
+        - reportPath (Optional[str]): JSON file to write the progress metrics of the exams to after every processing round.
+        - metricsTextfile (Optional[str]): OpenMetrics textfile to keep up to date with the progress, e.g. for the node exporter.
+        - inspectionTimeout (float): Seconds to wait for the backend to inspect the import folder, the exams of the round fail after that.
+        """
+        # settings
+        self.clientVersion: str = "0.0.1"
+        self.mode: str = "cpu"
+        self.gpuid: str = "0"
+        self.workers: int = None
+        self.backendName: str = backendName
+        self.port: int = port
+        self.dashboardPort: int = dashboardPort
+        self.url: str = "http://localhost:{}".format(port)
+        self.startupTimeout: float = startupTimeout
+        self.inspectionTimeout: float = inspectionTimeout
+        self.updatePolicy: str = updatePolicy
+        self.updateTTL: float = updateTTL
+        self.noDocker: bool = noDocker
+        self.scratchRoot: str = scratchRoot
+
+        # init sio client
+        self.sio: socketio.AsyncClient = socketio.AsyncClient()
+
+        # the running session, see start_session
+        self.session: dict = None
+        self._sessionStack: ExitStack = None
+        self._identified: asyncio.Event = None
+        self._roundLock: asyncio.Lock = None
+        self._rounds: asyncio.Task = None
+        self._inspected: asyncio.Future = None
+        self._completed: asyncio.Future = None
+        self._error: str = None
+        # exam -> future, and output folder for submitted exams
+        self._futures: Dict[str, asyncio.Future] = {}
+        self._outputs: Dict[str, str] = {}
+        # submitted exams waiting for the next round, as (exam, input files)
+        self._queue: List[Tuple[str, List[str]]] = []
+
+        # progress of the exams, its callbacks get every update
+        self.reportPath: str = reportPath
+        self.metrics = PreprocessingMetrics(textfile=metricsTextfile)
+
+        # called with the event name and data of every status and ipstatus event
+        self.listeners: List[Callable[[str, dict], None]] = [self.metrics]
+
+        @self.sio.event
+        async def connect() -> None:
+            """
+            Event handler for successful connection.
+            """
+            print("connection established! sid:", self.sio.sid)
+            await self.sio.emit(
+                "clientidentification",
+                {"brats_cli": self.clientVersion, "proc_mode": self.mode},
+            )
+
+        @self.sio.event
+        async def disconnect() -> None:
+            """
+            Event handler for disconnection.
+            """
+            print("disconnected from server")
+
+        @self.sio.on("status")
+        async def on_status(data: dict) -> None:
+            """
+            Event handler for status update.
+            """
+            print("status received: ", data)
+            self._notify("status", data)
+            if data["message"] == "client ID json generation finished!":
+                self._identified.set()
+            elif data["message"] == "input inspection finished!":
+                _resolve(self._inspected, list(data.get("data") or []))
+            elif data["message"] == "image processing successfully completed.":
+                _resolve(self._completed, None)
+
+        @self.sio.on("client_outdated")
+        async def outdated(data: dict) -> None:
+            """
+            Event handler for outdated client version.
+            """
+            print(
+                "Your client version",
+                self.clientVersion,
+                "is outdated. Please download version",
+                data,
+                "from:",
+            )
+            print("https://neuronflow.github.io/brats-preprocessor/")
+            self._error = "client version {} is outdated".format(self.clientVersion)
+            error = RuntimeError(self._error)
+            self._identified.set()
+            for future in [self._inspected, self._completed]:
+                _resolve(future, error=error)
+            for exam in list(self._futures):
+                await self._finish_exam(exam, error)
+
+        @self.sio.on("ipstatus")
+        async def on_ipstatus(data: dict) -> None:
+            """
+            Event handler for image processing status, resolves the exam's future.
+            """
+            print("image processing status received:")
+            print(data["examid"], ": ", data["ipstatus"])
+            self._notify("ipstatus", data)
+            status: str = str(data["ipstatus"])
+            if self.examFailed.search(status):
+                await self._finish_exam(
+                    data["examid"],
+                    RuntimeError("{}: {}".format(data["examid"], status)),
+                )
+            elif self.examDone.search(status):
+                await self._finish_exam(data["examid"])
+
+    async def start_session(
+        self,
+        exam_import_folder: str = None,
+        exam_export_folder: str = None,
+        dicom_import_folder: str = None,
+        nifti_export_folder: str = None,
+        mode: str = "cpu",
+        skipUpdate: bool = False,
+        gpuid: str = "0",
+        workers: Union[int, str] = "auto",
+    ) -> None:
+        """
+        Start the backend and connect to it, once for many exams.
+
+        Parameters:
+        - exam_import_folder (Optional[str]): Import folder path. Defaults to a scratch directory submit stages its exams in.
+        - exam_export_folder (str): Export folder path.
+        - dicom_import_folder (Optional[str]): DICOM import folder path.
+        - nifti_export_folder (Optional[str]): NIfTI export folder path.
+        - mode (str): Processing mode (e.g., "cpu", "gpu").
+        - skipUpdate (bool): Whether to skip Docker update, regardless of the update policy.
+        - gpuid (str): GPU ID.
+        - workers (Union[int, str]): Number of backend workers to request (advisory, passed as BRATS_WORKERS), "auto" sizes them by the available cores and memory.
+
+        Returns:
+        - None
+        """
+        if self.session is not None:
+            raise RuntimeError("A preprocessing session is already running")
+        if exam_export_folder is None and nifti_export_folder is None:
+            raise ValueError("exam_export_folder is required")
+        self.mode = mode
+        self.gpuid = gpuid
+        self.workers = preprocessing_workers(workers, mode)
+        self.metrics.reset()
+        self._identified = asyncio.Event()
+        self._roundLock = asyncio.Lock()
+        self._error = None
+        stack = ExitStack()
+        if exam_import_folder is None and dicom_import_folder is None:
+            exam_import_folder = stack.enter_context(scratch_dir(self.scratchRoot))
+
+        loop = asyncio.get_running_loop()
+        try:
+            # starting the container blocks, don't block the loop meanwhile
+            await loop.run_in_executor(
+                None,
+                functools.partial(
+                    _start_backend,
+                    stack,
+                    noDocker=self.noDocker,
+                    skipUpdate=skipUpdate,
+                    url=self.url,
+                    startupTimeout=self.startupTimeout,
+                    updatePolicy=self.updatePolicy,
+                    updateTTL=self.updateTTL,
+                    exam_import_folder=exam_import_folder,
+                    exam_export_folder=exam_export_folder,
+                    dicom_import_folder=dicom_import_folder,
+                    nifti_export_folder=nifti_export_folder,
+                    mode=self.mode,
+                    gpuid=self.gpuid,
+                    workers=self.workers,
+                    name=self.backendName,
+                    port=self.port,
+                    dashboard_port=self.dashboardPort,
+                ),
+            )
+            await self.sio.connect(self.url)
+            print("sid:", self.sio.sid)
+            try:
+                await asyncio.wait_for(self._identified.wait(), self.startupTimeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("The backend did not identify the client")
+            if self._error is not None:
+                raise RuntimeError(self._error)
+        except BaseException:
+            if self.sio.connected:
+                await self.sio.disconnect()
+            await loop.run_in_executor(None, stack.close)
+            raise
+
+        self._sessionStack = stack
+        self.session = {
+            "exam_import_folder": _abspath(exam_import_folder or dicom_import_folder),
+            "exam_export_folder": _abspath(exam_export_folder or nifti_export_folder),
+        }
+
+    async def submit(
+        self,
+        t1File: str,
+        t1cFile: str,
+        t2File: str,
+        flaFile: str,
+        outputFolder: str,
+    ) -> asyncio.Future:
+        """
+        Submit a single exam to the running session.
+
+        Parameters:
+        - t1File (str): Path to T1 file.
+        - t1cFile (str): Path to T1c file.
+        - t2File (str): Path to T2 file.
+        - flaFile (str): Path to FLAIR file.
+        - outputFolder (str): Output folder path, its name is the exam's name.
+
+        Returns:
+        - asyncio.Future: Resolves to the output folder once the exam is preprocessed.
+        """
+        self._check_session()
+        exam: str = os.path.basename(os.path.normpath(outputFolder))
+        if exam in self._futures:
+            raise ValueError("{} is already submitted".format(exam))
+        future = self._future(exam)
+        self._outputs[exam] = os.path.abspath(outputFolder)
+        self._queue.append((exam, [t1File, t1cFile, t2File, flaFile]))
+        if self._rounds is None or self._rounds.done():
+            self._rounds = asyncio.ensure_future(self._process_queue())
+        return future
+
+    async def process_exams(self) -> Dict[str, asyncio.Future]:
+        """
+        Start processing the exams in the import folder of the running session.
+
+        Returns:
+        - Dict[str, asyncio.Future]: A future per exam found by the input inspection, resolving to its export folder.
+        """
+        self._check_session()
+        await self._roundLock.acquire()
+        try:
+            futures = await self._start_round()
+        except BaseException:
+            self._roundLock.release()
+            raise
+        task = asyncio.ensure_future(self._end_round(futures))
+        task.add_done_callback(lambda _: self._roundLock.release())
+        return futures
+
+    async def close_session(self) -> None:
+        """
+        Disconnect from the backend and shut it down. Exams not processed yet fail.
+        """
+        if self._rounds is not None and not self._rounds.done():
+            self._rounds.cancel()
+            # let the round remove its staged exams
+            await asyncio.wait([self._rounds])
+        self._queue = []
+        for exam in list(self._futures):
+            await self._finish_exam(exam, RuntimeError("The session was closed"))
+        self.session = None
+        stack, self._sessionStack = self._sessionStack, None
+        if self.sio.connected:
+            await self.sio.disconnect()
+        if stack is not None:
+            await asyncio.get_running_loop().run_in_executor(None, stack.close)
+
+    async def __aenter__(self) -> "AsyncPreprocessor":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close_session()
+
+    def _check_session(self) -> None:
+        if self.session is None:
+            raise RuntimeError("No preprocessing session, call start_session first")
+
+    def _notify(self, event: str, data: dict) -> None:
+        for listener in list(self.listeners):
+            listener(event, data)
+
+    def _future(self, exam: str) -> asyncio.Future:
+        if exam not in self._futures:
+            self._futures[exam] = asyncio.get_running_loop().create_future()
+        return self._futures[exam]
+
+    async def _finish_exam(self, exam: str, error: Exception = None) -> None:
+        """
+        Resolve the future of an exam with where its results are, or fail it.
+        """
+        future = self._futures.pop(exam, None)
+        outputFolder = self._outputs.pop(exam, None)
+        if future is None or future.done():
+            return
+        if error is None:
+            exported: str = os.path.join(self.session["exam_export_folder"], exam)
+            try:
+                # moving the results may take a while, don't block the loop
+                exported = await asyncio.get_running_loop().run_in_executor(
+                    None, _collect_results, exported, outputFolder
+                )
+            except OSError as e:
+                error = e
+            else:
+                if exported is not None:
+                    _resolve(future, exported)
+                    return
+                error = RuntimeError("The backend wrote no results for {}".format(exam))
+        _resolve(future, error=error)
+
+    async def _start_round(self) -> Dict[str, asyncio.Future]:
+        """
+        Inspect the import folder and start processing the exams found,
+        the round lock has to be held.
+        """
+        loop = asyncio.get_running_loop()
+        self._inspected = loop.create_future()
+        print("sending input inspection request!")
+        await self.sio.emit("input_inspection", {"hurray": "yes"})
+        try:
+            exams: List[str] = await asyncio.wait_for(
+                self._inspected, self.inspectionTimeout
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutError("The backend did not inspect the input")
+        print("input inspection found the following exams: ", exams)
+        # before processing starts, its first ipstatus may come any time
+        futures = {exam: self._future(exam) for exam in exams}
+        if exams:
+            self._completed = loop.create_future()
+            print("sending processing request!")
+            await self.sio.emit("brats_processing", {"hurray": "yes"})
+        return futures
+
+    async def _end_round(self, futures: Dict[str, asyncio.Future]) -> None:
+        """
+        Wait for the round to complete and resolve the exams without ipstatus.
+        """
+        try:
+            if futures:
+                await self._completed
+        except Exception as e:
+            for exam in futures:
+                await self._finish_exam(exam, e)
+        finally:
+            if self.reportPath is not None:
+                self.metrics.write_json(self.reportPath)
+        for exam in futures:
+            await self._finish_exam(exam)
+
+    async def _process_queue(self) -> None:
+        """
+        Process the submitted exams in rounds until none are waiting.
+        """
+        loop = asyncio.get_running_loop()
+        while self._queue:
+            async with self._roundLock:
+                batch, self._queue = self._queue, []
+                staged: List[str] = []
+
+                def stage() -> None:
+                    for exam, inputFiles in batch:
+                        tempFolder = os.path.join(
+                            self.session["exam_import_folder"], exam
+                        )
+                        os.makedirs(tempFolder)
+                        staged.append(tempFolder)
+                        _stage_exam(inputFiles, tempFolder)
+
+                def unstage() -> None:
+                    for tempFolder in staged:
+                        shutil.rmtree(tempFolder, ignore_errors=True)
+
+                error: Exception = None
+                try:
+                    # staging copies files, keep the loop free for the events
+                    await loop.run_in_executor(None, stage)
+                    await self._end_round(await self._start_round())
+                except Exception as e:
+                    error = e
+                finally:
+                    await _run_to_end(loop.run_in_executor(None, unstage))
+                # exams the backend didn't report, failed ones once unstaged
+                for exam, _ in batch:
+                    await self._finish_exam(exam, error)
+
+
+async def _run_to_end(future: asyncio.Future) -> None:
+    """
+    Await future, when cancelled meanwhile only after it is done, e.g. to
+    finish a cleanup in the executor before the cancellation goes on.
+    """
+    try:
+        await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await future
+        raise
+
+
+def _collect_results(exported: str, outputFolder: str = None) -> str:
+    """
+    Move the results of an exam from the export folder to outputFolder if
+    given. Returns where the results are, None if the backend wrote none.
+    """
+    if not os.path.exists(exported):
+        return None
+    if outputFolder is None:
+        return exported
+    return _move_results(exported, outputFolder)
+
+
+def _resolve(
+    future: asyncio.Future, result: object = None, error: Exception = None
+) -> None:
+    if future is None or future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
@@ -9,15 +9,17 @@
 __version__ = "0.1"
 __author__ = "Christoph Berger"
 
-import errno
+import asyncio
 import glob
 import json
 import logging
 import os
 import os.path as op
+import shutil
+import sqlite3
 import subprocess
-import sys
-import tempfile
+import time
+import uuid
 
 import numpy as np
 
@@ -25,6 +27,30 @@ from . import fusionator
 from .util import filemanager as fm
 from .util import own_itk as oitk
 from .util.citation_reminder import citation_reminder, new_segmentor_note
+from .util.async_runner import (
+    FATAL_PATTERNS,
+    AsyncContainerRunner,
+    ContainerStartError,
+    Watchdog,
+    WatchdogError,
+    run_sync,
+)
+from .util.container_runtime import container_name, get_runtime
+from .util.image_updates import ImageUpdater
+from .util.result_cache import ResultCache
+from .util import timing
+from .util.scratch import scratch_dir
+from .util.runtime_history import ENV_VAR as HISTORY_ENV_VAR
+from .util.runtime_history import RuntimeHistory, image_voxels
+from .util.scheduling import CpusetPool, GpuPool, lpt_makespan, parse_devices
+from .util.work_queue import ClaimLost, WorkQueue, worker_id
+
+# cids that segment with all containers of the config and fuse the results
+FUSION_METHODS = ["mav", "simple", "all"]
+# assumed dice with the fusion of containers that were never part of one
+DEFAULT_AGREEMENT = 0.5
+# larger label values are counted with np.unique
+MAX_BINCOUNT_LABEL = 2**16
 
 
 class Segmentor(object):
@@ -42,19 +68,78 @@ class Segmentor(object):
         tty=False,
         newdocker=True,
         gpu="0",
+        cache_root=None,
+        cpu_slots=None,
+        max_parallel=1,
+        runtime=None,
+        trace=False,
+        gpu_slots=None,
+        scratch_root=None,
+        runtime_history=None,
+        timeout=None,
+        idle_timeout=None,
     ):
-        """Init the orchestra class with placeholders"""
+        """
+        Init the orchestra class with placeholders
+
+        gpu takes one device id or several as list or comma separated string,
+        nvidia containers are scheduled onto the least busy of them. With
+        gpu_slots at most that many containers share one device at a time.
+        Inputs are staged below scratch_root (default: $BRATS_SCRATCH or the
+        system temp directory), e.g. a tmpfs or a local NVMe disk.
+        Container runtimes are only recorded if runtime_history is the path of
+        an SQLite database, True for the default
+        ~/.cache/brats_toolkit/runtime_history.sqlite, or if
+        $BRATS_RUNTIME_HISTORY is set. Without it jobs aren't ordered by
+        runtime and budgets can't select ensembles.
+        A watchdog kills containers running longer than timeout seconds, not
+        writing output for idle_timeout seconds or printing a known fatal
+        error. The config fields timeout, idle_timeout and fatal_patterns
+        override these per container.
+        """
         self.noOfContainers = 0
         self.config = []
         self.directory = None
         self.verbose = verbose
         self.tty = tty
         self.dockerGPU = newdocker
-        self.gpu = gpu
+        self.gpus = parse_devices(gpu)
+        self.gpu = ",".join(self.gpus)
+        self.gpuPool = GpuPool(self.gpus, gpu_slots)
         self.package_directory = op.dirname(op.abspath(__file__))
+        # backend executing the containers, docker unless a fake is requested
+        self.runtime = get_runtime(runtime)
+        # results are only cached if a cache root is configured
+        self.cache = (
+            ResultCache(cache_root, imageId=self.runtime.image_id)
+            if cache_root is not None
+            else None
+        )
+        # pin concurrently running containers to disjoint cpusets if requested
+        self.cpusetPool = CpusetPool(cpu_slots) if cpu_slots else None
+        # containers are executed as async subprocesses, max_parallel at a time
+        self.runner = AsyncContainerRunner(max_parallel)
+        # also write a chrome trace next to the json run report
+        self.trace = trace
+        self.scratch_root = scratch_root
+        # defaults for the watchdog of containers that don't configure it
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        # runtimes order the jobs longest first and predict the makespan
+        self.history = None
+        if runtime_history is None and os.environ.get(HISTORY_ENV_VAR):
+            runtime_history = True
+        if runtime_history:
+            try:
+                self.history = RuntimeHistory(
+                    None if runtime_history is True else runtime_history,
+                    runtime=self.runtime.name,
+                )
+            except (OSError, sqlite3.Error) as e:
+                logging.warning("Runtime history disabled: {}".format(e))
         # set environment variables to limit GPU usage
         os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"  # see issue #152
-        os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+        os.environ["CUDA_VISIBLE_DEVICES"] = self.gpu
         if config is None:
             config = op.join(self.package_directory, "config", "dockers.json")
         if fileformats is None:
@@ -88,105 +173,234 @@ class Segmentor(object):
         return len(self.config)
 
     def _runDummyContainer(self, stop=False):
-        command = "docker run --rm -it hello-world"
-        subprocess.check_call(command, shell=True)
+        subprocess.check_call(self.runtime.hello_command())
 
     def _runContainer(self, id, directory, outputDir, outputName):
         """
         Runs one container on one patient folder
         """
+        try:
+            status, _ = run_sync(
+                self._runContainerAsync(id, directory, outputDir, outputName)
+            )
+        except ContainerStartError as e:
+            logging.error("Segmentation with {} failed: {}".format(id, e))
+            return False
+        return status
+
+    async def _runContainerAsync(self, id, directory, outputDir, outputName, cases=1):
+        """
+        Runs one container on one patient folder without blocking the event loop,
+        batch mounts pass the number of cases to scale the timeout. Returns the
+        status and the seconds the container ran, without waiting for resources.
+        Raises ContainerStartError if the runtime could not start the container.
+        """
         logging.info("Now running a segmentation with the Docker {}.".format(id))
         logging.info("Output will be in {}.".format(outputDir))
 
         params = self.config[id]  # only references, doesn't copy
-        command = "docker run --rm"
-        # assemble the rest of the command
-        flags = params.get("flags", "")
-        # check if we need to map the user
-        if params.get("user_mode", False):
-            user_flags = "--user $(id -u):$(id -g)"
-        else:
-            user_flags = ""
-        # assemble the gpu flags if needed
-        if params["runtime"] == "nvidia":
-            if self.dockerGPU:
-                # TODO clean this up
-                gpu_flags = "--gpus device=" + str(self.gpu)
-            else:
-                gpu_flags = "--runtime=nvidia -e CUDA_VISIBLE_DEVICES=" + str(self.gpu)
-        else:
-            gpu_flags = ""
-        # assemble directory mapping
-        volume = "-v " + str(directory) + ":" + str(params["mountpoint"])
-        # assemble execution command
-        call = str(params["command"])
-
-        # stick everything together
-        command = (
-            command
-            + " "
-            + user_flags
-            + " "
-            + gpu_flags
-            + " "
-            + flags
-            + " "
-            + volume
-            + " "
-            + params["id"]
-            + " "
-            + call
-        )
+        # containers without a fixed cpuset get one from the pool
+        cpuset = params.get("cpuset")
+        pooledCpuset = gpu = None
+        # jobs cancelled while waiting give back what they already hold
+        try:
+            if cpuset is None and self.cpusetPool is not None:
+                cpuset = pooledCpuset = await self.cpusetPool.acquire()
+            # gpu containers run on the least busy device
+            if params["runtime"] == "nvidia":
+                gpu = await self.gpuPool.acquire()
+        except asyncio.CancelledError:
+            if pooledCpuset is not None:
+                self.cpusetPool.release(pooledCpuset)
+            raise
+        # named containers can be killed if they hang
+        name = container_name(id, uuid.uuid4().hex[:8])
+        command = self._containerCommand(id, directory, cpuset, gpu, name)
 
         if self.verbose:
-            print("Executing: {}".format(command))
+            print("Executing: {}".format(" ".join(command)))
+        logPath = op.join(outputDir, "{}_output.log".format(outputName.split(".")[0]))
         try:
-            with open(
-                op.join(outputDir, "{}_output.log".format(outputName.split(".")[0])),
-                "w",
-            ) as f:
-                subprocess.check_call(command, shell=True, stdout=f)
-        except Exception as e:
+            with timing.span("container_run", cid=id, cpuset=cpuset, gpu=gpu) as attrs:
+                start = time.perf_counter()
+                returncode = await self.runtime.run(
+                    self.runner,
+                    id,
+                    params,
+                    directory,
+                    command,
+                    logPath,
+                    watchdog=self._watchdog(params, cases),
+                    name=name,
+                )
+                seconds = time.perf_counter() - start
+                attrs["returncode"] = returncode
+        except WatchdogError as e:
+            logging.error(
+                "Segmentation with {} stopped by the watchdog for case {}: {}".format(
+                    id, directory, e
+                )
+            )
+            return False, None
+        except OSError as e:
             logging.error(
                 "Segmentation failed for case {} with error: {}".format(directory, e)
             )
-            if "exit status 125" in str(e):
-                logging.error(
+            return False, None
+        finally:
+            if pooledCpuset is not None:
+                self.cpusetPool.release(pooledCpuset)
+            if gpu is not None:
+                self.gpuPool.release(gpu)
+        if returncode != 0:
+            logging.error(
+                "Segmentation failed for case {} with error: exit status {}".format(
+                    directory, returncode
+                )
+            )
+            if returncode == 125:
+                raise ContainerStartError(
                     "DOCKER DAEMON not running! Please start your Docker runtime."
                 )
-                sys.exit(125)
-            return False
+            return False, None
         if self.verbose:
             logging.info("Container exited without error")
-        # fileh.close()
-        return True
+        return True, seconds
+
+    def _containerCommand(self, id, directory, cpuset=None, gpu=None, name=None):
+        """
+        Assembles the command running one container on one patient folder
+        """
+        return self.runtime.command(
+            id,
+            self.config[id],
+            directory,
+            gpu=self.gpus[0] if gpu is None else gpu,
+            newdocker=self.dockerGPU,
+            cpuset=cpuset,
+            name=name,
+        )
+
+    def _watchdog(self, params, cases=1):
+        """Returns the watchdog for a container from its config and the defaults"""
+        timeout = params.get("timeout", self.timeout)
+        return Watchdog(
+            timeout=timeout * cases if timeout else timeout,
+            idle_timeout=params.get("idle_timeout", self.idle_timeout),
+            fatal_patterns=FATAL_PATTERNS + params.get("fatal_patterns", []),
+        )
 
     def _runIterate(self, dir, cid):
-        """Iterates over a directory and runs the segmentation on each patient found"""
+        """
+        Runs container cid on every patient folder in dir, containers with
+        batch_mount in their config are launched once on the whole dir
+        """
         logging.info("Looking for BRATS data directories..")
-        for fn in os.listdir(dir):
-            if not os.path.isdir(os.path.join(dir, fn)):
-                continue  # Not a directory
-            if "DE_RI" in fn:
-                logging.info("Found pat data: {}".format(fn))
-                try:
-                    os.makedirs(os.path.join(os.path.join(dir, fn), "results"))
-                except OSError as err:
-                    if err.errno != errno.EEXIST:
-                        raise
-                logging.info("Calling Container: {}".format(cid))
-                if not self._runContainer(cid, os.path.join(dir, fn), dir):
-                    logging.info(
-                        "ERROR: Run failed for patient {} with container {}".format(
-                            fn, cid
-                        )
-                    )
-                    return False
-                # TODO: rename folder and prepend pat_id
-                # rename_folder(img_id, os.path.join(directory, fn), fn)
+        patients = [fn for fn in sorted(os.listdir(dir)) if op.isdir(op.join(dir, fn))]
+        for fn in patients:
+            os.makedirs(op.join(dir, fn, "results"), exist_ok=True)
+        if self.config[cid].get("batch_mount", False):
+            logging.info(
+                "Calling Container {} on {} patients".format(cid, len(patients))
+            )
+            return self._runContainer(cid, dir, dir, cid + "_batch.nii.gz")
+        for fn in patients:
+            logging.info("Found pat data: {}".format(fn))
+            logging.info("Calling Container: {}".format(cid))
+            if not self._runContainer(cid, op.join(dir, fn), dir, fn + ".nii.gz"):
+                logging.info(
+                    "ERROR: Run failed for patient {} with container {}".format(fn, cid)
+                )
+                return False
         return True
 
-    def _multiSegment(self, tempDir, inputs, method, outputName, outputDir):
+    async def _segmentJob(self, cid, inputs, stageDir, outputDir, outputPath):
+        """
+        segmentJob runs one (case, container) pair: cache lookup, staging,
+        container run and result handling
+
+        Args:
+            cid (str): the container id
+            inputs (dict): modality -> input image
+            stageDir (str): the directory mounted into the container
+            outputDir (str): the directory for logs
+            outputPath (str): the path of the resulting segmentation
+
+        Returns:
+            bool: True if a segmentation was saved
+        """
+        with timing.span("cache_lookup", cid=cid) as attrs:
+            cacheKey = await timing.run_in_executor(self._cacheKey, cid, inputs)
+            hit = cacheKey is not None and self.cache.fetch(cacheKey, outputPath)
+            attrs["hit"] = hit
+        if hit:
+            logging.info(
+                "[Weborchestra][Success] Reused cached segmentation of {}".format(cid)
+            )
+            return True
+        voxels, predicted = await timing.run_in_executor(
+            self._predictRuntime, cid, inputs
+        )
+        # staging only starts once a slot is free, so pending jobs don't fill the disk
+        # the longest jobs get the free slots first
+        async with self.runner.slot(priority=predicted or 0):
+            try:
+                saved = await self._runStaged(
+                    cid, inputs, stageDir, outputDir, outputPath, voxels
+                )
+            finally:
+                # the free space check only accounts for the running containers
+                await timing.run_in_executor(
+                    shutil.rmtree, stageDir, ignore_errors=True
+                )
+        if saved:
+            with timing.span("cache_store", cid=cid):
+                self._cacheStore(cacheKey, cid, outputPath)
+        return saved
+
+    async def _runStaged(self, cid, inputs, stageDir, outputDir, outputPath, voxels):
+        """Stages the inputs, runs the container and saves its result"""
+        with timing.span("stage", cid=cid):
+            await timing.run_in_executor(self._stageInputs, cid, inputs, stageDir)
+        if self.verbose:
+            logging.info(
+                "[Weborchestra][Info] Starting the Segmentation with {} now".format(cid)
+            )
+        try:
+            status, seconds = await self._runContainerAsync(
+                cid, stageDir, outputDir, op.basename(outputPath)
+            )
+        except ContainerStartError as e:
+            logging.error(e)
+            status = False
+        if status:
+            self._recordRuntime(cid, voxels, seconds)
+        else:
+            logging.error(
+                "[Weborchestra][Error] Segmentation with {} failed, see output!".format(
+                    cid
+                )
+            )
+            return False
+        if self.verbose:
+            logging.info("[Weborchestra][Success] Segmentation saved")
+        resultsDir = op.join(stageDir, "results/")
+        with timing.span("handle_result", cid=cid):
+            return await timing.run_in_executor(
+                self._handleResult, cid, resultsDir, outputPath
+            )
+
+    async def _multiSegment(
+        self,
+        tempDir,
+        inputs,
+        method,
+        outputName,
+        outputDir,
+        members=None,
+        deadline=None,
+        minMembers=1,
+    ):
         """
         multiSegment [summary]
 
@@ -196,44 +410,161 @@ class Segmentor(object):
             method ([type]): [description]
             outputName ([type]): [description]
             outputDir ([type]): [description]
+            members (list, optional): the containers to run, defaults to all of the config
+            deadline (float, optional): event loop time after which unfinished members are stopped
+            minMembers (int, optional): members to wait for even after the deadline
         """
         logging.debug("CALLED MULTISEGMENT")
-        fusion = fusionator.Fusionator()
-        for cid in self.config.keys():
-            # replace this with a call to single-segment
+        if members is None:
+            members = list(self.config.keys())
+        # results are fused as they arrive, "all" only keeps the members
+        accumulator = None
+        if method != "all":
+            accumulator = fusionator.FusionAccumulator(method, verbose=self.verbose)
+        jobs = []
+        for cid in members:
             logging.info("[Orchestra] Segmenting with " + cid)
-            ff = self._format(self._getFileFormat(cid), self.fileformats)
-            for key, img in inputs.items():
-                savepath = op.join(tempDir, ff[key])
-                img = oitk.get_itk_image(img)
-                if self.verbose:
-                    logging.info(
-                        "[Weborchestra][Info] Writing to path {}".format(savepath)
-                    )
-                oitk.write_itk_image(img, savepath)
-            if self.verbose:
-                logging.info("[Weborchestra][Info] Images saved correctly")
-                logging.info(
-                    "[Weborchestra][Info] Starting the Segmentation with container {} now".format(
-                        cid
+            # every container gets its own mount so they can run concurrently
+            stageDir = self._makeStageDir(op.join(tempDir, cid))
+            saveLocation = op.join(outputDir, cid + "_tumor_seg.nii.gz")
+            jobs.append(
+                asyncio.ensure_future(
+                    self._memberJob(
+                        cid, inputs, stageDir, outputDir, saveLocation, accumulator
                     )
                 )
+            )
+        if deadline is None:
+            results = await asyncio.gather(*jobs)
+        else:
+            results = await self._awaitMembers(jobs, deadline, minMembers)
+        for cid, status in zip(members, results):
+            if not status:
+                logging.error("Container run for CID {} failed!".format(cid))
+        if accumulator is not None:
+            if accumulator.count == 0:
+                logging.error("No segmentation to fuse, all containers failed!")
+                return False
+            with timing.span("fusion", method=method, members=accumulator.count):
+                fused = await timing.run_in_executor(
+                    accumulator.write, op.join(outputDir, outputName)
+                )
+            await timing.run_in_executor(self._recordAgreement, accumulator, fused)
+        return any(results)
 
-            status = self._runContainer(cid, tempDir, outputDir)
-            status = self._runContainer(cid, tempDir, outputDir, outputName)
-            if status:
-                if self.verbose:
-                    logging.info("[Weborchestra][Success] Segmentation saved")
-                resultsDir = op.join(tempDir, "results/")
-                saveLocation = op.join(outputDir, cid + "_tumor_seg.nii.gz")
-                self._handleResult(cid, resultsDir, outputPath=saveLocation)
-            else:
-                logging.exception("Container run for CID {} failed!".format(cid))
-        fusion._dirFuse(
-            outputDir, method=method, outputPath=op.join(outputDir, outputName)
+    async def _awaitMembers(self, jobs, deadline, minMembers):
+        """
+        Waits for the member jobs until the deadline, then stops the unfinished
+        ones. Keeps waiting past the deadline until minMembers succeeded.
+        """
+        loop = asyncio.get_running_loop()
+        done, pending = await asyncio.wait(
+            jobs, timeout=max(0.0, deadline - loop.time())
         )
+        while pending and sum(job.result() for job in done) < minMembers:
+            logging.warning(
+                "Budget exhausted with {} of {} required members, waiting for the next one".format(
+                    sum(job.result() for job in done), minMembers
+                )
+            )
+            finished, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            done |= finished
+        if pending:
+            logging.warning(
+                "Budget exhausted, stopping {} unfinished containers".format(
+                    len(pending)
+                )
+            )
+            for job in pending:
+                job.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return [job.result() if job in done else False for job in jobs]
 
-    def _singleSegment(self, tempDir, inputs, cid, outputName, outputDir):
+    def _selectEnsemble(self, inputs, budget, minMembers):
+        """
+        Picks the containers that agreed best with past fusions and together
+        fit into budget seconds on max_parallel slots, nvidia containers also
+        on the gpu slots. Containers without runtime history don't count as
+        fitting, if less than minMembers fit the fastest remaining ones are added.
+        """
+        cids = list(self.config.keys())
+        predicted = {cid: self._predictRuntime(cid, inputs)[1] for cid in cids}
+        agreement = {cid: self._agreement(cid) for cid in cids}
+
+        def rank(cid):
+            known = agreement[cid] if agreement[cid] is not None else DEFAULT_AGREEMENT
+            seconds = predicted[cid] if predicted[cid] is not None else float("inf")
+            return (-known, seconds)
+
+        chosen = []
+        for cid in sorted(cids, key=rank):
+            if predicted[cid] is None:
+                continue
+            candidates = chosen + [cid]
+            if self._makespan(candidates, [predicted[c] for c in candidates]) <= budget:
+                chosen.append(cid)
+        if len(chosen) < minMembers:
+            fitting = len(chosen)
+            rest = sorted(
+                (c for c in cids if c not in chosen), key=lambda c: rank(c)[::-1]
+            )
+            chosen += rest[: minMembers - len(chosen)]
+            logging.warning(
+                "Only {} containers fit into the budget of {}s, running {}".format(
+                    fitting, budget, chosen
+                )
+            )
+        logging.info(
+            "Selected the ensemble {} for a budget of {}s".format(chosen, budget)
+        )
+        return chosen
+
+    def _makespan(self, cids, seconds):
+        """Predicts the makespan of running cids concurrently, seconds holds the runtime of each"""
+        gpuSlots = None
+        if self.gpuPool.slots_per_device:
+            gpuSlots = len(self.gpus) * self.gpuPool.slots_per_device
+        return lpt_makespan(
+            seconds,
+            self.runner.max_parallel,
+            gpu=[self.config[cid]["runtime"] == "nvidia" for cid in cids],
+            gpu_slots=gpuSlots,
+        )
+
+    def _agreement(self, cid):
+        if self.history is None:
+            return None
+        return self.history.agreement(cid)
+
+    def _recordAgreement(self, accumulator, fused):
+        if self.history is None or accumulator.count < 2:
+            return
+        try:
+            for cid, dice in accumulator.agreement(fused).items():
+                self.history.record_agreement(cid, dice)
+        except sqlite3.Error as e:
+            logging.warning("Could not record the ensemble agreement: {}".format(e))
+
+    async def _memberJob(
+        self, cid, inputs, stageDir, outputDir, outputPath, accumulator
+    ):
+        """Runs one member of an ensemble and adds its result to the fusion"""
+        status = await self._segmentJob(cid, inputs, stageDir, outputDir, outputPath)
+        if status and accumulator is not None:
+            with timing.span("fusion_add", cid=cid):
+                try:
+                    await timing.run_in_executor(
+                        accumulator.add_file, outputPath, name=cid
+                    )
+                except (RuntimeError, ValueError) as e:
+                    logging.error(
+                        "Could not fuse the segmentation of {}: {}".format(cid, e)
+                    )
+        return status
+
+    async def _singleSegment(self, tempDir, inputs, cid, outputName, outputDir):
         """
         singleSegment [summary]
 
@@ -244,32 +575,21 @@ class Segmentor(object):
             outputName ([type]): [description]
             outputDir ([type]): [description]
         """
-        ff = self._format(self._getFileFormat(cid), self.fileformats)
-        for key, img in inputs.items():
-            savepath = op.join(tempDir, ff[key])
-            img = oitk.get_itk_image(img)
-            if self.verbose:
-                logging.info("[Weborchestra][Info] Writing to path {}".format(savepath))
-            oitk.write_itk_image(img, savepath)
-        if self.verbose:
-            logging.info("[Weborchestra][Info] Images saved correctly")
-            logging.info(
-                "[Weborchestra][Info] Starting the Segmentation with {} now".format(cid)
-            )
-        status = self._runContainer(cid, tempDir, outputDir, outputName)
-        if status:
-            if self.verbose:
-                logging.info("[Weborchestra][Success] Segmentation saved")
-            resultsDir = op.join(tempDir, "results/")
-            self._handleResult(
-                cid, resultsDir, outputPath=op.join(outputDir, outputName)
-            )
-            # delete tmp directory if result was saved elsewhere
-        else:
-            logging.error("[Weborchestra][Error] Segmentation failed, see output!")
+        stageDir = self._makeStageDir(tempDir)
+        return await self._segmentJob(
+            cid, inputs, stageDir, outputDir, op.join(outputDir, outputName)
+        )
 
     def segment(
-        self, t1=None, t1c=None, t2=None, fla=None, cid="mocker", outputPath=None
+        self,
+        t1=None,
+        t1c=None,
+        t2=None,
+        fla=None,
+        cid="mocker",
+        outputPath=None,
+        budget=None,
+        min_ensemble=2,
     ):
         """
         segment [summary]
@@ -281,16 +601,83 @@ class Segmentor(object):
             fla ([type], optional): [description]. Defaults to None.
             cid (str, optional): [description]. Defaults to 'mocker'.
             outputPath ([type], optional): [description]. Defaults to None.
+            budget (float, optional): wall clock seconds for mav and simple. Only the
+                containers that fit into the budget by their recorded runtimes are run,
+                preferring those that agreed best with past fusions, and what finished
+                in time is fused. Defaults to None, all containers.
+            min_ensemble (int, optional): number of members to fuse at least with a budget. Defaults to 2.
+
+        Returns:
+            bool: True if a segmentation was saved
+        """
+        return run_sync(
+            self.asegment(
+                t1=t1,
+                t1c=t1c,
+                t2=t2,
+                fla=fla,
+                cid=cid,
+                outputPath=outputPath,
+                budget=budget,
+                min_ensemble=min_ensemble,
+            )
+        )
+
+    async def asegment(
+        self,
+        t1=None,
+        t1c=None,
+        t2=None,
+        fla=None,
+        cid="mocker",
+        outputPath=None,
+        budget=None,
+        min_ensemble=2,
+    ):
+        """
+        asegment is the coroutine version of segment, use it to await many
+        segmentations from one event loop. Takes the same arguments as segment.
         """
+        # the budget includes staging and fusion
+        deadline = None
+        if budget is not None:
+            deadline = asyncio.get_running_loop().time() + budget
         # Call output method here
         outputName, outputDir = self._whereDoesTheFileGo(outputPath, t1, cid)
         # set up logging (for all internal functions)
-        logging.basicConfig(
-            format="%(asctime)s %(levelname)s:%(message)s",
-            filename=op.join(outputDir, "segmentor_high_level.log"),
-            level=logging.DEBUG,
-        )
-        logging.getLogger().addHandler(logging.StreamHandler())
+        self._setupLogging(outputDir)
+        # stage timings go into a report next to the output
+        stem = outputName.split(".")[0]
+        with timing.run_report(
+            "segment",
+            jsonPath=op.join(outputDir, stem + "_run_report.json"),
+            tracePath=op.join(outputDir, stem + "_trace.json") if self.trace else None,
+        ):
+            with timing.span("segment", cid=cid, budget=budget):
+                return await self._segment(
+                    t1,
+                    t1c,
+                    t2,
+                    fla,
+                    cid,
+                    outputName,
+                    outputDir,
+                    deadline=deadline,
+                    minMembers=min_ensemble,
+                )
+
+    async def _segment(
+        self,
+        t1,
+        t1c,
+        t2,
+        fla,
+        cid,
+        outputName,
+        outputDir,
+        deadline=None,
+        minMembers=1,
+    ):
         logging.debug("DIRNAME is: " + outputDir)
         logging.debug("FILENAME is: " + outputName)
         logging.info(
@@ -298,28 +685,476 @@ class Segmentor(object):
         )
         # switch between
         inputs = {"t1": t1, "t2": t2, "t1c": t1c, "fla": fla}
-        # create temporary directory for storage
-        storage = tempfile.TemporaryDirectory(dir=self.package_directory)
-        # TODO this is a potential security hazzard as all users can access the files now, but currently it seems the only way to deal with bad configured docker installations
-        os.chmod(storage.name, 0o777)
-        tempDir = op.abspath(storage.name)
-        resultsDir = op.join(tempDir, "results")
-        os.mkdir(resultsDir)
+        members = None
+        if deadline is not None and cid in ["mav", "simple"]:
+            budget = deadline - asyncio.get_running_loop().time()
+            members = await timing.run_in_executor(
+                self._selectEnsemble, inputs, budget, minMembers
+            )
+        elif deadline is not None:
+            logging.warning("The budget only applies to mav and simple, ignoring it")
+            deadline = None
+        # every running container has a copy of the inputs, check the scratch root can take them
+        if members is not None:
+            containers = len(members)
+        else:
+            containers = self.noOfContainers if cid in FUSION_METHODS else 1
+        slots = min(containers, self.runner.max_parallel)
+        required = slots * self._stagingBytes(inputs)
+        # the scratch directory is removed again even if containers fail
+        with scratch_dir(self.scratch_root, required=required) as tempDir:
+            if cid in FUSION_METHODS:
+                # segment with all containers
+                logging.info("Called singleSegment with method: " + cid)
+                return await self._multiSegment(
+                    tempDir,
+                    inputs,
+                    cid,
+                    outputName,
+                    outputDir,
+                    members=members,
+                    deadline=deadline,
+                    minMembers=minMembers,
+                )
+            else:
+                # segment only with a single container
+                logging.info("Called singleSegment with docker: " + cid)
+                return await self._singleSegment(
+                    tempDir, inputs, cid, outputName, outputDir
+                )
+
+    def segment_batch(self, cases, cid="mocker", batch_size=None):
+        """
+        segment_batch segments many cases from one event loop, at most
+        max_parallel containers run at the same time.
+
+        Containers with batch_mount in their config accept a directory with
+        one folder per case. They are launched once per batch_size cases
+        (default: the config field batch_size, else all cases), so the model
+        is only loaded once per launch.
+
+        Args:
+            cases (list): dicts with the keys t1, t1c, t2, fla and optionally outputPath
+            cid (str, optional): container id or fusion method for all cases. Defaults to 'mocker'.
+            batch_size (int, optional): cases per launch of a batch mount container.
+
+        Returns:
+            list: True for every case that produced a segmentation
+        """
+        return run_sync(self._segmentBatch(cases, cid, batch_size))
+
+    async def _segmentBatch(self, cases, cid, batch_size=None):
+        if cid not in FUSION_METHODS and self.config[cid].get("batch_mount", False):
+            return await self._segmentBatchMounted(cases, cid, batch_size)
+        plan = self.plan(cases, cid)
+        remaining = {i: [] for i in range(len(cases))}
+        for job in plan["jobs"]:
+            remaining[job["case"]].append(job)
+        # print, the log files are only set up per case
+        print(
+            "Predicted makespan of {} cases: {:.0f}s".format(
+                len(cases), plan["makespan"]
+            )
+        )
+
+        async def job(i, case):
+            try:
+                return await self.asegment(cid=cid, **case)
+            finally:
+                del remaining[i]
+                left = sum(remaining.values(), [])
+                eta = self._makespan(
+                    [j["cid"] for j in left], [j["seconds"] for j in left]
+                )
+                print(
+                    "{} of {} cases done, ETA {:.0f}s".format(
+                        len(cases) - len(remaining), len(cases), eta
+                    )
+                )
+
+        jobs = [job(i, case) for i, case in enumerate(cases)]
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        for case, result in zip(cases, results):
+            if isinstance(result, Exception):
+                logging.error(
+                    "Segmentation of {} failed with error: {}".format(
+                        case.get("t1"), result
+                    )
+                )
+        return [result is True for result in results]
+
+    async def _segmentBatchMounted(self, cases, cid, batch_size=None):
+        size = batch_size or self.config[cid].get("batch_size") or len(cases)
+        chunks = [cases[i : i + size] for i in range(0, len(cases), size)]
+        print(
+            "Segmenting {} cases with {} in {} launches".format(
+                len(cases), cid, len(chunks)
+            )
+        )
+        jobs = [self._segmentChunk(cid, k, chunk) for k, chunk in enumerate(chunks)]
+        results = []
+        for chunk, result in zip(
+            chunks, await asyncio.gather(*jobs, return_exceptions=True)
+        ):
+            if isinstance(result, Exception):
+                logging.error(
+                    "Batch starting with {} failed with error: {}".format(
+                        chunk[0].get("t1"), result
+                    )
+                )
+                result = [False] * len(chunk)
+            results += result
+        return results
+
+    async def _segmentChunk(self, cid, k, cases):
+        """Segments cases with one launch of a batch mount container"""
+        targets = []
+        for case in cases:
+            outputName, outputDir = self._whereDoesTheFileGo(
+                case.get("outputPath"), case["t1"], cid
+            )
+            inputs = {m: case[m] for m in ["t1", "t2", "t1c", "fla"]}
+            targets.append((inputs, op.join(outputDir, outputName)))
+        # the log and report of a launch go next to its first case
+        logDir = op.dirname(targets[0][1])
+        self._setupLogging(logDir)
+        stem = "{}_batch{}".format(cid, k)
+        with timing.run_report(
+            "segment_batch",
+            jsonPath=op.join(logDir, stem + "_run_report.json"),
+            tracePath=op.join(logDir, stem + "_trace.json") if self.trace else None,
+        ):
+            with timing.span("segment_batch", cid=cid, cases=len(cases)):
+                return await self._batchMountJob(cid, targets, stem, logDir)
+
+    async def _batchMountJob(self, cid, targets, stem, logDir):
+        """
+        batchMountJob stages the cases that aren't cached into one folder
+        each below a single mount, runs the container once and moves the
+        per case results to their outputs
+
+        Args:
+            cid (str): the container id
+            targets (list): (inputs, outputPath) per case
+            stem (str): name of the launch for logs
+            logDir (str): the directory for logs
+
+        Returns:
+            list: True for every case with a saved segmentation
+        """
+        statuses = [False] * len(targets)
+        cacheKeys = []
+        todo = []
+        for i, (inputs, outputPath) in enumerate(targets):
+            with timing.span("cache_lookup", cid=cid) as attrs:
+                cacheKey = await timing.run_in_executor(self._cacheKey, cid, inputs)
+                hit = cacheKey is not None and self.cache.fetch(cacheKey, outputPath)
+                attrs["hit"] = hit
+            cacheKeys.append(cacheKey)
+            if hit:
+                statuses[i] = True
+            else:
+                todo.append(i)
+        if not todo:
+            return statuses
+        required = sum(self._stagingBytes(targets[i][0]) for i in todo)
+        with scratch_dir(self.scratch_root, required=required) as mountDir:
+            caseDirs = {
+                i: self._makeStageDir(op.join(mountDir, "case_{:05d}".format(i)))
+                for i in todo
+            }
+            voxels, predicted = await timing.run_in_executor(
+                self._predictRuntime, cid, targets[todo[0]][0]
+            )
+            async with self.runner.slot(priority=(predicted or 0) * len(todo)):
+                with timing.span("stage", cid=cid, cases=len(todo)):
+                    for i in todo:
+                        await timing.run_in_executor(
+                            self._stageInputs, cid, targets[i][0], caseDirs[i]
+                        )
+                try:
+                    status, seconds = await self._runContainerAsync(
+                        cid, mountDir, logDir, stem + ".nii.gz", cases=len(todo)
+                    )
+                except ContainerStartError as e:
+                    logging.error(e)
+                    status = False
+                if status:
+                    # the history keeps runtimes per case
+                    self._recordRuntime(cid, voxels, seconds / len(todo))
+                else:
+                    logging.error(
+                        "[Weborchestra][Error] Batch {} failed, see output!".format(
+                            stem
+                        )
+                    )
+            # results of cases finished before a failure are still used
+            for i in todo:
+                with timing.span("handle_result", cid=cid):
+                    statuses[i] = await timing.run_in_executor(
+                        self._handleResult,
+                        cid,
+                        op.join(caseDirs[i], "results/"),
+                        targets[i][1],
+                    )
+                if statuses[i] and status:
+                    with timing.span("cache_store", cid=cid):
+                        self._cacheStore(cacheKeys[i], cid, targets[i][1])
+        return statuses
+
+    def update_images(self, cid="all", policy="ttl", ttl=None, max_parallel=4):
+        """
+        update_images pulls the images of the containers whose tag points to
+        a different digest in the registry, several at a time
+
+        Args:
+            cid (str, optional): container id, or a fusion method for all containers. Defaults to 'all'.
+            policy (str, optional): "never", "ttl" or "always", see util.image_updates. Defaults to "ttl".
+            ttl (float, optional): seconds a registry check stays valid. Defaults to a day.
+            max_parallel (int, optional): images checked and pulled at a time. Defaults to 4.
+
+        Returns:
+            dict: "pulled", "current", "cached", "skipped", "offline" or "failed" per image
+        """
+        cids = list(self.config.keys()) if cid in FUSION_METHODS else [cid]
+        updater = ImageUpdater(
+            self.runtime, policy=policy, ttl=ttl, max_parallel=max_parallel
+        )
+        return updater.update_all(self.config[c]["id"] for c in cids)
+
+    def plan(self, cases, cid="mocker"):
+        """
+        plan predicts the runtimes of a batch from the runtime history, with
+        the containers scheduled longest first on max_parallel slots and
+        nvidia containers on the gpu slots
+
+        Args:
+            cases (list): dicts with the keys t1, t1c, t2, fla and optionally outputPath
+            cid (str, optional): container id or fusion method for all cases. Defaults to 'mocker'.
+
+        Returns:
+            dict: the predicted seconds per job ("jobs"), the number of jobs
+            without history ("unknown"), "slots" and the predicted "makespan"
+        """
+        cids = list(self.config.keys()) if cid in FUSION_METHODS else [cid]
+        jobs = []
+        for i, case in enumerate(cases):
+            for member in cids:
+                _, seconds = self._predictRuntime(member, case)
+                jobs.append({"case": i, "cid": member, "seconds": seconds})
+        known = [j["seconds"] for j in jobs if j["seconds"] is not None]
+        # jobs without history are assumed to take a typical time
+        fallback = float(np.median(known)) if known else 0.0
+        unknown = len(jobs) - len(known)
+        for j in jobs:
+            if j["seconds"] is None:
+                j["seconds"] = fallback
+        return {
+            "jobs": jobs,
+            "unknown": unknown,
+            "slots": self.runner.max_parallel,
+            "makespan": self._makespan(
+                [j["cid"] for j in jobs], [j["seconds"] for j in jobs]
+            ),
+        }
+
+    def enqueue_batch(self, queueDir, cases, cid="mocker"):
+        """
+        enqueue_batch puts the work of a batch into a queue on a shared
+        filesystem: one item per (case, container) pair and for the fusion
+        methods one fusion item per case, which waits for its members.
+        Workers started with run_worker on any node mounting queueDir
+        process the items.
+
+        Args:
+            queueDir (str): the root directory of the queue
+            cases (list): dicts with the keys t1, t1c, t2, fla and optionally outputPath
+            cid (str, optional): container id or fusion method for all cases. Defaults to 'mocker'.
+
+        Returns:
+            list: the ids of the enqueued items
+        """
+        queue = WorkQueue(queueDir)
+        ids = []
+        for case in cases:
+            # other nodes need absolute paths
+            case = {k: op.abspath(v) for k, v in case.items() if v is not None}
+            outputName, outputDir = self._whereDoesTheFileGo(
+                case.get("outputPath"), case["t1"], cid
+            )
+            if cid not in FUSION_METHODS:
+                case["outputPath"] = op.join(outputDir, outputName)
+                ids.append(queue.put({"kind": "segment", "cid": cid, "case": case}))
+                continue
+            members = []
+            memberPaths = []
+            for member in self.config.keys():
+                memberPath = op.join(outputDir, member + "_tumor_seg.nii.gz")
+                memberCase = dict(case, outputPath=memberPath)
+                members.append(
+                    queue.put({"kind": "segment", "cid": member, "case": memberCase})
+                )
+                memberPaths.append(memberPath)
+            ids += members
+            if cid != "all":
+                fusionItem = {
+                    "kind": "fuse",
+                    "method": cid,
+                    "members": memberPaths,
+                    "outputPath": op.join(outputDir, outputName),
+                }
+                ids.append(queue.put(fusionItem, depends=members))
+        print("Enqueued {} items in {}".format(len(ids), queueDir))
+        return ids
+
+    def run_worker(
+        self, queueDir, heartbeat=30, stale_after=300, poll=5, exit_when_idle=True
+    ):
+        """
+        run_worker processes items of a shared queue, max_parallel at a time.
+        Start workers on as many nodes as you like, claims of crashed workers
+        are put back to the queue once their heartbeat is older than stale_after.
+
+        Args:
+            queueDir (str): the root directory of the queue
+            heartbeat (int, optional): seconds between heartbeats. Defaults to 30.
+            stale_after (int, optional): seconds after which claims without heartbeat are re-queued. Defaults to 300.
+            poll (int, optional): seconds to wait if no item is ready. Defaults to 5.
+            exit_when_idle (bool, optional): return once nothing is pending or claimed. Defaults to True.
+
+        Returns:
+            int: the number of processed items
+        """
+        queue = WorkQueue(queueDir, stale_after=stale_after)
+        return run_sync(self._work(queue, heartbeat, poll, exit_when_idle))
+
+    async def _work(self, queue, heartbeat, poll, exit_when_idle):
+        worker = worker_id()
+        print("Worker {} started on queue {}".format(worker, queue.root))
+        loops = [
+            self._workLoop(queue, worker, heartbeat, poll, exit_when_idle)
+            for _ in range(self.runner.max_parallel)
+        ]
+        processed = sum(await asyncio.gather(*loops))
+        print("Worker {} processed {} items".format(worker, processed))
+        return processed
+
+    async def _workLoop(self, queue, worker, heartbeat, poll, exit_when_idle):
+        processed = 0
+        while True:
+            queue.reap()
+            claim = queue.claim(worker)
+            if claim is None:
+                if exit_when_idle and queue.finished():
+                    return processed
+                await asyncio.sleep(poll)
+                continue
+            beat = asyncio.ensure_future(self._heartbeat(claim, heartbeat))
+            try:
+                status = await self._processItem(claim.payload)
+            except Exception as e:
+                logging.exception("Work item {} failed: {}".format(claim.item["id"], e))
+                status = False
+            finally:
+                beat.cancel()
+            if status:
+                claim.done()
+            else:
+                claim.fail()
+            processed += 1
+
+    async def _heartbeat(self, claim, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                claim.heartbeat()
+            except ClaimLost:
+                logging.warning("Lost the claim {}".format(claim.item["id"]))
+                return
+
+    async def _processItem(self, payload):
+        if payload["kind"] == "segment":
+            return await self.asegment(cid=payload["cid"], **payload["case"])
+        # fuse the members that were segmented successfully
+        members = [p for p in payload["members"] if op.exists(p)]
+        if not members:
+            return False
+        fusion = fusionator.Fusionator()
+        with timing.span("fusion", method=payload["method"]):
+            await timing.run_in_executor(
+                fusion.fuse, members, payload["outputPath"], method=payload["method"]
+            )
+        return op.exists(payload["outputPath"])
+
+    ### Private utility methods below ###
+
+    def _setupLogging(self, outputDir):
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)s:%(message)s",
+            filename=op.join(outputDir, "segmentor_high_level.log"),
+            level=logging.DEBUG,
+        )
+        # only add the console handler once, batches call this for every case
+        root = logging.getLogger()
+        if not any(type(h) is logging.StreamHandler for h in root.handlers):
+            root.addHandler(logging.StreamHandler())
+
+    def _makeStageDir(self, stageDir):
+        """Creates a directory to mount into a container, with a results folder"""
+        os.makedirs(stageDir, exist_ok=True)
+        resultsDir = op.join(stageDir, "results")
+        os.makedirs(resultsDir, exist_ok=True)
         # TODO this is a potential security hazzard as all users can access the files now, but currently it seems the only way to deal with bad configured docker installations
+        os.chmod(stageDir, 0o777)
         os.chmod(resultsDir, 0o777)
-        logging.debug(tempDir)
-        logging.debug(resultsDir)
+        return stageDir
 
-        if cid == "mav" or cid == "simple" or cid == "all":
-            # segment with all containers
-            logging.info("Called singleSegment with method: " + cid)
-            self._multiSegment(tempDir, inputs, cid, outputName, outputDir)
-        else:
-            # segment only with a single container
-            logging.info("Called singleSegment with docker: " + cid)
-            self._singleSegment(tempDir, inputs, cid, outputName, outputDir)
+    def _predictRuntime(self, cid, inputs):
+        """Returns the input size in voxels and the predicted seconds of a container run"""
+        if self.history is None:
+            return None, None
+        try:
+            voxels = image_voxels(inputs["t1"])
+        except RuntimeError:
+            return None, None
+        return voxels, self.history.predict(cid, voxels)
 
-    ### Private utility methods below ###
+    def _recordRuntime(self, cid, voxels, seconds):
+        if self.history is None or voxels is None:
+            return
+        try:
+            self.history.record(cid, voxels, seconds)
+        except sqlite3.Error as e:
+            logging.warning("Could not record the runtime of {}: {}".format(cid, e))
+
+    def _stagingBytes(self, inputs):
+        """Estimates the scratch space of one staged case from the size of its inputs on disk"""
+        return sum(op.getsize(img) for img in inputs.values())
+
+    def _stageInputs(self, cid, inputs, stageDir):
+        """Writes the inputs in the fileformat of the container to stageDir"""
+        ff = self._format(self._getFileFormat(cid), self.fileformats)
+        for key, img in inputs.items():
+            savepath = op.join(stageDir, ff[key])
+            img = oitk.get_itk_image(img)
+            if self.verbose:
+                logging.info("[Weborchestra][Info] Writing to path {}".format(savepath))
+            oitk.write_itk_image(img, savepath)
+        if self.verbose:
+            logging.info("[Weborchestra][Info] Images saved correctly")
+
+    def _cacheKey(self, cid, inputs):
+        """Returns the result cache key for a container run or None"""
+        if self.cache is None:
+            return None
+        return self.cache.key(inputs, self.config[cid])
+
+    def _cacheStore(self, key, cid, resultPath):
+        if key is None:
+            return
+        self.cache.store(
+            key, resultPath, meta={"cid": cid, "image": self.config[cid]["id"]}
+        )
 
     def _whereDoesTheFileGo(self, outputPath, t1path, cid):
         if outputPath is None:
@@ -355,7 +1190,8 @@ class Segmentor(object):
     def _handleResult(self, cid, directory, outputPath):
         """
         This function handles the copying and renaming of the
-        Segmentation result before returning
+        Segmentation result before returning, returns True if a
+        segmentation was saved
         """
         # Todo: Find segmentation result
         contents = glob.glob(op.join(directory, "tumor_" + cid + "_class.nii*"))
@@ -369,30 +1205,71 @@ class Segmentor(object):
             logging.error(
                 "[Weborchestra - Filehandling][Error] No segmentation saved, the container run has most likely failed."
             )
+            return False
         elif len(contents) > 1:
             logging.warning(
                 "[Weborchestra - Filehandling][Warning] Multiple Segmentations found"
             )
             print("found files: {}".format(contents))
-            img = oitk.get_itk_image(contents[0])
+            # all background results still yield a segmentation
             labels = 0
-            exportImg = None
-            for _, c in enumerate(contents):
-                img = oitk.get_itk_image(c)
-                if labels < len(np.unique(oitk.get_itk_array(img))):
-                    exportImg = img
-                    labels = len(np.unique(oitk.get_itk_array(img)))
-            oitk.write_itk_image(exportImg, op.join(outputPath))
+            best = contents[0]
+            for c in contents:
+                count = self._countLabels(oitk.get_itk_array(c))
+                if labels < count:
+                    best = c
+                    labels = count
+            self._ingestResult(best, outputPath)
             logging.warning(
                 "[Weborchestra - Filehandling][Warning] Segmentation with most labels ({}) for cid {} saved".format(
                     labels, cid
                 )
             )
-            return
-        img = oitk.get_itk_image(contents[0])
-        for c in contents:
-            os.remove(op.join(directory, c))
+            return True
+        return self._ingestResult(contents[0], outputPath)
+
+    def _ingestResult(self, resultPath, outputPath):
+        """
+        Moves a container result to outputPath. The image is only decoded
+        and written again if its format differs from the target or the
+        header looks broken.
+        """
+        if self._niftiSuffix(resultPath) == self._niftiSuffix(
+            outputPath
+        ) and self._headerLooksSane(resultPath):
+            shutil.move(resultPath, outputPath)
+            return True
+        img = oitk.get_itk_image(resultPath)
         oitk.write_itk_image(img, outputPath)
+        os.remove(resultPath)
+        return True
+
+    @staticmethod
+    def _niftiSuffix(path):
+        return ".nii.gz" if path.endswith(".nii.gz") else op.splitext(path)[1]
+
+    @staticmethod
+    def _headerLooksSane(path):
+        """Checks a segmentation via its header only, without decoding the voxels"""
+        try:
+            info = oitk.get_itk_information(path)
+        except Exception:
+            # unreadable headers take the decode path, which reports the error
+            return False
+        return info.GetDimension() == 3 and all(s > 0 for s in info.GetSize())
+
+    @staticmethod
+    def _countLabels(arr):
+        """Counts the distinct labels of a segmentation in one pass"""
+        # bincount allocates one counter per value, corrupt results may hold huge ones
+        if (
+            np.issubdtype(arr.dtype, np.integer)
+            and arr.size
+            and arr.min() >= 0
+            and arr.max() <= MAX_BINCOUNT_LABEL
+        ):
+            return int(np.count_nonzero(np.bincount(arr.ravel())))
+        return len(np.unique(arr))
 
     def _format(self, fileformat, configpath, verbose=True):
         # load fileformat for a given container
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""Asyncio based execution of container runs
+
+The runner launches containers as async subprocesses and streams their
+output into log files, so many (case, container) jobs can be awaited
+from one event loop. An optional watchdog stops containers that run too
+long, stop writing output or print a known fatal error.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import re
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+# seconds a cancelled container gets to shut down before it is killed
+TERMINATE_GRACE = 10
+# bytes read from the output at once, longer lines are logged in pieces
+READ_CHUNK = 2**16
+
+# output that means the container won't produce a result anymore
+FATAL_PATTERNS = [
+    r"CUDA out of memory",
+    r"CUDA error: out of memory",
+    r"no CUDA-capable device is detected",
+    r"could not select device driver .* with capabilities: \[\[gpu\]\]",
+    r"Segmentation fault \(core dumped\)",
+]
+
+
+class WatchdogError(Exception):
+    """Raised when the watchdog stopped a container"""
+
+
+class ContainerStartError(Exception):
+    """Raised when the container runtime could not start a container at all"""
+
+
+def run_sync(coro):
+    """
+    Runs a coroutine to completion from synchronous code. If the calling
+    thread already runs an event loop, e.g. in Jupyter, the coroutine gets
+    a loop of its own on a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+
+class Watchdog(object):
+    """
+    Conditions under which a running container is stopped: more than
+    timeout seconds in total, more than idle_timeout seconds without output
+    or an output line matching one of fatal_patterns.
+    """
+
+    def __init__(self, timeout=None, idle_timeout=None, fatal_patterns=None):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        if fatal_patterns is None:
+            fatal_patterns = FATAL_PATTERNS
+        self.fatal_patterns = [re.compile(p) for p in fatal_patterns]
+
+    def wait_time(self, started, lastOutput):
+        """Returns the seconds until the next deadline, None without deadlines"""
+        now = time.monotonic()
+        waits = []
+        if self.timeout:
+            waits.append(started + self.timeout - now)
+        if self.idle_timeout:
+            waits.append(lastOutput + self.idle_timeout - now)
+        return max(0.0, min(waits)) if waits else None
+
+    def expired(self, started, lastOutput):
+        """Returns why the container should be stopped or None"""
+        now = time.monotonic()
+        if self.timeout and now - started >= self.timeout:
+            return "timeout of {}s exceeded".format(self.timeout)
+        if self.idle_timeout and now - lastOutput >= self.idle_timeout:
+            return "no output for {}s".format(self.idle_timeout)
+        return None
+
+    def fatal(self, line):
+        """Returns the fatal pattern a line matches or None"""
+        for pattern in self.fatal_patterns:
+            if pattern.search(line):
+                return "fatal output: " + pattern.pattern
+        return None
+
+
+class _LineReader(object):
+    """
+    Splits a stream into lines ending with a newline or a carriage return.
+    Reads in chunks instead of StreamReader.readline, which fails on lines
+    longer than its limit, e.g. progress bars redrawn with \\r for hours.
+    """
+
+    def __init__(self, stream, chunk=READ_CHUNK):
+        self.stream = stream
+        self.chunk = chunk
+        self._buffer = bytearray()
+
+    def _lineEnd(self):
+        ends = [self._buffer.find(b"\n"), self._buffer.find(b"\r")]
+        ends = [i for i in ends if i >= 0]
+        return min(ends) + 1 if ends else None
+
+    async def readline(self):
+        """Returns the next line, at most chunk bytes of it, b"" at the end"""
+        while True:
+            end = self._lineEnd()
+            if end is None and len(self._buffer) >= self.chunk:
+                end = self.chunk
+            if end is not None:
+                line = bytes(self._buffer[:end])
+                del self._buffer[:end]
+                return line
+            data = await self.stream.read(self.chunk)
+            if not data:
+                line = bytes(self._buffer)
+                self._buffer.clear()
+                return line
+            self._buffer += data
+
+
+class _PrioritySlots(object):
+    """A semaphore handing free slots to the waiter with the highest priority"""
+
+    def __init__(self, slots):
+        self.free = slots
+        self._waiters = []
+        self._order = itertools.count()
+
+    async def acquire(self, priority):
+        if self.free > 0 and not self._waiters:
+            self.free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        # equal priorities are served first come, first served
+        heapq.heappush(self._waiters, (-priority, next(self._order), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just before the cancellation
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.free += 1
+
+
+class AsyncContainerRunner(object):
+    """
+    Limits the number of concurrently running jobs and executes container
+    commands without blocking the event loop. Free slots go to the waiting
+    job with the highest priority.
+    """
+
+    def __init__(self, max_parallel=1):
+        self.max_parallel = max(1, int(max_parallel))
+        # asyncio primitives are bound to a loop, keep one set of slots per loop
+        self._slots = weakref.WeakKeyDictionary()
+
+    def _loopSlots(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._slots:
+            self._slots[loop] = _PrioritySlots(self.max_parallel)
+        return self._slots[loop]
+
+    @asynccontextmanager
+    async def slot(self, priority=0):
+        """Waits for one of the max_parallel job slots, higher priorities first"""
+        slots = self._loopSlots()
+        await slots.acquire(priority)
+        try:
+            yield
+        finally:
+            slots.release()
+
+    async def run(self, command, logPath, watchdog=None, kill=None):
+        """
+        run executes one command and streams stdout and stderr to a log file
+
+        Args:
+            command (list): the command as list of arguments
+            logPath (str): the file the output is written to
+            watchdog (Watchdog, optional): stops the command if it hangs or fails
+            kill (coroutine function, optional): forcibly stops the container,
+                called before the process itself is terminated
+
+        Returns:
+            int: the exit code of the command
+
+        Raises:
+            WatchdogError: if the watchdog stopped the command
+            asyncio.CancelledError: if the job is cancelled, the process is
+                terminated before the error is propagated
+        """
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        try:
+            reason = await self.follow(
+                _LineReader(process.stdout).readline, logPath, watchdog
+            )
+            if reason is not None:
+                logging.error(
+                    "Watchdog stopping process {}: {}".format(process.pid, reason)
+                )
+                await self._stop(process, kill)
+                raise WatchdogError(reason)
+            return await process.wait()
+        except asyncio.CancelledError:
+            logging.warning("Job cancelled, stopping process {}".format(process.pid))
+            await self._stop(process, kill)
+            raise
+
+    async def follow(self, readline, logPath, watchdog=None):
+        """
+        follow writes the lines returned by the coroutine function readline
+        to a log file until it returns an empty line
+
+        Args:
+            readline (coroutine function): returns the next line as bytes
+            logPath (str): the file the output is written to
+            watchdog (Watchdog, optional): checks the output and the time
+
+        Returns:
+            str: why the watchdog fired, None if the output ended
+        """
+        started = lastOutput = time.monotonic()
+        reason = None
+        with open(logPath, "wb") as log:
+            while True:
+                wait = (
+                    None
+                    if watchdog is None
+                    else watchdog.wait_time(started, lastOutput)
+                )
+                try:
+                    line = await asyncio.wait_for(readline(), wait)
+                except asyncio.TimeoutError:
+                    reason = watchdog.expired(started, lastOutput)
+                    if reason is None:
+                        continue
+                    break
+                if not line:
+                    break
+                log.write(line)
+                log.flush()
+                lastOutput = time.monotonic()
+                if watchdog is not None:
+                    reason = watchdog.fatal(line.decode("utf-8", "replace"))
+                    if reason is not None:
+                        break
+            if reason is not None:
+                log.write("\n[watchdog] stopping: {}\n".format(reason).encode())
+        return reason
+
+    async def _stop(self, process, kill):
+        if kill is not None and process.returncode is None:
+            try:
+                await kill()
+            except Exception as e:
+                logging.warning("Could not kill the container: {}".format(e))
+        await self._terminate(process)
+
+    async def _terminate(self, process):
+        if process.returncode is not None:
+            return
+        # docker run forwards SIGTERM to the container
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), TERMINATE_GRACE)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
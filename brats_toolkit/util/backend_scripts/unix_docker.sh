@@ -11,16 +11,30 @@ if [ $# -eq 0 ]; then
   exit 1
 fi
 
-docker stop greedy_elephant
-docker run --rm -d --name=greedy_elephant -p 5000:5000 -p 9181:9181 -v "$2":"/data/import/dicom_import" -v "$3":"/data/export/nifti_export" -v "$4":"/data/import/exam_import" -v "$5":"/data/export/exam_export" projectelephant/server redis-server
-#wait until everything is started up
-sleep 5
+# the backend's container name and ports, several backends need distinct ones
+name="${BRATS_BACKEND_NAME:-greedy_elephant}"
+port="${BRATS_BACKEND_PORT:-5000}"
+dashboard_port="${BRATS_DASHBOARD_PORT:-9181}"
+
+docker stop "$name"
+# further arguments are single files to bind mount, as host:container[:options]
+extra_mounts=()
+for mount in "${@:7}"; do
+  extra_mounts+=(-v "$mount")
+done
+docker run --rm -d --name="$name" -p "$port":5000 -p "$dashboard_port":9181 -v "$2":"/data/import/dicom_import" -v "$3":"/data/export/nifti_export" -v "$4":"/data/import/exam_import" -v "$5":"/data/export/exam_export" "${extra_mounts[@]}" projectelephant/server redis-server || exit $?
+#wait until redis answers instead of a fixed sleep, give up after 150 tries
+for i in $(seq 1 150); do
+  docker exec "$name" redis-cli ping >/dev/null 2>&1 && break
+  sleep 0.2
+done
 #start x-server for non-gui gui
-docker exec -d greedy_elephant /bin/bash -c "source ~/.bashrc; Xorg -noreset +extension GLX +extension RANDR +extension RENDER -logfile ./etc/10.log -config ./etc/X11/xorg.conf :0;"
-docker exec -d greedy_elephant python3 elephant_server.py
-docker exec -d greedy_elephant /bin/bash -c "source ~/.bashrc; rq-dashboard;"
+docker exec -d "$name" /bin/bash -c "source ~/.bashrc; Xorg -noreset +extension GLX +extension RANDR +extension RENDER -logfile ./etc/10.log -config ./etc/X11/xorg.conf :0;"
+docker exec -d "$name" python3 elephant_server.py
+docker exec -d "$name" /bin/bash -c "source ~/.bashrc; rq-dashboard;"
 #ugly format to set correct path variable every time! (as .bashrc doesn't want to work)
-docker exec -d greedy_elephant /bin/bash -c "source ~/.bashrc; ./start_workers.sh;"
+# the number of workers is only passed in the environment, start_workers.sh takes no arguments
+docker exec -d -e BRATS_WORKERS="$1" "$name" /bin/bash -c "source ~/.bashrc; ./start_workers.sh;"
 
 # TODO fix user thing, also need to add user on exec
 # userid=$(id -u)
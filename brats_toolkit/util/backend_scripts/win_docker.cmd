@@ -1,11 +1,18 @@
 SETLOCAL ENABLEEXTENSIONS
 SET me=%~n0
 SET parent=%~dp0
+REM the backend's container name and ports, several backends need distinct ones
+IF "%BRATS_BACKEND_NAME%"=="" SET BRATS_BACKEND_NAME=greedy_elephant
+IF "%BRATS_BACKEND_PORT%"=="" SET BRATS_BACKEND_PORT=5000
+IF "%BRATS_DASHBOARD_PORT%"=="" SET BRATS_DASHBOARD_PORT=9181
 REM get container ID and stop it (rm is automatic)
-docker stop greedy_elephant
-docker run --rm -d --name=greedy_elephant -p 5000:5000 -p 9181:9181 -v %2:"/data/import/dicom_import" -v %3:"/data/export/nifti_export" -v %4:"/data/import/exam_import" -v %5:"/data/export/exam_export" projectelephant/server redis-server
-docker exec -d greedy_elephant /bin/bash -c "source ~/.bashrc; Xorg -noreset +extension GLX +extension RANDR +extension RENDER -logfile ./etc/10.log -config ./etc/X11/xorg.conf :0;"
-docker exec -d greedy_elephant python3 elephant_server.py
-docker exec -d greedy_elephant /bin/bash -c "source ~/.bashrc; rq-dashboard;"
-docker exec -d greedy_elephant /bin/bash -c "source ~/.bashrc; ./start_workers.sh;"
+docker stop %BRATS_BACKEND_NAME%
+docker run --rm -d --name=%BRATS_BACKEND_NAME% -p %BRATS_BACKEND_PORT%:5000 -p %BRATS_DASHBOARD_PORT%:9181 -v %2:"/data/import/dicom_import" -v %3:"/data/export/nifti_export" -v %4:"/data/import/exam_import" -v %5:"/data/export/exam_export" projectelephant/server redis-server
+REM e.g. a port in use, the caller may retry on other ports
+IF ERRORLEVEL 1 EXIT /B %ERRORLEVEL%
+docker exec -d %BRATS_BACKEND_NAME% /bin/bash -c "source ~/.bashrc; Xorg -noreset +extension GLX +extension RANDR +extension RENDER -logfile ./etc/10.log -config ./etc/X11/xorg.conf :0;"
+docker exec -d %BRATS_BACKEND_NAME% python3 elephant_server.py
+docker exec -d %BRATS_BACKEND_NAME% /bin/bash -c "source ~/.bashrc; rq-dashboard;"
+REM the number of workers is only passed in the environment, start_workers.sh takes no arguments
+docker exec -d -e BRATS_WORKERS=%1 %BRATS_BACKEND_NAME% /bin/bash -c "source ~/.bashrc; ./start_workers.sh;"
 @REM del temp.txt
@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+"""Container runtime backends
+
+The Segmentor talks to containers through a runtime backend. The docker
+backend drives the docker CLI, the docker-api backend talks to the Engine
+API on the daemon's unix socket and falls back to the CLI. The fake backend
+runs a local stand-in that writes a deterministic segmentation, which allows
+to profile and test the orchestration on machines without Docker.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import traceback
+
+from .async_runner import WatchdogError
+from .docker_api import DockerAPIError, EngineAPIClient, parse_bytes
+
+# label of the containers started through the Engine API, holds the cid
+CID_LABEL = "org.brats_toolkit.cid"
+
+
+def resource_flags(params, cpuset=None):
+    """
+    Assembles the docker resource limits from the optional config fields
+    cpus, memory and shm_size plus the cpuset to pin to
+    """
+    flags = []
+    if params.get("cpus"):
+        flags.append("--cpus=" + str(params["cpus"]))
+    if params.get("memory"):
+        # also cap the swap, otherwise the limit only moves the thrashing to disk
+        flags.append("--memory=" + str(params["memory"]))
+        flags.append("--memory-swap=" + str(params["memory"]))
+    if params.get("shm_size"):
+        flags.append("--shm-size=" + str(params["shm_size"]))
+    if cpuset:
+        flags.append("--cpuset-cpus=" + str(cpuset))
+    return flags
+
+
+def _split(value):
+    return shlex.split(str(value or ""), posix=os.name != "nt")
+
+
+def container_name(cid, suffix):
+    """Returns a valid docker container name for a run of cid"""
+    return re.sub(r"[^a-zA-Z0-9_.-]", "_", "brats_{}_{}".format(cid, suffix))
+
+
+class ContainerRuntime(object):
+    """
+    Base class of the runtime backends. Subclasses assemble the command
+    for a container run, run() executes it through an AsyncContainerRunner.
+    """
+
+    name = None
+
+    def command(
+        self, cid, params, directory, gpu="0", newdocker=True, cpuset=None, name=None
+    ):
+        """Returns the command running container cid on directory as list"""
+        raise NotImplementedError
+
+    async def run(
+        self,
+        runner,
+        cid,
+        params,
+        directory,
+        command,
+        logPath,
+        watchdog=None,
+        name=None,
+    ):
+        """
+        Executes a command created by command(), returns the exit code.
+        If the watchdog fires or the run is cancelled the container called
+        name is killed.
+        """
+        kill = functools.partial(self.kill, name) if name is not None else None
+        return await runner.run(command, logPath, watchdog=watchdog, kill=kill)
+
+    async def kill(self, name):
+        """Forcibly stops the container called name"""
+        pass
+
+    def hello_command(self):
+        """Returns a command checking that the runtime works"""
+        raise NotImplementedError
+
+    def image_id(self, image):
+        """Returns an id identifying the content of an image, None if unknown"""
+        return None
+
+    def repo_digests(self, image):
+        """Returns the registry digests of a local image, None if it is missing"""
+        return []
+
+    def stop(self, name):
+        pass
+
+    def remove(self, name):
+        pass
+
+    def pull(self, image):
+        pass
+
+
+class DockerCLIRuntime(ContainerRuntime):
+    """Runs containers with the docker command line interface"""
+
+    name = "docker"
+
+    def command(
+        self, cid, params, directory, gpu="0", newdocker=True, cpuset=None, name=None
+    ):
+        command = ["docker", "run", "--rm"]
+        # a name allows to kill the container if the docker client hangs
+        if name is not None:
+            command += ["--name", name]
+        # check if we need to map the user
+        if params.get("user_mode", False):
+            command += ["--user", "{}:{}".format(os.getuid(), os.getgid())]
+        # assemble the gpu flags if needed
+        if params["runtime"] == "nvidia":
+            if newdocker:
+                command += ["--gpus", "device=" + str(gpu)]
+            else:
+                command += [
+                    "--runtime=nvidia",
+                    "-e",
+                    "CUDA_VISIBLE_DEVICES=" + str(gpu),
+                ]
+        command += resource_flags(params, cpuset)
+        command += _split(params.get("flags", ""))
+        # assemble directory mapping
+        command += ["-v", str(directory) + ":" + str(params["mountpoint"])]
+        command.append(params["id"])
+        # assemble execution command
+        command += _split(params["command"])
+        return command
+
+    def hello_command(self):
+        return ["docker", "run", "--rm", "-it", "hello-world"]
+
+    def image_id(self, image):
+        try:
+            out = subprocess.run(
+                ["docker", "image", "inspect", "--format", "{{.Id}}", image],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            return out.stdout.strip() or None
+        except (OSError, subprocess.CalledProcessError):
+            logging.warning("Could not determine the image id of {}.".format(image))
+            return None
+
+    def repo_digests(self, image):
+        try:
+            out = subprocess.run(
+                [
+                    "docker",
+                    "image",
+                    "inspect",
+                    "--format",
+                    "{{json .RepoDigests}}",
+                    image,
+                ],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return json.loads(out.stdout) or []
+
+    def _docker(self, *args):
+        command = ["docker"] + list(args)
+        print("running docker command:", " ".join(command))
+        return subprocess.run(command)
+
+    def stop(self, name):
+        return self._docker("stop", name)
+
+    def remove(self, name):
+        return self._docker("rm", name)
+
+    def pull(self, image):
+        return self._docker("pull", image)
+
+    async def kill(self, name):
+        logging.warning("Killing container {}".format(name))
+        process = await asyncio.create_subprocess_exec(
+            "docker",
+            "kill",
+            name,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        await process.wait()
+
+
+class FakeRuntime(ContainerRuntime):
+    """
+    Local stand-in for docker. Without func, every run starts the script
+    brats_toolkit.util.fake_container, which sleeps, burns cpu and writes
+    a deterministic tumor_<cid>_class.nii.gz into the results folder.
+    With func, func(cid, params, directory) is called in a worker thread
+    instead and is expected to write the result itself.
+
+    The config fields fake_sleep and fake_burn override the default
+    seconds to sleep and to burn cpu for single containers. fake_message
+    is printed first, with fake_hang the stand-in never finishes, both
+    allow to exercise the watchdog. Containers with batch_mount segment
+    every case folder of the mounted directory.
+    """
+
+    name = "fake"
+
+    def __init__(self, func=None, sleep=0.0, burn=0.0):
+        self.func = func
+        self.sleep = sleep
+        self.burn = burn
+
+    def command(
+        self, cid, params, directory, gpu="0", newdocker=True, cpuset=None, name=None
+    ):
+        command = [
+            sys.executable,
+            "-m",
+            "brats_toolkit.util.fake_container",
+            str(directory),
+            "--cid",
+            cid,
+            "--sleep",
+            str(params.get("fake_sleep", self.sleep)),
+            "--burn",
+            str(params.get("fake_burn", self.burn)),
+            "--gpu",
+            str(gpu),
+        ]
+        if params.get("fake_message"):
+            command += ["--message", str(params["fake_message"])]
+        if params.get("fake_hang"):
+            command.append("--hang")
+        if params.get("batch_mount"):
+            command.append("--batch")
+        return command
+
+    async def run(
+        self,
+        runner,
+        cid,
+        params,
+        directory,
+        command,
+        logPath,
+        watchdog=None,
+        name=None,
+    ):
+        if self.func is None:
+            # there is no container to kill, stopping the process is enough
+            return await runner.run(command, logPath, watchdog=watchdog)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.func, cid, params, directory)
+        except Exception:
+            with open(logPath, "w") as log:
+                log.write(traceback.format_exc())
+            return 1
+        with open(logPath, "w") as log:
+            log.write("fake run of {} finished\n".format(cid))
+        return 0
+
+    def hello_command(self):
+        return [sys.executable, "-c", "print('Hello from the fake runtime!')"]
+
+    def image_id(self, image):
+        return "fake:" + image
+
+
+class DockerCommand(list):
+    """The argv of a docker run, carrying the equivalent Engine API config"""
+
+    def __init__(self, argv, config=None):
+        super().__init__(argv)
+        self.config = config
+
+
+class DockerAPIRuntime(DockerCLIRuntime):
+    """
+    Runs containers through the Engine API on the daemon's unix socket with
+    a pooled connection: create, start, follow the logs, wait and remove.
+    Containers with custom CLI flags in their config, which have no general
+    API equivalent, are still run with the docker CLI.
+    """
+
+    name = "docker-api"
+
+    def __init__(self, socket_path=None, client=None):
+        self.client = client or EngineAPIClient(socket_path)
+
+    def available(self):
+        return self.client.ping()
+
+    def command(
+        self, cid, params, directory, gpu="0", newdocker=True, cpuset=None, name=None
+    ):
+        argv = super().command(cid, params, directory, gpu, newdocker, cpuset, name)
+        config = None
+        if not _split(params.get("flags", "")):
+            config = self.container_config(
+                cid, params, directory, gpu, newdocker, cpuset
+            )
+        return DockerCommand(argv, config)
+
+    def container_config(
+        self, cid, params, directory, gpu="0", newdocker=True, cpuset=None
+    ):
+        """Returns the Engine API config equivalent to the docker run command"""
+        hostConfig = {"Binds": [str(directory) + ":" + str(params["mountpoint"])]}
+        config = {
+            "Image": params["id"],
+            "Labels": {CID_LABEL: cid},
+            "HostConfig": hostConfig,
+        }
+        if _split(params["command"]):
+            config["Cmd"] = _split(params["command"])
+        if params.get("user_mode", False):
+            config["User"] = "{}:{}".format(os.getuid(), os.getgid())
+        if params["runtime"] == "nvidia":
+            if newdocker:
+                hostConfig["DeviceRequests"] = [
+                    {
+                        "Driver": "nvidia",
+                        "DeviceIDs": [str(gpu)],
+                        "Capabilities": [["gpu"]],
+                    }
+                ]
+            else:
+                hostConfig["Runtime"] = "nvidia"
+                config["Env"] = ["CUDA_VISIBLE_DEVICES=" + str(gpu)]
+        if params.get("cpus"):
+            hostConfig["NanoCpus"] = int(float(params["cpus"]) * 1e9)
+        if params.get("memory"):
+            hostConfig["Memory"] = parse_bytes(params["memory"])
+            hostConfig["MemorySwap"] = parse_bytes(params["memory"])
+        if params.get("shm_size"):
+            hostConfig["ShmSize"] = parse_bytes(params["shm_size"])
+        if cpuset:
+            hostConfig["CpusetCpus"] = str(cpuset)
+        return config
+
+    async def run(
+        self,
+        runner,
+        cid,
+        params,
+        directory,
+        command,
+        logPath,
+        watchdog=None,
+        name=None,
+    ):
+        config = getattr(command, "config", None)
+        if config is None:
+            return await super().run(
+                runner, cid, params, directory, command, logPath, watchdog, name
+            )
+        loop = asyncio.get_running_loop()
+        container = await loop.run_in_executor(
+            None, self._create, config, name, params["id"]
+        )
+        try:
+            await loop.run_in_executor(None, self.client.start, container)
+            reason = await runner.follow(
+                self._followLogs(container), logPath, watchdog=watchdog
+            )
+            if reason is not None:
+                logging.error("Watchdog stopping container {}: {}".format(name, reason))
+                await self._kill(container)
+                raise WatchdogError(reason)
+            return await loop.run_in_executor(None, self.client.wait, container)
+        except asyncio.CancelledError:
+            await self._kill(container)
+            raise
+        finally:
+            try:
+                await loop.run_in_executor(None, self.client.remove, container, True)
+            except OSError as e:
+                logging.warning("Could not remove container {}: {}".format(name, e))
+
+    def _create(self, config, name, image):
+        try:
+            return self.client.create_container(config, name)
+        except DockerAPIError as e:
+            if e.status != 404:
+                raise
+        # docker run pulls missing images, so do we
+        for _ in self.client.pull(image):
+            pass
+        return self.client.create_container(config, name)
+
+    def _followLogs(self, container):
+        """Returns a coroutine function reading the next log line of container"""
+        loop = asyncio.get_running_loop()
+        lines = asyncio.Queue()
+
+        def put(line):
+            try:
+                loop.call_soon_threadsafe(lines.put_nowait, line)
+            except RuntimeError:
+                pass  # the loop is gone
+
+        def pump():
+            try:
+                for line in self.client.logs(container):
+                    put(line)
+            except OSError as e:
+                logging.warning("Lost the log stream of {}: {}".format(container, e))
+            finally:
+                put(b"")
+
+        # a thread of its own, the stream blocks for the whole container run
+        threading.Thread(target=pump, daemon=True).start()
+        return lines.get
+
+    async def _kill(self, container):
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.client.kill, container
+            )
+        except OSError as e:
+            logging.warning("Could not kill container {}: {}".format(container, e))
+
+    async def kill(self, name):
+        logging.warning("Killing container {}".format(name))
+        await self._kill(name)
+
+    def image_id(self, image):
+        try:
+            return self.client.image_id(image)
+        except OSError:
+            return super().image_id(image)
+
+    def repo_digests(self, image):
+        try:
+            return self.client.inspect_image(image).get("RepoDigests") or []
+        except DockerAPIError as e:
+            if e.status == 404:
+                return None
+            raise
+        except OSError:
+            return super().repo_digests(image)
+
+    def stop(self, name):
+        print("stopping container", name)
+        try:
+            self.client.stop(name)
+        except DockerAPIError as e:
+            print(e)
+
+    def remove(self, name):
+        print("removing container", name)
+        try:
+            self.client.remove(name)
+        except DockerAPIError as e:
+            print(e)
+
+    def pull(self, image):
+        print("pulling image", image)
+        for message in self.client.pull(image):
+            if "status" in message and "progressDetail" not in message:
+                print(message["status"])
+
+
+def docker_api_or_cli(socket_path=None):
+    """Returns the Engine API runtime if the daemon answers, else the CLI runtime"""
+    runtime = DockerAPIRuntime(socket_path)
+    if runtime.available():
+        return runtime
+    logging.warning(
+        "Docker Engine API not reachable on {}, using the docker CLI".format(
+            runtime.client.socket_path
+        )
+    )
+    return DockerCLIRuntime()
+
+
+RUNTIMES = {
+    "docker": DockerCLIRuntime,
+    "docker-api": docker_api_or_cli,
+    "fake": FakeRuntime,
+}
+
+
+def get_runtime(runtime=None):
+    """
+    Returns a runtime backend for a name ("docker", "docker-api", "fake")
+    or passes through a ContainerRuntime instance. Defaults to docker.
+    """
+    if runtime is None:
+        runtime = "docker"
+    if isinstance(runtime, ContainerRuntime):
+        return runtime
+    try:
+        return RUNTIMES[runtime]()
+    except KeyError:
+        raise ValueError(
+            "Unknown container runtime {}, choose one of {}".format(
+                runtime, list(RUNTIMES.keys())
+            )
+        )
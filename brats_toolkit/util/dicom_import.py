@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""Local conversion of DICOM trees to exam folders
+
+Instead of leaving the DICOM import to the preprocessing backend, the tree
+is indexed once: the headers of all files are read in parallel and the
+files grouped by series instance UID. Every study with a t1, t1c, t2 and
+FLAIR series becomes an exam folder, its series are converted to NIfTI in
+a process pool. The exam folders are what batch_preprocess expects as
+exam_import_folder. Series converted before and unchanged since are kept.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import os
+import os.path as op
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import SimpleITK as sitk
+
+from . import own_itk as oitk
+from .scheduling import available_cpus
+
+MODALITIES = ["t1", "t1c", "t2", "fla"]
+
+TAGS = {
+    "patient": "0010|0020",
+    "study": "0020|000d",
+    "date": "0008|0020",
+    "series": "0020|000e",
+    "description": "0008|103e",
+    "protocol": "0018|1030",
+    "instance": "0020|0013",
+    "position": "0020|0032",
+    "orientation": "0020|0037",
+}
+
+
+def modality_of(description):
+    """
+    Guesses the modality of a series from its description or protocol name
+
+    Returns:
+        str: one of MODALITIES, None for other series
+    """
+    d = description.lower()
+    if re.search(r"flair|\bfla\b|t2.?fl|\bdark.?fluid", d):
+        return "fla"
+    if re.search(r"t1|mprage|spgr|\btfl\b|bravo", d):
+        if re.search(r"\+ ?c\b|\bce\b|gd|gad|contrast|post|\bkm\b", d):
+            return "t1c"
+        return "t1"
+    if re.search(r"t2", d):
+        return "t2"
+    return None
+
+
+def _floats(value):
+    try:
+        return [float(v) for v in value.split("\\")]
+    except (AttributeError, ValueError):
+        return None
+
+
+def read_header(path):
+    """
+    Reads the tags needed for grouping and sorting from a DICOM file,
+    without its pixel data
+
+    Returns:
+        dict: the TAGS values, None if path is no DICOM file
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO("GDCMImageIO")
+    reader.SetFileName(path)
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return None
+    header = {"path": path, "mtime": os.stat(path).st_mtime}
+    for name, tag in TAGS.items():
+        value = reader.GetMetaData(tag).strip() if reader.HasMetaDataKey(tag) else ""
+        header[name] = value
+    if not header["series"]:
+        return None
+    header["position"] = _floats(header["position"])
+    header["orientation"] = _floats(header["orientation"])
+    return header
+
+
+def _index_directory(directory):
+    """Reads the headers of the DICOM files directly in directory"""
+    headers = []
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        if entry.is_file():
+            header = read_header(entry.path)
+            if header is not None:
+                headers.append(header)
+    return headers
+
+
+def _slice_key(header):
+    # along the slice normal if the geometry is known, else by instance number
+    position, orientation = header["position"], header["orientation"]
+    if position and orientation and len(position) == 3 and len(orientation) == 6:
+        r, c = orientation[:3], orientation[3:]
+        normal = [
+            r[1] * c[2] - r[2] * c[1],
+            r[2] * c[0] - r[0] * c[2],
+            r[0] * c[1] - r[1] * c[0],
+        ]
+        return (0, sum(p * n for p, n in zip(position, normal)), header["path"])
+    try:
+        instance = float(header["instance"])
+    except ValueError:
+        instance = 0.0
+    return (1, instance, header["path"])
+
+
+def index_dicom(dicom_folder, max_workers=None):
+    """
+    index_dicom reads the headers of all files below dicom_folder once, in
+    parallel per directory, and groups them by series instance UID
+
+    Returns:
+        dict: series uid -> dict with patient, study, date, description,
+        protocol, the sorted files and the newest mtime of them
+    """
+    directories = [root for root, _, files in os.walk(dicom_folder) if files]
+    workers = _workers(max_workers, len(directories))
+    headers = []
+    if workers <= 1:
+        for directory in directories:
+            headers += _index_directory(directory)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for found in pool.map(_index_directory, directories, chunksize=8):
+                headers += found
+    series = {}
+    for header in headers:
+        entry = series.setdefault(
+            header["series"],
+            {
+                k: header[k]
+                for k in ["patient", "study", "date", "description", "protocol"]
+            },
+        )
+        entry.setdefault("headers", []).append(header)
+    for entry in series.values():
+        found = sorted(entry.pop("headers"), key=_slice_key)
+        entry["files"] = [h["path"] for h in found]
+        entry["mtime"] = max(h["mtime"] for h in found)
+    return series
+
+
+def _workers(max_workers, tasks):
+    if max_workers is None:
+        max_workers = len(available_cpus())
+    return max(1, min(int(max_workers), tasks))
+
+
+def _name(value):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", value).strip("_")
+
+
+def plan_exams(series, classify=modality_of):
+    """
+    Picks per study the series of each modality, the one with the most
+    slices if there are several
+
+    Returns:
+        tuple: exam name -> modality -> series uid, and exam name -> why it
+        is skipped for studies lacking a modality
+    """
+    studies = {}
+    for uid, entry in series.items():
+        modality = classify(entry["description"]) or classify(entry["protocol"])
+        if modality is None:
+            continue
+        study = studies.setdefault((entry["patient"], entry["study"]), {})
+        current = study.get(modality)
+        if current is None or len(entry["files"]) > len(series[current]["files"]):
+            study[modality] = uid
+    exams, skipped = {}, {}
+    for (patient, study), found in sorted(studies.items()):
+        some = series[next(iter(found.values()))]
+        name = _name(patient) or "anonymous"
+        name += "_" + (_name(some["date"]) or _name(study)[-8:])
+        if name in exams or name in skipped:
+            name += "_" + _name(study)[-8:]
+        missing = [m for m in MODALITIES if m not in found]
+        if missing:
+            skipped[name] = "no {} series".format(", ".join(missing))
+        else:
+            exams[name] = found
+    return exams, skipped
+
+
+def convert_series(files, path):
+    """Converts the sorted files of a series to the image at path"""
+    image = oitk.read_dicom(list(files), verbose=False)
+    # write next to the target and rename, reruns never see partial files
+    tmp = op.join(op.dirname(path), ".converting_" + op.basename(path))
+    sitk.WriteImage(image, tmp, True)
+    os.replace(tmp, path)
+    return path
+
+
+def import_dicom(
+    dicom_folder, exam_import_folder, max_workers=None, classify=modality_of
+):
+    """
+    import_dicom converts the studies below dicom_folder into exam folders
+    in exam_import_folder, one NIfTI file per modality, named as the
+    preprocessing backend expects them
+
+    Args:
+        dicom_folder (str): the DICOM tree, in any layout
+        exam_import_folder (str): where the exam folders are written
+        max_workers (int, optional): processes, defaults to the available cpus
+        classify (callable, optional): maps a series description to a modality
+
+    Returns:
+        tuple: exam name -> modality -> NIfTI file of the converted exams,
+        and exam name -> reason of the skipped ones
+    """
+    series = index_dicom(dicom_folder, max_workers=max_workers)
+    exams, skipped = plan_exams(series, classify=classify)
+    print(
+        "indexed {} series below {}: {} exams".format(
+            len(series), dicom_folder, len(exams)
+        )
+    )
+
+    jobs = {}
+    converted = {}
+    for exam, found in exams.items():
+        folder = op.join(exam_import_folder, exam)
+        os.makedirs(folder, exist_ok=True)
+        converted[exam] = {}
+        for modality, uid in found.items():
+            path = op.join(folder, "{}_{}.nii.gz".format(exam, modality))
+            converted[exam][modality] = path
+            # keep what an earlier import converted from the same files
+            if op.exists(path) and op.getmtime(path) >= series[uid]["mtime"]:
+                continue
+            jobs[(exam, modality)] = (series[uid]["files"], path)
+
+    workers = _workers(max_workers, len(jobs))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(convert_series, files, path): key
+            for key, (files, path) in jobs.items()
+        }
+        for future in as_completed(futures):
+            exam, modality = futures[future]
+            try:
+                future.result()
+            except (RuntimeError, IOError) as e:
+                skipped[exam] = "{} conversion failed: {}".format(modality, e)
+                # the backend must not see an incomplete exam
+                shutil.rmtree(op.join(exam_import_folder, exam), ignore_errors=True)
+    for exam, reason in skipped.items():
+        converted.pop(exam, None)
+        print("skipping exam {}: {}".format(exam, reason))
+    return converted, skipped
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""Minimal client for the Docker Engine API on the local unix socket
+
+Talks HTTP/1.1 to the docker daemon directly instead of starting a docker
+CLI process per operation. Idle keep-alive connections are pooled, log
+streams get a connection of their own. Only the standard library is used.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import http.client
+import json
+import os
+import queue
+import socket
+import struct
+from urllib.parse import quote, urlencode
+
+API_VERSION = "v1.41"
+DEFAULT_SOCKET = "/var/run/docker.sock"
+
+
+def default_socket():
+    """Returns the daemon socket from DOCKER_HOST if it is a unix socket"""
+    host = os.environ.get("DOCKER_HOST", "")
+    if host.startswith("unix://"):
+        return host[len("unix://") :]
+    return DEFAULT_SOCKET
+
+
+def parse_bytes(value):
+    """Converts docker sizes like 512m or 8g to bytes"""
+    value = str(value).strip().lower()
+    units = {"b": 1, "k": 2**10, "m": 2**20, "g": 2**30}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+class DockerAPIError(OSError):
+    """An error response of the Engine API"""
+
+    def __init__(self, status, message):
+        super().__init__("Docker API error {}: {}".format(status, message))
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix socket"""
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def _error_message(payload):
+    try:
+        return json.loads(payload)["message"]
+    except (ValueError, KeyError, TypeError):
+        return payload.decode("utf-8", "replace").strip()
+
+
+class EngineAPIClient(object):
+    """
+    Sends requests to the Engine API. Connections are taken from a pool of
+    at most pool_size idle connections and given back after the response
+    was read, so requests from several threads don't wait for each other.
+    """
+
+    def __init__(self, socket_path=None, pool_size=4, timeout=60):
+        self.socket_path = socket_path or default_socket()
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _connection(self):
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return UnixHTTPConnection(self.socket_path, timeout=self.timeout), False
+
+    def _giveBack(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _url(self, path, params=None):
+        url = "/{}{}".format(API_VERSION, path)
+        if params:
+            url += "?" + urlencode(params)
+        return url
+
+    def request(self, method, path, params=None, body=None):
+        """
+        request sends one request and reads the whole response
+
+        Args:
+            method (str): the HTTP method
+            path (str): the endpoint, e.g. /containers/create
+            params (dict, optional): query parameters
+            body (dict, optional): sent as JSON
+
+        Returns:
+            the decoded JSON response, the raw bytes for other content or None
+
+        Raises:
+            DockerAPIError: for error responses
+            OSError: if the daemon can't be reached
+        """
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        headers = {"Content-Type": "application/json"} if data is not None else {}
+        url = self._url(path, params)
+        while True:
+            conn, reused = self._connection()
+            try:
+                conn.request(method, url, body=data, headers=headers)
+                resp = conn.getresponse()
+                payload = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused:
+                    # the daemon closed the idle connection, retry on a new one
+                    continue
+                raise
+            break
+        if resp.will_close:
+            conn.close()
+        else:
+            self._giveBack(conn)
+        if resp.status >= 400:
+            raise DockerAPIError(resp.status, _error_message(payload))
+        if not payload:
+            return None
+        if resp.getheader("Content-Type", "").startswith("application/json"):
+            return json.loads(payload)
+        return payload
+
+    def stream(self, method, path, params=None):
+        """
+        stream sends a request on a connection of its own and returns the
+        connection and the unread response. Close the connection when done.
+        """
+        # streams may be silent for a long time, don't time out
+        conn = UnixHTTPConnection(self.socket_path, timeout=None)
+        try:
+            conn.request(method, self._url(path, params))
+            resp = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            raise
+        if resp.status >= 400:
+            payload = resp.read()
+            conn.close()
+            raise DockerAPIError(resp.status, _error_message(payload))
+        return conn, resp
+
+    def ping(self):
+        """Returns True if the daemon answers"""
+        try:
+            return self.request("GET", "/_ping") == b"OK"
+        except OSError:
+            return False
+
+    def create_container(self, config, name=None):
+        """Creates a container from an API config, returns its id"""
+        params = {"name": name} if name else None
+        return self.request("POST", "/containers/create", params, config)["Id"]
+
+    def start(self, container):
+        self.request("POST", "/containers/{}/start".format(quote(container)))
+
+    def wait(self, container):
+        """Blocks until the container exits, returns its exit code"""
+        result = self.request("POST", "/containers/{}/wait".format(quote(container)))
+        return result["StatusCode"]
+
+    def kill(self, container):
+        self.request("POST", "/containers/{}/kill".format(quote(container)))
+
+    def stop(self, container):
+        self.request("POST", "/containers/{}/stop".format(quote(container)))
+
+    def remove(self, container, force=False):
+        self.request(
+            "DELETE",
+            "/containers/{}".format(quote(container)),
+            {"force": "true" if force else "false"},
+        )
+
+    def inspect_image(self, image):
+        return self.request("GET", "/images/{}/json".format(quote(image)))
+
+    def image_id(self, image):
+        return self.inspect_image(image)["Id"]
+
+    def pull(self, image):
+        """Pulls an image, yields the decoded progress messages"""
+        name, _, tag = image.rpartition(":")
+        if not name or "/" in tag:
+            # no tag, or the colon belonged to a registry port
+            name, tag = image, ""
+        conn, resp = self.stream(
+            "POST", "/images/create", {"fromImage": name, "tag": tag or "latest"}
+        )
+        try:
+            for line in resp:
+                if line.strip():
+                    message = json.loads(line)
+                    if "error" in message:
+                        raise DockerAPIError(500, message["error"])
+                    yield message
+        finally:
+            conn.close()
+
+    def logs(self, container):
+        """
+        Follows stdout and stderr of a container until it exits, yields the
+        output line by line as bytes
+        """
+        conn, resp = self.stream(
+            "GET",
+            "/containers/{}/logs".format(quote(container)),
+            {"follow": "true", "stdout": "true", "stderr": "true"},
+        )
+        try:
+            buffer = b""
+            # without a tty the streams are multiplexed in frames with an
+            # 8 byte header: stream type, 3 bytes padding, payload size
+            while True:
+                header = resp.read(8)
+                if len(header) < 8:
+                    break
+                size = struct.unpack(">xxxxL", header)[0]
+                buffer += resp.read(size)
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    yield line + b"\n"
+            if buffer:
+                yield buffer
+        finally:
+            conn.close()
@@ -1,9 +1,17 @@
 import os
 import pathlib
 import platform
-import shlex
 import subprocess
 
+from brats_toolkit.util.container_runtime import get_runtime
+from brats_toolkit.util.image_updates import ImageUpdater
+
+PREPROCESSING_IMAGE = "projectelephant/server"
+# name and ports of the backend container unless others are given
+BACKEND_NAME = "greedy_elephant"
+BACKEND_PORT = 5000
+DASHBOARD_PORT = 9181
+
 
 def start_docker(
     exam_import_folder=None,
@@ -12,6 +20,11 @@ def start_docker(
     nifti_export_folder=None,
     mode="cpu",
     gpuid="0",
+    mounts=None,
+    workers=3,
+    name=BACKEND_NAME,
+    port=BACKEND_PORT,
+    dashboard_port=DASHBOARD_PORT,
 ):
     # deal with missing arguments
     if dicom_import_folder is None:
@@ -60,44 +73,53 @@ def start_docker(
     # generate subprocess call
     command = [
         bashscript,
-        "3",
+        str(workers),
         dicom_import_folder,
         nifti_export_folder,
         exam_import_folder,
         exam_export_folder,
         gpuid,
     ]
+    # files bind mounted into the exam import folder, given as host file and
+    # its path in the exam import folder (unix scripts only)
+    for source, target in mounts or []:
+        relative = os.path.relpath(os.path.abspath(target), exam_import_folder)
+        command.append(
+            "{}:{}:ro".format(
+                os.path.abspath(source),
+                "/data/import/exam_import/" + pathlib.PurePath(relative).as_posix(),
+            )
+        )
     print(*command)
 
+    # the scripts read the container name and ports from the environment
+    env = dict(os.environ)
+    env["BRATS_BACKEND_NAME"] = name
+    env["BRATS_BACKEND_PORT"] = str(port)
+    env["BRATS_DASHBOARD_PORT"] = str(dashboard_port)
+
     print("starting docker!")
-    subprocess.run(command, cwd=cwd)
+    result = subprocess.run(command, cwd=cwd, env=env)
+    if result.returncode != 0:
+        # e.g. a port that is in use
+        raise RuntimeError(
+            "Starting the backend {} failed with exit code {}".format(
+                name, result.returncode
+            )
+        )
     print("docker started!")
 
 
-def stop_docker():
+def stop_docker(runtime=None, name=BACKEND_NAME):
     # stop it
-    readableCmd = "docker stop greedy_elephant"
-    command = shlex.split(readableCmd)
-
-    cwd = pathlib.Path(__file__).resolve().parent
-
-    print("stopping docker with command:", readableCmd)
-    subprocess.run(command, cwd=cwd)
+    runtime = get_runtime(runtime)
+    runtime.stop(name)
     # remove it
-    readableCmd = "docker rm greedy_elephant"
-    command = shlex.split(readableCmd)
-
-    cwd = pathlib.Path(__file__).resolve().parent
-
-    print("stopping docker with command:", readableCmd)
-    subprocess.run(command, cwd=cwd)
+    runtime.remove(name)
 
 
-def update_docker():
-    readableCmd = "docker pull projectelephant/server"
-    print(readableCmd)
-    command = shlex.split(readableCmd)
-
-    cwd = pathlib.Path(__file__).resolve().parent
-
-    subprocess.run(command, cwd=cwd)
+def update_docker(runtime=None, policy="ttl", ttl=None):
+    """Pulls the preprocessing image if the registry has a newer one, see ImageUpdater"""
+    result = ImageUpdater(runtime, policy=policy, ttl=ttl).update(PREPROCESSING_IMAGE)
+    print("preprocessing image {}: {}".format(PREPROCESSING_IMAGE, result))
+    return result
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Manifest of the exams preprocessed into an export folder
+
+The manifest records per exam a fingerprint of its input folder and
+whether it was submitted, is done or failed. Every batch run records its
+exams, a resumed rerun submits only the exams that are new, changed since
+or not done, so a batch that died mid-cohort picks up where it stopped. The manifest is a JSON file in
+the export folder and is saved after every change.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import threading
+import time
+import uuid
+
+from .prep_metrics import EXAM_DONE, EXAM_FAILED
+from .result_cache import file_digest
+
+MANIFEST_NAME = ".brats_manifest.json"
+
+
+def fingerprint(exam_folder, content=False):
+    """
+    Returns a fingerprint of the files in exam_folder: of their names,
+    sizes and modification times, or with content of the files themselves
+
+    Args:
+        exam_folder (str): the input folder of an exam
+        content (bool, optional): hash the file contents, slower but
+            independent of timestamps
+    """
+    sha = hashlib.sha256()
+    for root, dirs, files in os.walk(exam_folder):
+        dirs.sort()
+        for name in sorted(files):
+            path = op.join(root, name)
+            relative = op.relpath(path, exam_folder).replace(os.sep, "/")
+            if content:
+                token = file_digest(path)
+            else:
+                stat = os.stat(path)
+                token = "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+            sha.update("{}\0{}\n".format(relative, token).encode("utf-8"))
+    return sha.hexdigest()
+
+
+class ExamManifest(object):
+    """
+    The manifest of an export folder. Instances are listeners of a
+    Preprocessor, the ipstatus events mark exams done or failed.
+    """
+
+    def __init__(self, export_folder, content=False):
+        self.export_folder = op.abspath(export_folder)
+        self.path = op.join(self.export_folder, MANIFEST_NAME)
+        self.content = content
+        self._lock = threading.Lock()
+        self.exams = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)["exams"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def _save(self):
+        os.makedirs(self.export_folder, exist_ok=True)
+        # write next to the target and rename, a crash never leaves half a manifest
+        tmp = "{}.{}.tmp".format(self.path, uuid.uuid4().hex)
+        with open(tmp, "w") as f:
+            json.dump({"exams": self.exams}, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def _mark(self, exam, status):
+        with self._lock:
+            entry = self.exams.get(exam)
+            if entry is None or entry["status"] == status:
+                return
+            entry["status"] = status
+            entry["updated"] = time.time()
+            self._save()
+
+    def fingerprints(self, exam_folders):
+        """
+        Returns the fingerprints of the exam folders as dict exam folder ->
+        fingerprint
+        """
+        return {
+            folder: fingerprint(folder, content=self.content) for folder in exam_folders
+        }
+
+    def pending(self, exam_folders):
+        """
+        Returns the exam folders that are new, changed or not done, with
+        their fingerprints as dict exam folder -> fingerprint
+        """
+        result = {}
+        for folder, current in self.fingerprints(exam_folders).items():
+            exam = op.basename(op.normpath(folder))
+            entry = self.exams.get(exam)
+            if (
+                entry is None
+                or entry["fingerprint"] != current
+                or entry["status"] != "done"
+                or not op.isdir(op.join(self.export_folder, exam))
+            ):
+                result[folder] = current
+        return result
+
+    def submit(self, pending):
+        """
+        Marks the exams of pending() or fingerprints() as submitted.
+        Results of an earlier run of them are removed if it failed or their
+        inputs changed since, other results are left to be overwritten.
+        """
+        with self._lock:
+            for folder, current in pending.items():
+                exam = op.basename(op.normpath(folder))
+                exported = op.join(self.export_folder, exam)
+                entry = self.exams.get(exam)
+                outdated = entry is not None and (
+                    entry["fingerprint"] != current or entry["status"] == "failed"
+                )
+                if outdated and op.isdir(exported):
+                    shutil.rmtree(exported)
+                self.exams[exam] = {
+                    "fingerprint": current,
+                    "status": "submitted",
+                    "updated": time.time(),
+                }
+            self._save()
+
+    def complete(self, exams):
+        """
+        Marks the exams of a finished run that are neither done nor failed
+        by their results: done if the export folder has them
+        """
+        with self._lock:
+            for exam in exams:
+                entry = self.exams.get(exam)
+                if entry is None or entry["status"] != "submitted":
+                    continue
+                exported = op.join(self.export_folder, exam)
+                entry["status"] = "done" if op.isdir(exported) else "failed"
+                entry["updated"] = time.time()
+            self._save()
+
+    def __call__(self, event, data):
+        if event != "ipstatus":
+            return
+        message = str(data["ipstatus"])
+        if EXAM_FAILED.search(message):
+            self._mark(data["examid"], "failed")
+        elif EXAM_DONE.search(message):
+            self._mark(data["examid"], "done")
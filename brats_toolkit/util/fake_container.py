@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Stand-in for a segmentation container, used by the fake runtime
+
+Sleeps and burns cpu for the configured time, then writes a deterministic
+label map with the geometry of the first input image found in the mounted
+directory to results/tumor_<cid>_class.nii.gz. With --batch every sub
+folder of the mounted directory is a case and gets its own results.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import argparse
+import glob
+import hashlib
+import os
+import os.path as op
+import time
+
+import numpy as np
+
+from . import own_itk as oitk
+
+DEFAULT_SIZE = (240, 240, 155)
+
+
+def burn_cpu(seconds):
+    """Keeps one core busy for the given seconds"""
+    end = time.perf_counter() + seconds
+    x = 0
+    while time.perf_counter() < end:
+        x = (x * 31 + 7) % 1000003
+    return x
+
+
+def fake_segmentation(cid, proto=None):
+    """
+    Creates a label map with the labels 1, 2 and 4 as nested spheres,
+    slightly shifted depending on cid so ensembles don't agree perfectly
+
+    Args:
+        cid (str): the container id, seeds the shift
+        proto (itk reader or image, optional): provides size and geometry
+
+    Returns:
+        itk image: the label map
+    """
+    size = proto.GetSize() if proto is not None else DEFAULT_SIZE
+    # itk sizes are x, y, z while arrays are z, y, x
+    shape = tuple(reversed(size))
+    seed = int(hashlib.sha256(cid.encode("utf-8")).hexdigest(), 16)
+    shift = np.array([(seed >> (8 * i)) % 5 - 2 for i in range(3)])
+    center = np.array(shape) // 2 + shift
+    radius = max(2, min(shape) // 6)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    dist = np.sqrt(sum((g - c) ** 2 for g, c in zip(grid, center)))
+    arr = np.zeros(shape, dtype=np.uint8)
+    arr[dist <= radius] = 2
+    arr[dist <= radius * 0.6] = 1
+    arr[dist <= radius * 0.3] = 4
+    image = oitk.make_itk_image(arr, verbose=False)
+    if proto is not None:
+        image.SetOrigin(proto.GetOrigin())
+        image.SetSpacing(proto.GetSpacing())
+        image.SetDirection(proto.GetDirection())
+    return image
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake segmentation container.")
+    parser.add_argument("directory", help="The mounted case directory.")
+    parser.add_argument("--cid", default="fake", help="The container id.")
+    parser.add_argument("--sleep", type=float, default=0.0)
+    parser.add_argument("--burn", type=float, default=0.0)
+    parser.add_argument(
+        "--gpu", default=None, help="The device a real container would use."
+    )
+    parser.add_argument("--message", help="A line to print before working.")
+    parser.add_argument(
+        "--hang", action="store_true", help="Never finish, like a stuck container."
+    )
+    parser.add_argument(
+        "--batch", action="store_true", help="Segment every case folder."
+    )
+    args = parser.parse_args()
+
+    print(
+        "fake container {} started on {} (gpu {})".format(
+            args.cid, args.directory, args.gpu
+        )
+    )
+    if args.message:
+        print(args.message, flush=True)
+    if args.hang:
+        while True:
+            time.sleep(60)
+    time.sleep(args.sleep)
+    burn_cpu(args.burn)
+    if args.batch:
+        cases = sorted(
+            op.join(args.directory, d)
+            for d in os.listdir(args.directory)
+            if op.isdir(op.join(args.directory, d))
+        )
+    else:
+        cases = [args.directory]
+    for case in cases:
+        inputs = sorted(glob.glob(op.join(case, "*.nii*")))
+        proto = oitk.get_itk_information(inputs[0]) if inputs else None
+        resultsDir = op.join(case, "results")
+        os.makedirs(resultsDir, exist_ok=True)
+        outputPath = op.join(resultsDir, "tumor_{}_class.nii.gz".format(args.cid))
+        oitk.write_itk_image(fake_segmentation(args.cid, proto), outputPath)
+        print("fake container {} wrote {}".format(args.cid, outputPath))
+
+
+if __name__ == "__main__":
+    main()
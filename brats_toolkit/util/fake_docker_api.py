@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""Stand-in for the Docker Engine API on a unix socket
+
+Serves the few endpoints the docker-api runtime uses and runs the fake
+container (see fake_container.py) for every started container, so the
+backend can be tried and tested on machines without Docker:
+
+    python -m brats_toolkit.util.fake_docker_api /tmp/fake_docker.sock
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import argparse
+import json
+import os
+import re
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+
+from .container_runtime import CID_LABEL
+
+
+class FakeContainer(object):
+    def __init__(self, name, config):
+        self.id = uuid.uuid4().hex
+        self.name = name or self.id[:12]
+        self.config = config
+        self.process = None
+        self.output = []
+        self.changed = threading.Condition()
+        self.exit_code = None
+
+    def command(self):
+        # the host directory of the first bind is the container's input
+        directory = self.config["HostConfig"]["Binds"][0].rsplit(":", 1)[0]
+        command = [sys.executable, "-m", "brats_toolkit.util.fake_container"]
+        cid = self.config.get("Labels", {}).get(CID_LABEL, self.name)
+        command += [directory, "--cid", cid]
+        command += self.config.get("Cmd") or []
+        return command
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.command(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def _collect(self):
+        for line in iter(self.process.stdout.readline, b""):
+            with self.changed:
+                self.output.append(line)
+                self.changed.notify_all()
+        code = self.process.wait()
+        with self.changed:
+            self.exit_code = code
+            self.changed.notify_all()
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+
+
+class EngineAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+    # responses
+
+    def _send(self, status, body=b"", content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send(status, {"message": message})
+
+    def _startChunked(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _endChunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    # routing
+
+    def _route(self, method):
+        url = urlparse(self.path)
+        path = re.sub(r"^/v[0-9.]+", "", url.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        server = self.server
+        if path == "/_ping":
+            return self._send(200, b"OK", "text/plain")
+        if method == "POST" and path == "/images/create":
+            return self._pull(query)
+        match = re.match(r"^/images/(.+)/json$", path)
+        if match:
+            image = unquote(match.group(1))
+            if image in server.missing_images:
+                return self._error(404, "No such image: " + image)
+            return self._send(200, {"Id": "sha256:" + image, "RepoDigests": []})
+        if method == "POST" and path == "/containers/create":
+            if body["Image"] in server.missing_images:
+                return self._error(404, "No such image: " + body["Image"])
+            container = FakeContainer(query.get("name"), body)
+            with server.lock:
+                server.containers[container.id] = container
+            return self._send(201, {"Id": container.id, "Warnings": []})
+        match = re.match(r"^/containers/([^/]+)(/[a-z]+)?$", path)
+        if not match:
+            return self._error(404, "page not found")
+        container = server.find(unquote(match.group(1)))
+        if container is None:
+            return self._error(404, "No such container: " + match.group(1))
+        action = match.group(2)
+        if method == "POST" and action == "/start":
+            container.start()
+            return self._send(204)
+        if method == "POST" and action in ["/kill", "/stop"]:
+            container.kill()
+            return self._send(204)
+        if method == "POST" and action == "/wait":
+            with container.changed:
+                container.changed.wait_for(lambda: container.exit_code is not None)
+            return self._send(200, {"StatusCode": container.exit_code})
+        if method == "GET" and action == "/logs":
+            return self._logs(container)
+        if method == "DELETE" and action is None:
+            if container.exit_code is None and query.get("force") != "true":
+                return self._error(409, "container is running")
+            container.kill()
+            with server.lock:
+                server.containers.pop(container.id, None)
+            return self._send(204)
+        return self._error(404, "page not found")
+
+    def _pull(self, query):
+        image = query.get("fromImage", "")
+        tag = query.get("tag", "latest")
+        self._startChunked("application/json")
+        if {image, "{}:{}".format(image, tag)} & self.server.broken_images:
+            # the daemon reports failed pulls inside the progress stream
+            message = {"error": "manifest for {}:{} not found".format(image, tag)}
+            self._chunk(json.dumps(message).encode("utf-8") + b"\n")
+            return self._endChunked()
+        self.server.missing_images.discard(image)
+        self.server.missing_images.discard("{}:{}".format(image, tag))
+        for status in ["Pulling from " + image, "Status: Downloaded " + image]:
+            self._chunk(json.dumps({"status": status}).encode("utf-8") + b"\n")
+        self._endChunked()
+
+    def _logs(self, container):
+        # multiplexed stream: stdout frames with an 8 byte header
+        self._startChunked("application/vnd.docker.raw-stream")
+        sent = 0
+        while True:
+            with container.changed:
+                container.changed.wait_for(
+                    lambda: len(container.output) > sent
+                    or container.exit_code is not None
+                )
+                lines = container.output[sent:]
+                finished = container.exit_code is not None
+            for line in lines:
+                self._chunk(struct.pack(">BxxxL", 1, len(line)) + line)
+            sent += len(lines)
+            if finished and sent == len(container.output):
+                break
+        self._endChunked()
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+
+class FakeEngineAPIServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves the stand-in Engine API on socket_path. Images listed in
+    missing_images answer 404 on create until they are pulled, pulls of
+    images listed in broken_images fail.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, missing_images=None, broken_images=None):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, EngineAPIHandler)
+        self.socket_path = socket_path
+        self.containers = {}
+        self.missing_images = set(missing_images or [])
+        self.broken_images = set(broken_images or [])
+        self.lock = threading.Lock()
+
+    def find(self, ref):
+        with self.lock:
+            for container in self.containers.values():
+                if ref in [container.id, container.name] or container.id.startswith(
+                    ref
+                ):
+                    return container
+        return None
+
+    def start(self):
+        """Serves in a daemon thread, returns the thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("socket", help="path of the unix socket to serve on")
+    args = parser.parse_args()
+    server = FakeEngineAPIServer(args.socket)
+    print("serving a stand-in Docker Engine API on", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -246,6 +246,37 @@ def completeclean(root):
     clean(root, False, True)
 
 
+def find_cases(root, pattern="*{}.nii.gz", outputRoot=None, outputName=None):
+    """Finds the cases of a cohort, one per subfolder of root
+    pattern: glob relative to the case folder, {} is replaced by the modality
+             (t1, t1c, t2, fla), e.g. "hdbet_brats-space/*_{}.nii.gz"
+    outputRoot, outputName: if both are passed every case gets the
+             outputPath outputRoot/<case>/outputName
+    returns: list of dicts with the keys t1, t1c, t2, fla (and outputPath)
+    """
+    cases = []
+    for case in sorted(os.listdir(root)):
+        casepath = os.path.join(root, case)
+        if not os.path.isdir(casepath):
+            continue  # Not a directory
+        found = {}
+        for modality in ["t1", "t1c", "t2", "fla"]:
+            matches = glob.glob(os.path.join(casepath, pattern.format(modality)))
+            if len(matches) != 1:
+                print(
+                    "Skipping case {}: found {} files for {}".format(
+                        case, len(matches), modality
+                    )
+                )
+                break
+            found[modality] = matches[0]
+        else:
+            if outputRoot is not None and outputName is not None:
+                found["outputPath"] = os.path.join(outputRoot, case, outputName)
+            cases.append(found)
+    return cases
+
+
 def conversion(segmentations, verbose=True):
     gt_root = (
         "/Users/christoph/Documents/Uni/Bachelorarbeit/Testdaten/testing_nii_LABELS"
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Digest-checked updates of container images
+
+Instead of pulling an image on every run, the digest of its tag in the
+registry is compared with the digests of the local image, and the image is
+only pulled if they differ. The policies:
+
+    never   don't touch the registry, docker run pulls missing images
+    ttl     check the registry at most once per ttl seconds per image
+    always  check the registry every time
+
+Registry checks are cached in a small JSON file. If the registry can't be
+reached the local image is used, so air-gapped nodes keep working.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import json
+import os
+import os.path as op
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .container_runtime import get_runtime
+
+POLICIES = ["never", "ttl", "always"]
+DEFAULT_TTL = 24 * 3600
+ENV_VAR = "BRATS_IMAGE_CACHE"
+DEFAULT_PATH = op.join("~", ".cache", "brats_toolkit", "image_digests.json")
+
+DOCKER_HUB = "registry-1.docker.io"
+MANIFEST_TYPES = [
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+]
+
+
+def parse_reference(image):
+    """
+    Splits an image reference into registry, repository and tag, e.g.
+    projectelephant/server -> (registry-1.docker.io, projectelephant/server, latest)
+    """
+    name, _, tag = image.rpartition(":")
+    if not name or "/" in tag:
+        # no tag, or the colon belonged to a registry port
+        name, tag = image, "latest"
+    first, _, rest = name.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        return first, rest, tag
+    if not rest:
+        # official images live in library/
+        return DOCKER_HUB, "library/" + name, tag
+    return DOCKER_HUB, name, tag
+
+
+def _bearer_token(challenge, timeout):
+    """Fetches an anonymous token for a WWW-Authenticate Bearer challenge"""
+    params = {}
+    for part in challenge[len("Bearer ") :].split(","):
+        key, _, value = part.strip().partition("=")
+        params[key] = value.strip('"')
+    realm = params.pop("realm")
+    response = requests.get(realm, params=params, timeout=timeout)
+    response.raise_for_status()
+    body = response.json()
+    return body.get("token") or body.get("access_token")
+
+
+def remote_digest(image, timeout=10):
+    """
+    Returns the digest of the image's tag in its registry
+
+    Raises:
+        OSError: if the registry can't be reached or doesn't know the image
+    """
+    registry, repository, tag = parse_reference(image)
+    url = "https://{}/v2/{}/manifests/{}".format(registry, repository, tag)
+    headers = {"Accept": ", ".join(MANIFEST_TYPES)}
+    try:
+        response = requests.head(url, headers=headers, timeout=timeout)
+        challenge = response.headers.get("WWW-Authenticate", "")
+        if response.status_code == 401 and challenge.startswith("Bearer "):
+            token = _bearer_token(challenge, timeout)
+            headers["Authorization"] = "Bearer " + token
+            response = requests.head(url, headers=headers, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        raise OSError("Registry check of {} failed: {}".format(image, e))
+    digest = response.headers.get("Docker-Content-Digest")
+    if not digest:
+        raise OSError("Registry sent no digest for {}".format(image))
+    return digest
+
+
+class ImageUpdater(object):
+    """
+    Pulls images only if their registry digest changed, according to the
+    policy. Checks and pulls of several images run in parallel.
+    """
+
+    def __init__(
+        self,
+        runtime=None,
+        policy="ttl",
+        ttl=DEFAULT_TTL,
+        cache_path=None,
+        max_parallel=4,
+        digest=remote_digest,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(
+                "Unknown update policy {}, choose one of {}".format(policy, POLICIES)
+            )
+        self.runtime = get_runtime(runtime)
+        self.policy = policy
+        self.ttl = DEFAULT_TTL if ttl is None else ttl
+        if cache_path is None:
+            cache_path = os.environ.get(ENV_VAR) or DEFAULT_PATH
+        self.cache_path = op.abspath(op.expanduser(cache_path))
+        self.max_parallel = max_parallel
+        self.digest = digest
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _remember(self, image, digest):
+        with self._lock:
+            cache = self._load()
+            cache[image] = {"digest": digest, "checked": time.time()}
+            try:
+                os.makedirs(op.dirname(self.cache_path), exist_ok=True)
+                # write next to the target and rename, readers never see partial files
+                tmp = "{}.{}.tmp".format(self.cache_path, uuid.uuid4().hex)
+                with open(tmp, "w") as f:
+                    json.dump(cache, f, indent=1)
+                os.replace(tmp, self.cache_path)
+            except OSError as e:
+                print("Could not cache the image digests: {}".format(e))
+
+    def update(self, image):
+        """
+        update pulls image if the policy asks for a check and the registry
+        has a different digest than the local image
+
+        Returns:
+            str: "pulled", "current", "cached" (checked within the ttl),
+            "skipped" (policy never), "offline" (registry not reachable) or
+            "failed" (the pull failed, the local image is used)
+        """
+        if self.policy == "never":
+            return "skipped"
+        local = self.runtime.repo_digests(image)
+        entry = self._load().get(image)
+        if (
+            self.policy == "ttl"
+            and local is not None
+            and entry is not None
+            and time.time() - entry["checked"] < self.ttl
+            and any(d.endswith("@" + entry["digest"]) for d in local)
+        ):
+            return "cached"
+        try:
+            remote = self.digest(image)
+        except OSError as e:
+            print("{}, using the local image".format(e))
+            return "offline"
+        if local is not None and any(d.endswith("@" + remote) for d in local):
+            self._remember(image, remote)
+            return "current"
+        if not self._pull(image):
+            # don't remember the digest, the next run tries again
+            return "failed"
+        self._remember(image, remote)
+        return "pulled"
+
+    def _pull(self, image):
+        """Pulls image, returns False if the pull failed"""
+        try:
+            result = self.runtime.pull(image)
+        except OSError as e:
+            print("Pulling {} failed: {}, using the local image".format(image, e))
+            return False
+        # the docker CLI runtime returns the completed process
+        returncode = getattr(result, "returncode", 0)
+        if returncode != 0:
+            print(
+                "Pulling {} failed with exit status {}, using the local image".format(
+                    image, returncode
+                )
+            )
+            return False
+        return True
+
+    def update_all(self, images):
+        """Updates several images in parallel, returns their update() results"""
+        images = list(dict.fromkeys(images))
+        if not images:
+            return {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_parallel)) as pool:
+            results = dict(zip(images, pool.map(self.update, images)))
+        # printed, this runs before the segmentor sets up its log file
+        for image, result in results.items():
+            print("image {}: {}".format(image, result))
+        return results
@@ -121,6 +121,33 @@ def get_itk_image(path_or_image):
     return image
 
 
+def get_itk_information(path):
+    """Read only the header of an image file, the voxels are not decoded.
+
+    Parameters
+    ----------
+    path : str
+        Path pointing to an image file.
+
+    Returns
+    -------
+    reader : itk.ImageFileReader
+        Reader exposing the header information, e.g. GetSize(),
+        GetDimension() or GetSpacing().
+
+    """
+
+    if not os.path.exists(path):
+        err = path + " doesnt exist"
+        raise AttributeError(err)
+
+    reader = itk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+
+    return reader
+
+
 def get_itk_array(path_or_image):
     """Get an image array given a path or itk image.
 
@@ -252,8 +279,9 @@ def read_dicom(source_path, verbose=True):
 
     Parameters
     ----------
-    source_path : string
-        path to directory containing dicom series.
+    source_path : string or list of strings
+        path to directory containing dicom series, or the sorted
+        files of one series.
     verbose : boolean
         print out all series file names.
 
@@ -264,7 +292,11 @@ def read_dicom(source_path, verbose=True):
     """
 
     reader = itk.ImageSeriesReader()
-    names = reader.GetGDCMSeriesFileNames(source_path)
+    if isinstance(source_path, (list, tuple)):
+        names = list(source_path)
+        source_path = os.path.dirname(names[0]) if names else ""
+    else:
+        names = reader.GetGDCMSeriesFileNames(source_path)
     if len(names) < 1:
         raise IOError("No Series can be found at the specified path!")
     elif verbose:
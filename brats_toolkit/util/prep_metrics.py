@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""Progress metrics of preprocessing runs
+
+The backend reports its progress as status and ipstatus events. A
+PreprocessingMetrics listens to them and turns them into per-exam start and
+end times, the time spent per reported stage, the throughput and an ETA.
+Callbacks get every update, the metrics are written as a JSON run report
+and optionally as an OpenMetrics textfile, e.g. for the textfile collector
+of the Prometheus node exporter.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import json
+import os
+import os.path as op
+import re
+import threading
+import time
+import uuid
+
+# ipstatus messages ending an exam, other messages are stages. Failures
+# are the end of the processing or a message starting with an error, a
+# stage merely mentioning one (e.g. a failed fallback) keeps running
+EXAM_DONE = re.compile(
+    r"processing (successfully )?(completed|finished)", re.IGNORECASE
+)
+EXAM_FAILED = re.compile(
+    r"processing (has )?(failed|aborted)|^\s*((error|exception)\s*(:|$)|failed\b)",
+    re.IGNORECASE,
+)
+
+PREFIX = "brats_preprocessing"
+STATES = ["queued", "running", "done", "failed"]
+
+# stage labels of the OpenMetrics textfile, the free text of the stages
+# would give every message a time series of its own
+STAGE_LABELS = [
+    ("conversion", re.compile(r"dicom|conver|nifti", re.IGNORECASE)),
+    ("registration", re.compile(r"regist|align|atlas|sri", re.IGNORECASE)),
+    (
+        "skullstripping",
+        re.compile(r"skull|brain ?extract|robex|hd-?bet|mask", re.IGNORECASE),
+    ),
+    ("export", re.compile(r"export|sav|writ|copy", re.IGNORECASE)),
+]
+OTHER_STAGE = "other"
+
+
+def stage_label(stage):
+    """Returns the fixed label of a stage message, see STAGE_LABELS"""
+    for label, pattern in STAGE_LABELS:
+        if pattern.search(stage):
+            return label
+    return OTHER_STAGE
+
+
+def _escape(value):
+    """Escapes a label value for the OpenMetrics text format"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomic(path, text):
+    # write next to the target and rename, collectors never see partial files
+    path = op.abspath(path)
+    os.makedirs(op.dirname(path), exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class PreprocessingMetrics(object):
+    """
+    Collects the progress of the exams of a preprocessing run from the
+    backend's events. Instances are listeners of a Preprocessor, i.e. they
+    are called with the event name and its data, and are thread safe.
+    """
+
+    def __init__(self, name="preprocessing", textfile=None, clock=time.time):
+        self.name = name
+        self.textfile = textfile
+        self.clock = clock
+        # called with a dict of exam, message and summary() on every update
+        self.callbacks = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets all exams, the callbacks are kept"""
+        with self._lock:
+            self.created = self.clock()
+            self.exams = {}
+
+    def __call__(self, event, data):
+        if event == "status" and data.get("message") == "input inspection finished!":
+            with self._lock:
+                for exam in data.get("data") or []:
+                    self._queue(exam)
+            self._updated(None, data["message"])
+        elif event == "ipstatus":
+            self.exam_status(data["examid"], str(data["ipstatus"]))
+
+    def _queue(self, exam):
+        entry = self.exams.get(exam)
+        if entry is None or entry["state"] in ["done", "failed"]:
+            # new, or submitted again
+            entry = {
+                "state": "queued",
+                "queued": self.clock(),
+                "started": None,
+                "finished": None,
+                "stages": [],
+            }
+            self.exams[exam] = entry
+        return entry
+
+    def exam_status(self, exam, message):
+        """Records an ipstatus message of exam"""
+        now = self.clock()
+        terminal = EXAM_FAILED.search(message) or EXAM_DONE.search(message)
+        with self._lock:
+            entry = self.exams.get(exam)
+            if entry is not None and entry["state"] in ["done", "failed"]:
+                if terminal:
+                    # repeated end of an exam
+                    return
+            entry = self._queue(exam)
+            if entry["started"] is None:
+                entry["started"] = now
+                entry["state"] = "running"
+            # the previous stage lasted until this message
+            if entry["stages"] and entry["stages"][-1]["duration"] is None:
+                last = entry["stages"][-1]
+                last["duration"] = now - last["start"]
+            if EXAM_FAILED.search(message):
+                entry["state"] = "failed"
+                entry["finished"] = now
+                entry["error"] = message
+            elif EXAM_DONE.search(message):
+                entry["state"] = "done"
+                entry["finished"] = now
+            else:
+                entry["stages"].append(
+                    {"name": message, "start": now, "duration": None}
+                )
+        self._updated(exam, message)
+
+    def _updated(self, exam, message):
+        if self.textfile is not None:
+            try:
+                self.write_openmetrics(self.textfile)
+            except OSError as e:
+                print("Could not write the metrics textfile: {}".format(e))
+        if self.callbacks:
+            update = {"exam": exam, "message": message, "summary": self.summary()}
+            for callback in list(self.callbacks):
+                callback(update)
+
+    def summary(self):
+        """
+        Returns:
+            dict: exams per state, the finished exams per hour, the seconds
+            until all known exams are finished (None before the first one
+            finished), the mean latency from start to end of the exams and
+            the seconds per stage
+        """
+        with self._lock:
+            now = self.clock()
+            exams = [dict(e) for e in self.exams.values()]
+            stages = {}
+            for entry in self.exams.values():
+                for stage in entry["stages"]:
+                    duration = stage["duration"]
+                    if duration is None:
+                        continue
+                    totals = stages.setdefault(
+                        stage["name"], {"count": 0, "seconds": 0.0}
+                    )
+                    totals["count"] += 1
+                    totals["seconds"] += duration
+        counts = {state: 0 for state in STATES}
+        for entry in exams:
+            counts[entry["state"]] += 1
+        finished = [e for e in exams if e["finished"] is not None]
+        started = [e["started"] for e in exams if e["started"] is not None]
+        throughput = None
+        eta = None
+        if finished and started:
+            remaining = counts["queued"] + counts["running"]
+            # a finished run doesn't get slower while nobody looks
+            end = now if remaining else max(e["finished"] for e in finished)
+            elapsed = max(end - min(started), 1e-9)
+            throughput = len(finished) / elapsed * 3600
+            eta = remaining / throughput * 3600
+        latencies = [e["finished"] - e["started"] for e in finished]
+        for totals in stages.values():
+            totals["mean"] = totals["seconds"] / totals["count"]
+        return {
+            "exams": counts,
+            "throughput_per_hour": throughput,
+            "eta_seconds": eta,
+            "latency_seconds": {
+                "count": len(latencies),
+                "sum": sum(latencies),
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+            },
+            "stages": stages,
+        }
+
+    def write_json(self, path):
+        """Writes the run report: the summary and the timeline of every exam"""
+        summary = self.summary()
+        with self._lock:
+            exams = json.loads(json.dumps(self.exams))
+        for entry in exams.values():
+            if entry["started"] is not None and entry["finished"] is not None:
+                entry["latency"] = entry["finished"] - entry["started"]
+        report = {
+            "name": self.name,
+            "created": self.created,
+            "written": self.clock(),
+            "summary": summary,
+            "exams": exams,
+        }
+        _write_atomic(path, json.dumps(report, indent=2))
+
+    def openmetrics(self):
+        """Returns the metrics in the OpenMetrics text format"""
+        summary = self.summary()
+        lines = [
+            "# HELP {}_exams Exams of the run per state.".format(PREFIX),
+            "# TYPE {}_exams gauge".format(PREFIX),
+        ]
+        for state, count in summary["exams"].items():
+            lines.append('{}_exams{{state="{}"}} {}'.format(PREFIX, state, count))
+        for metric, key, help in [
+            (
+                "throughput_exams_per_hour",
+                "throughput_per_hour",
+                "Finished exams per hour.",
+            ),
+            (
+                "eta_seconds",
+                "eta_seconds",
+                "Seconds until the known exams are finished.",
+            ),
+        ]:
+            lines.append("# HELP {}_{} {}".format(PREFIX, metric, help))
+            lines.append("# TYPE {}_{} gauge".format(PREFIX, metric))
+            if summary[key] is not None:
+                lines.append("{}_{} {}".format(PREFIX, metric, summary[key]))
+        latency = summary["latency_seconds"]
+        lines += [
+            "# HELP {}_exam_latency_seconds Seconds from start to end of the exams.".format(
+                PREFIX
+            ),
+            "# TYPE {}_exam_latency_seconds summary".format(PREFIX),
+            "{}_exam_latency_seconds_count {}".format(PREFIX, latency["count"]),
+            "{}_exam_latency_seconds_sum {}".format(PREFIX, latency["sum"]),
+            "# HELP {}_stage_seconds Seconds spent per kind of reported stage.".format(
+                PREFIX
+            ),
+            "# TYPE {}_stage_seconds summary".format(PREFIX),
+        ]
+        labels = {label: {"count": 0, "seconds": 0.0} for label, _ in STAGE_LABELS}
+        labels[OTHER_STAGE] = {"count": 0, "seconds": 0.0}
+        for stage, totals in summary["stages"].items():
+            kind = labels[stage_label(stage)]
+            kind["count"] += totals["count"]
+            kind["seconds"] += totals["seconds"]
+        for stage, totals in labels.items():
+            label = '{{stage="{}"}}'.format(_escape(stage))
+            lines.append(
+                "{}_stage_seconds_count{} {}".format(PREFIX, label, totals["count"])
+            )
+            lines.append(
+                "{}_stage_seconds_sum{} {}".format(PREFIX, label, totals["seconds"])
+            )
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_openmetrics(self, path):
+        """Writes the metrics as textfile, the node exporter wants a .prom suffix"""
+        _write_atomic(path, self.openmetrics())
@@ -1,14 +1,85 @@
+import errno
 import os
 import shutil
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
 
-def tempFiler(orgFilePath, modality, tempFolder):
+# ioctl cloning a file on copy-on-write filesystems (btrfs, xfs), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def tempFileName(orgFilePath, modality):
     stemName = Path(orgFilePath).stem
     stemName = stemName.rsplit(".", 2)[0]
-    stemName = stemName + "_" + modality + ".nii.gz"
+    return stemName + "_" + modality + ".nii.gz"
+
+
+def reflink(orgFilePath, targetPath):
+    """Clones a file sharing its blocks, returns False if the filesystem can't"""
+    if fcntl is None:
+        return False
+    try:
+        with open(orgFilePath, "rb") as src, open(targetPath, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError as e:
+        if os.path.exists(targetPath):
+            os.remove(targetPath)
+        if e.errno in [
+            errno.EXDEV,
+            errno.EOPNOTSUPP,
+            errno.EINVAL,
+            errno.ENOTTY,
+            errno.EPERM,
+            errno.EBADF,
+        ]:
+            return False
+        raise
+
+
+def linkFile(orgFilePath, targetPath, hardlink=False):
+    """
+    Stages a file without copying its data: as reflink, which keeps the
+    original safe from writes to the staged file, or as hardlink if allowed.
+    A hardlink shares the original's data, only allow it for staging that
+    is mounted read-only.
+
+    Returns:
+        str: "reflink" or "hardlink", None if the file could not be linked
+    """
+    if reflink(orgFilePath, targetPath):
+        return "reflink"
+    if not hardlink:
+        return None
+    try:
+        os.link(orgFilePath, targetPath)
+        return "hardlink"
+    except OSError:
+        # other filesystem, or protected_hardlinks for files of other users
+        return None
+
+
+def tempFiler(orgFilePath, modality, tempFolder, copy=True, hardlink=False):
+    """
+    Stages a modality in tempFolder with the suffix the backend expects,
+    linked if possible and copied otherwise.
+
+    Args:
+        copy (bool, optional): if False files that can't be linked are not staged
+        hardlink (bool, optional): whether hardlinks may be used, see linkFile
 
-    tempFile = os.path.join(tempFolder, stemName)
+    Returns:
+        str: the staged file, None if it was not staged
+    """
+    tempFile = os.path.join(tempFolder, tempFileName(orgFilePath, modality))
     # print("tempFile:", tempFile)
+    if linkFile(orgFilePath, tempFile, hardlink=hardlink) is not None:
+        return tempFile
+    if not copy:
+        return None
     shutil.copyfile(orgFilePath, tempFile)
     return tempFile
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Readiness probes for the preprocessing backend
+
+Instead of sleeping a fixed time after starting the backend container, the
+Preprocessor polls the backend until it accepts TCP connections and answers
+the socket.IO handshake, with exponentially growing pauses and a timeout.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import socket
+import time
+from urllib.parse import urlparse
+
+import requests
+
+# engine.io protocol 3, spoken by python-socketio 4 and the backend
+HANDSHAKE_PATH = "/socket.io/?EIO=3&transport=polling"
+
+
+def port_open(host, port, timeout=1.0):
+    """True if host accepts TCP connections on port"""
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def free_ports(count, host="localhost"):
+    """
+    Returns count distinct TCP ports nobody listens on at the moment, for
+    backends started next to others
+    """
+    sockets = []
+    try:
+        # keep all bound until the end, so the ports differ
+        for _ in range(count):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(s)
+            s.bind((host, 0))
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+
+def socketio_ready(url, timeout=2.0):
+    """True if the socket.IO server at url answers the handshake with a session"""
+    try:
+        response = requests.get(url.rstrip("/") + HANDSHAKE_PATH, timeout=timeout)
+    except requests.RequestException:
+        return False
+    return response.status_code == 200 and b'"sid"' in response.content
+
+
+def wait_for_backend(url, timeout=120.0, initial_delay=0.05, max_delay=2.0):
+    """
+    wait_for_backend polls the backend at url until its port is open and
+    the socket.IO handshake succeeds
+
+    Args:
+        url (str): the backend, e.g. http://localhost:5000
+        timeout (float, optional): seconds to wait at most
+        initial_delay (float, optional): first pause between probes
+        max_delay (float, optional): the pauses double up to this
+
+    Returns:
+        float: the seconds the backend needed to get ready
+
+    Raises:
+        TimeoutError: if the backend isn't ready within timeout
+    """
+    parsed = urlparse(url)
+    host = parsed.hostname or "localhost"
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    started = time.monotonic()
+    delay = initial_delay
+    while True:
+        if port_open(host, port) and socketio_ready(url):
+            return time.monotonic() - started
+        remaining = timeout - (time.monotonic() - started)
+        if remaining <= 0:
+            raise TimeoutError(
+                "Backend at {} not ready after {:.0f}s".format(url, timeout)
+            )
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
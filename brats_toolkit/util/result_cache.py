@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Content addressed cache for segmentation results
+
+Results are keyed by the hashes of the input files, the id of the
+container image and the container settings from the docker config, so a
+rerun with unchanged inputs and images can reuse the stored segmentation.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import shutil
+import tempfile
+
+from .container_runtime import DockerCLIRuntime
+
+RESULT_NAME = "result.nii.gz"
+META_NAME = "meta.json"
+
+# config entries that influence the produced segmentation
+KEY_FIELDS = ["id", "command", "fileformat", "mountpoint", "flags", "user_mode"]
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Returns the sha256 hex digest of a file, read in chunks"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Stores segmentation results under a cache root directory. Every entry
+    lives in its own folder named after the cache key.
+    """
+
+    def __init__(self, root, imageId=None):
+        self.root = op.abspath(op.expanduser(root))
+        # resolves image names to content ids, see ContainerRuntime.image_id
+        self.imageId = imageId if imageId is not None else DockerCLIRuntime().image_id
+        os.makedirs(self.root, exist_ok=True)
+        self._imageIds = {}
+        self._digests = {}
+
+    def _digest(self, path):
+        # memoize by path, size and mtime so batch runs hash every input once
+        stat = os.stat(path)
+        token = (op.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if token not in self._digests:
+            self._digests[token] = file_digest(path)
+        return self._digests[token]
+
+    def _imageId(self, image):
+        # unknown ids are asked again, the image may be pulled in the meantime
+        if self._imageIds.get(image) is None:
+            self._imageIds[image] = self.imageId(image)
+        return self._imageIds[image]
+
+    def key(self, inputs, params):
+        """
+        key computes the cache key for one (case, container) pair
+
+        Args:
+            inputs (dict): modality -> path of the input files
+            params (dict): the container entry from the docker config
+
+        Returns:
+            str: the hex key, None if the inputs are not files on disk or
+            the image id is unknown
+        """
+        if not all(isinstance(p, str) and op.isfile(p) for p in inputs.values()):
+            return None
+        imageId = self._imageId(params["id"])
+        if imageId is None:
+            # the tag alone may point to another image than the cached results
+            logging.warning(
+                "[Cache] Unknown image id of {}, not using the cache".format(
+                    params["id"]
+                )
+            )
+            return None
+        payload = {
+            "inputs": {m: self._digest(p) for m, p in sorted(inputs.items())},
+            "image": imageId,
+            "params": {f: params.get(f) for f in KEY_FIELDS},
+        }
+        blob = json.dumps(payload, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(blob).hexdigest()
+
+    def _entry(self, key):
+        return op.join(self.root, key[:2], key)
+
+    def lookup(self, key):
+        """Returns the path of the cached result or None"""
+        if key is None:
+            return None
+        path = op.join(self._entry(key), RESULT_NAME)
+        return path if op.isfile(path) else None
+
+    def fetch(self, key, outputPath):
+        """Copies a cached result to outputPath, returns True on a hit"""
+        cached = self.lookup(key)
+        if cached is None:
+            return False
+        os.makedirs(op.dirname(op.abspath(outputPath)), exist_ok=True)
+        shutil.copyfile(cached, outputPath)
+        logging.info("[Cache] Hit for key {}, saved to {}".format(key, outputPath))
+        return True
+
+    def store(self, key, resultPath, meta=None):
+        """Adds a finished segmentation to the cache"""
+        if key is None or not op.isfile(resultPath):
+            return
+        entry = self._entry(key)
+        os.makedirs(entry, exist_ok=True)
+        # write to a temporary name first so readers never see partial files
+        fd, tmp = tempfile.mkstemp(dir=entry, suffix=".part")
+        os.close(fd)
+        try:
+            shutil.copyfile(resultPath, tmp)
+            with open(op.join(entry, META_NAME), "w") as f:
+                json.dump(meta or {}, f, indent=2)
+            os.replace(tmp, op.join(entry, RESULT_NAME))
+        finally:
+            if op.exists(tmp):
+                os.remove(tmp)
+        logging.info("[Cache] Stored result for key {}".format(key))
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Local history of container runtimes
+
+Every successful container run is recorded with the size of its input in a
+small SQLite database, if the Segmentor is given one. The history predicts how long a container will take
+on a new case, which the Segmentor uses to start the longest jobs first,
+to report ETAs and to plan cohorts. It also keeps how well the members of
+fused ensembles agreed with the fusion, to pick ensembles within a budget.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import os
+import os.path as op
+import sqlite3
+import statistics
+import time
+from contextlib import closing
+
+from . import own_itk as oitk
+
+ENV_VAR = "BRATS_RUNTIME_HISTORY"
+DEFAULT_PATH = op.join("~", ".cache", "brats_toolkit", "runtime_history.sqlite")
+
+# only the most recent runs of a container are used for predictions
+RECENT_RUNS = 50
+# runs on inputs within this relative size count as the same input size
+SIZE_TOLERANCE = 0.25
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    runtime TEXT NOT NULL,
+    cid TEXT NOT NULL,
+    voxels INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_cid ON runs (runtime, cid, created);
+CREATE TABLE IF NOT EXISTS agreement (
+    runtime TEXT NOT NULL,
+    cid TEXT NOT NULL,
+    dice REAL NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS agreement_cid ON agreement (runtime, cid, created);
+"""
+
+
+def image_voxels(path):
+    """Returns the number of voxels of an image, read from its header"""
+    voxels = 1
+    for s in oitk.get_itk_information(path).GetSize():
+        voxels *= s
+    return voxels
+
+
+class RuntimeHistory(object):
+    """
+    Runtimes of containers per runtime backend, container id and input size.
+    Connections are opened per call, so one history can be used from
+    several threads and processes.
+    """
+
+    def __init__(self, path=None, runtime="docker"):
+        if path is None:
+            path = os.environ.get(ENV_VAR) or DEFAULT_PATH
+        self.path = op.abspath(op.expanduser(path))
+        self.runtime = runtime
+        os.makedirs(op.dirname(self.path), exist_ok=True)
+        with closing(self._connect()) as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, cid, voxels, seconds):
+        """Stores the runtime of one successful container run"""
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?)",
+                (self.runtime, cid, int(voxels), float(seconds), time.time()),
+            )
+
+    def runs(self, cid):
+        """Returns (voxels, seconds) of the most recent runs of cid"""
+        with closing(self._connect()) as db:
+            return db.execute(
+                "SELECT voxels, seconds FROM runs WHERE runtime = ? AND cid = ? "
+                "ORDER BY created DESC LIMIT ?",
+                (self.runtime, cid, RECENT_RUNS),
+            ).fetchall()
+
+    def predict(self, cid, voxels):
+        """
+        predict estimates the seconds container cid needs for an input of
+        the given size: the median of runs on inputs of about that size,
+        otherwise the median seconds per voxel scaled to the size.
+
+        Returns:
+            float: the predicted seconds, None without history
+        """
+        runs = self.runs(cid)
+        if not runs:
+            return None
+        similar = [s for v, s in runs if abs(v - voxels) <= SIZE_TOLERANCE * voxels]
+        if similar:
+            return statistics.median(similar)
+        perVoxel = [s / v for v, s in runs if v > 0]
+        if not perVoxel:
+            return None
+        return statistics.median(perVoxel) * voxels
+
+    def record_agreement(self, cid, dice):
+        """Stores the dice of a member of a fused ensemble with the fusion"""
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "INSERT INTO agreement VALUES (?, ?, ?, ?)",
+                (self.runtime, cid, float(dice), time.time()),
+            )
+
+    def agreement(self, cid):
+        """Returns the mean recent dice of cid with the fusions, None without history"""
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                "SELECT dice FROM agreement WHERE runtime = ? AND cid = ? "
+                "ORDER BY created DESC LIMIT ?",
+                (self.runtime, cid, RECENT_RUNS),
+            ).fetchall()
+        if not rows:
+            return None
+        return statistics.mean(d for (d,) in rows)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""Helpers to share the resources of a node between concurrent containers"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import asyncio
+import collections
+import heapq
+import os
+from contextlib import asynccontextmanager
+
+
+def available_cpus():
+    """Returns the sorted ids of the cpus this process may run on"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        # not available on macOS and Windows
+        return list(range(os.cpu_count() or 1))
+
+
+def available_memory():
+    """Returns the bytes of memory available for new processes, None if unknown"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        # not available on Windows
+        return None
+
+
+# a preprocessing worker runs registration and brain extraction of one exam
+WORKER_CPUS = 2
+WORKER_MEMORY = 4 * 2**30
+# gpu workers share one device, more than this only queue on it
+MAX_GPU_WORKERS = 2
+
+
+def preprocessing_workers(workers="auto", mode="cpu", cpus=None, memory=None):
+    """
+    Returns the number of preprocessing workers to start
+
+    Args:
+        workers (int or str, optional): a number, or "auto" to size the
+            workers by the available cpus and memory
+        mode (str, optional): the processing mode, gpu modes are capped
+        cpus (int, optional): defaults to the cpus this process may use
+        memory (int, optional): bytes, defaults to the available memory
+
+    Returns:
+        int: at least 1
+    """
+    if str(workers) != "auto":
+        workers = int(workers)
+        if workers < 1:
+            raise ValueError("At least one worker is needed, got {}".format(workers))
+        return workers
+    if cpus is None:
+        cpus = len(available_cpus())
+    if memory is None:
+        memory = available_memory()
+    workers = cpus // WORKER_CPUS
+    if memory is not None:
+        workers = min(workers, memory // WORKER_MEMORY)
+    if mode.startswith("gpu"):
+        workers = min(workers, MAX_GPU_WORKERS)
+    return max(1, int(workers))
+
+
+def format_cpuset(cpus):
+    """Formats a list of cpu ids in the notation of docker's --cpuset-cpus"""
+    return ",".join(str(c) for c in cpus)
+
+
+class _AsyncPool(object):
+    """
+    Base of the resource pools. Coroutines wait for a free resource first
+    come, first served without blocking the event loop or a worker thread.
+    A pool is used from one event loop at a time.
+    """
+
+    def __init__(self):
+        self._waiters = collections.deque()
+
+    def _take(self):
+        """Marks a free resource as used and returns it, None if all are used"""
+        raise NotImplementedError
+
+    def _give(self, resource):
+        """Marks a used resource as free"""
+        raise NotImplementedError
+
+    async def acquire(self):
+        """Waits until a resource is free and returns it"""
+        if not self._waiters:
+            resource = self._take()
+            if resource is not None:
+                return resource
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the resource was handed over just before the cancellation
+                self.release(waiter.result())
+            raise
+        finally:
+            # served waiters were already removed by release()
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self, resource):
+        self._give(resource)
+        while self._waiters:
+            if self._waiters[0].done():
+                # cancelled while waiting
+                self._waiters.popleft()
+                continue
+            resource = self._take()
+            if resource is None:
+                return
+            self._waiters.popleft().set_result(resource)
+
+    @asynccontextmanager
+    async def slot(self):
+        resource = await self.acquire()
+        try:
+            yield resource
+        finally:
+            self.release(resource)
+
+
+class CpusetPool(_AsyncPool):
+    """
+    Splits the available cpus into a number of disjoint cpusets. Every
+    concurrently running container acquires one of them, so containers
+    never compete for the same cores.
+    """
+
+    def __init__(self, slots, cpus=None):
+        super().__init__()
+        if cpus is None:
+            cpus = available_cpus()
+        slots = max(1, min(int(slots), len(cpus)))
+        # spread leftover cores over the first slots
+        size, rest = divmod(len(cpus), slots)
+        self.cpusets = []
+        start = 0
+        for i in range(slots):
+            stop = start + size + (1 if i < rest else 0)
+            self.cpusets.append(format_cpuset(cpus[start:stop]))
+            start = stop
+        self._free = list(self.cpusets)
+
+    def _take(self):
+        return self._free.pop(0) if self._free else None
+
+    def _give(self, cpuset):
+        self._free.append(cpuset)
+
+
+def parse_devices(gpu):
+    """
+    Returns a list of gpu ids from a single id, a comma separated string
+    like "0,1,3" or a list of ids
+    """
+    if isinstance(gpu, (list, tuple)):
+        devices = [str(d).strip() for d in gpu]
+    else:
+        devices = [d.strip() for d in str(gpu).split(",")]
+    devices = [d for d in devices if d]
+    if not devices:
+        raise ValueError("No gpu device id given: {}".format(gpu))
+    return devices
+
+
+class GpuPool(_AsyncPool):
+    """
+    Hands out gpu devices to concurrently running containers. Every
+    container gets the device running the fewest containers at the moment,
+    with slots_per_device set acquire() waits while all devices are full.
+    """
+
+    def __init__(self, devices, slots_per_device=None):
+        super().__init__()
+        self.devices = parse_devices(devices)
+        self.slots_per_device = slots_per_device
+        self._running = {d: 0 for d in self.devices}
+
+    def _take(self):
+        device = min(self.devices, key=lambda d: self._running[d])
+        if self.slots_per_device and self._running[device] >= self.slots_per_device:
+            return None
+        self._running[device] += 1
+        return device
+
+    def _give(self, device):
+        self._running[device] -= 1
+
+
+def lpt_makespan(durations, slots, gpu=None, gpu_slots=None):
+    """
+    Simulates longest-processing-time-first scheduling of jobs on a number
+    of slots and returns the predicted makespan in seconds. Jobs flagged in
+    gpu additionally need one of gpu_slots device slots, they hold their
+    job slot while waiting for it like the segmentor does.
+    """
+    if gpu is None:
+        gpu = [False] * len(durations)
+    finish = [0.0] * max(1, int(slots))
+    devices = [0.0] * int(gpu_slots) if gpu_slots else None
+    for duration, needsGpu in sorted(zip(durations, gpu), key=lambda j: -j[0]):
+        # the next job goes to the slot that frees up first
+        start = heapq.heappop(finish)
+        if needsGpu and devices is not None:
+            start = max(start, heapq.heappop(devices))
+            heapq.heappush(devices, start + duration)
+        heapq.heappush(finish, start + duration)
+    return max(finish)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Scratch directories for staging container inputs
+
+Inputs are staged below a scratch root, which defaults to the environment
+variable BRATS_SCRATCH and then to the system temp directory. Point it to
+a tmpfs or a local NVMe disk to keep the staging I/O off slow disks.
+Scratch directories are checked for free space before anything is staged
+and removed when the block using them is left, also on errors.
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import errno
+import logging
+import os
+import os.path as op
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import SimpleITK as sitk
+
+from . import own_itk as oitk
+
+ENV_VAR = "BRATS_SCRATCH"
+
+
+def scratch_root(root=None):
+    """Returns the scratch root to use: root, $BRATS_SCRATCH or the temp dir"""
+    if root is None:
+        root = os.environ.get(ENV_VAR) or tempfile.gettempdir()
+    root = op.abspath(op.expanduser(root))
+    os.makedirs(root, exist_ok=True)
+    return root
+
+
+def image_nbytes(path):
+    """
+    Returns the size of an image once decompressed, read from its header.
+    Falls back to the file size for files SimpleITK can't read.
+    """
+    try:
+        reader = oitk.get_itk_information(path)
+        # bytes per voxel, including vector components
+        voxel = sitk.GetArrayFromImage(sitk.Image([1, 1, 1], reader.GetPixelID()))
+        nbytes = voxel.nbytes
+        for s in reader.GetSize():
+            nbytes *= s
+        return nbytes
+    except RuntimeError:
+        return op.getsize(path)
+
+
+def check_free_space(root, required):
+    """Raises an OSError (ENOSPC) if root has less than required bytes free"""
+    free = shutil.disk_usage(root).free
+    if free < required:
+        raise OSError(
+            errno.ENOSPC,
+            "Scratch root {} has {:.1f} MiB free, staging needs about {:.1f} MiB".format(
+                root, free / 2**20, required / 2**20
+            ),
+        )
+    return free
+
+
+@contextmanager
+def scratch_dir(root=None, required=0, prefix="brats_"):
+    """
+    Creates a directory below the scratch root after checking that about
+    required bytes are free. The directory is removed when the block is left.
+
+    Args:
+        root (str, optional): the scratch root, see scratch_root()
+        required (int, optional): bytes the staging is expected to need
+        prefix (str, optional): prefix of the directory name
+
+    Yields:
+        str: the absolute path of the directory
+    """
+    root = scratch_root(root)
+    check_free_space(root, required)
+    path = tempfile.mkdtemp(prefix=prefix, dir=root)
+    # TODO this is a potential security hazzard as all users can access the files now, but currently it seems the only way to deal with bad configured docker installations
+    os.chmod(path, 0o777)
+    logging.debug("Staging in {}".format(path))
+    try:
+        yield path
+    finally:
+        # containers running as root may leave files we can't remove
+        shutil.rmtree(path, ignore_errors=True)
+        if op.exists(path):
+            logging.warning("Could not remove the scratch directory {}".format(path))
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Lightweight stage timing for segmentation and fusion runs
+
+Stages are wrapped in span() blocks or timed() functions. Every span
+records its duration into the run report active in the current context,
+together with the bytes this python process read and wrote meanwhile and
+its peak resident memory. The process counters are prefixed with
+process_: they include the I/O of concurrent spans and exclude the I/O
+of containers, which run in processes of their own. Without an active
+report spans cost next to nothing. Reports are written as JSON and optionally
+as Chrome trace events (open with chrome://tracing or ui.perfetto.dev).
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+_current_report = contextvars.ContextVar("brats_toolkit_run_report", default=None)
+
+# per span counters of the whole python process, not of the stage alone
+PROCESS_COUNTERS = [
+    "process_bytes_read",
+    "process_bytes_written",
+    "process_peak_rss_kb",
+]
+
+
+def _io_counters():
+    """Returns the bytes read and written by this process so far"""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peak_rss_kb():
+    """Returns the peak resident set size of this process in KiB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KiB
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _lane():
+    """Identifies the asyncio task or thread a span runs in"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return "task-{}".format(id(task))
+    return "thread-{}".format(threading.get_ident())
+
+
+class RunReport(object):
+    """Collects the spans of one run"""
+
+    def __init__(self, name):
+        self.name = name
+        self.created = time.time()
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self.spans = []
+
+    def record(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self):
+        """Returns the total seconds spent per stage name"""
+        totals = {}
+        for span in self.spans:
+            totals[span["name"]] = totals.get(span["name"], 0.0) + span["duration"]
+        return totals
+
+    def write_json(self, path):
+        report = {
+            "name": self.name,
+            "created": self.created,
+            "wall_time": time.perf_counter() - self._t0,
+            "process_peak_rss_kb": _peak_rss_kb(),
+            "stages": self.summary(),
+            "spans": sorted(self.spans, key=lambda s: s["start"]),
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    def write_chrome_trace(self, path):
+        lanes = {}
+        events = []
+        for span in sorted(self.spans, key=lambda s: s["start"]):
+            tid = lanes.setdefault(span["lane"], len(lanes) + 1)
+            args = dict(span["attrs"])
+            for k in PROCESS_COUNTERS:
+                args[k] = span[k]
+            events.append(
+                {
+                    "name": span["name"],
+                    "cat": self.name,
+                    "ph": "X",
+                    "ts": span["start"] * 1e6,
+                    "dur": span["duration"] * 1e6,
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": args,
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    span times the enclosed block as stage name in the active report.
+    Yields a dict, entries added to it are stored with the span.
+    The process_ counters are process wide, concurrent spans see each
+    other's I/O and container I/O is not included.
+    """
+    report = _current_report.get()
+    if report is None:
+        yield attrs
+        return
+    read0, written0 = _io_counters()
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        end = time.perf_counter()
+        read1, written1 = _io_counters()
+        report.record(
+            {
+                "name": name,
+                "start": start - report._t0,
+                "duration": end - start,
+                "process_bytes_read": None if read0 is None else read1 - read0,
+                "process_bytes_written": (
+                    None if written0 is None else written1 - written0
+                ),
+                "process_peak_rss_kb": _peak_rss_kb(),
+                "lane": _lane(),
+                "attrs": attrs,
+            }
+        )
+
+
+def timed(name):
+    """Decorator timing every call of a function as one span called name"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, function=func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def run_report(name, jsonPath=None, tracePath=None):
+    """
+    Activates a new report for the enclosed block and writes it to jsonPath
+    and tracePath (Chrome trace events) when the block is left.
+    """
+    report = RunReport(name)
+    token = _current_report.set(report)
+    try:
+        yield report
+    finally:
+        _current_report.reset(token)
+        if jsonPath is not None:
+            report.write_json(jsonPath)
+        if tracePath is not None:
+            report.write_chrome_trace(tracePath)
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """Runs func in the default executor, spans inside it stay in the active report"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(context.run, func, *args, **kwargs)
+    )
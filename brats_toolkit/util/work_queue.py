@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Work queue on a shared filesystem, without an external broker
+
+Every work item is a small JSON file. Its state is the folder it lives in:
+
+    pending/<id>.json              waiting to be claimed
+    claimed/<id>.json.<worker>     claimed by a worker, mtime is the heartbeat
+    done/<id>.json                 finished
+    failed/<id>.json               gave up after max_attempts
+
+Claims and state changes are atomic renames, which are safe on NFS in
+contrast to file locks or SQLite's WAL mode. Workers refresh the mtime of
+their claims, claims without heartbeat are put back to pending by reap().
+"""
+
+# Please refer to README.md and LICENSE.md for further documentation
+# This software is not certified for clinical use.
+
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import socket
+import time
+import uuid
+
+STATES = ["pending", "claimed", "done", "failed"]
+
+
+def worker_id():
+    """Returns an id unique for this process across nodes"""
+    return "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+
+
+class ClaimLost(Exception):
+    """Raised if a claim was reaped while the worker still held it"""
+
+
+class WorkQueue(object):
+    """
+    A queue of JSON work items under root, shared by workers on all nodes
+    mounting root.
+
+    Items may depend on other items (e.g. a fusion on the segmentations of a
+    case), they are only handed out once all dependencies are done or failed.
+    """
+
+    def __init__(self, root, stale_after=300, max_attempts=3):
+        self.root = op.abspath(op.expanduser(root))
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        for state in STATES:
+            os.makedirs(op.join(self.root, state), exist_ok=True)
+
+    def _path(self, state, name):
+        return op.join(self.root, state, name)
+
+    def _write(self, state, name, item):
+        # write next to the target and rename, readers never see partial files
+        tmp = self._path(state, ".{}.{}.tmp".format(name, uuid.uuid4().hex))
+        with open(tmp, "w") as f:
+            json.dump(item, f)
+        os.rename(tmp, self._path(state, name))
+
+    def _itemName(self, item_id):
+        return item_id + ".json"
+
+    def _exists(self, item_id):
+        name = self._itemName(item_id)
+        if any(op.exists(self._path(s, name)) for s in ["pending", "done", "failed"]):
+            return True
+        return any(
+            f.startswith(name) for f in os.listdir(op.join(self.root, "claimed"))
+        )
+
+    def put(self, payload, item_id=None, depends=None):
+        """
+        put enqueues a work item, enqueueing the same payload again is a no-op
+
+        Args:
+            payload (dict): JSON serializable description of the work
+            item_id (str, optional): defaults to a hash of the payload
+            depends (list, optional): ids of items that have to be done first
+
+        Returns:
+            str: the item id
+        """
+        if item_id is None:
+            blob = json.dumps(payload, sort_keys=True).encode("utf-8")
+            item_id = hashlib.sha256(blob).hexdigest()[:24]
+        if not self._exists(item_id):
+            item = {
+                "id": item_id,
+                "payload": payload,
+                "depends": list(depends or []),
+                "attempts": 0,
+            }
+            self._write("pending", self._itemName(item_id), item)
+        return item_id
+
+    def _ready(self, name):
+        try:
+            with open(self._path("pending", name)) as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return False
+        # dependencies that failed for good don't block, e.g. a fusion then
+        # uses the members that are available
+        return all(
+            op.exists(self._path("done", self._itemName(d)))
+            or op.exists(self._path("failed", self._itemName(d)))
+            for d in item["depends"]
+        )
+
+    def claim(self, worker):
+        """
+        claim takes the next ready item
+
+        Args:
+            worker (str): the id of the claiming worker
+
+        Returns:
+            Claim: the claimed item, None if no item is ready
+        """
+        pending = sorted(
+            f for f in os.listdir(op.join(self.root, "pending")) if f.endswith(".json")
+        )
+        for name in pending:
+            if not self._ready(name):
+                continue
+            target = self._path("claimed", "{}.{}".format(name, worker))
+            try:
+                # only one worker can win the rename
+                os.rename(self._path("pending", name), target)
+            except FileNotFoundError:
+                continue
+            claim = Claim(self, target)
+            try:
+                claim.heartbeat()
+                with open(target) as f:
+                    claim.item = json.load(f)
+            except ClaimLost:
+                continue
+            return claim
+        return None
+
+    def reap(self):
+        """Puts claims without recent heartbeat back to pending, returns their number"""
+        reaped = 0
+        now = time.time()
+        claimed = op.join(self.root, "claimed")
+        for name in os.listdir(claimed):
+            if ".reaping." in name:
+                # taken over by another reaper
+                continue
+            path = op.join(claimed, name)
+            try:
+                if now - os.stat(path).st_mtime < self.stale_after:
+                    continue
+                # take the claim over first, so only one reaper handles it
+                reaping = path + ".reaping." + uuid.uuid4().hex[:6]
+                os.rename(path, reaping)
+                with open(reaping) as f:
+                    item = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if op.exists(self._path("done", self._itemName(item["id"]))):
+                # the worker died after finishing the item
+                os.remove(reaping)
+                continue
+            item["attempts"] += 1
+            state = "failed" if item["attempts"] >= self.max_attempts else "pending"
+            logging.warning(
+                "Claim {} is stale, moving it to {}".format(item["id"], state)
+            )
+            self._write(state, self._itemName(item["id"]), item)
+            os.remove(reaping)
+            reaped += 1
+        return reaped
+
+    def counts(self):
+        """Returns the number of items per state"""
+        return {
+            state: len(
+                [f for f in os.listdir(op.join(self.root, state)) if ".tmp" not in f]
+            )
+            for state in STATES
+        }
+
+    def finished(self):
+        """True if no item is pending or claimed"""
+        counts = self.counts()
+        return counts["pending"] == 0 and counts["claimed"] == 0
+
+
+class Claim(object):
+    """A work item claimed by one worker"""
+
+    def __init__(self, queue, path):
+        self.queue = queue
+        self.path = path
+        self.item = None
+
+    @property
+    def payload(self):
+        return self.item["payload"]
+
+    def heartbeat(self):
+        """Refreshes the claim, raises ClaimLost if it was reaped"""
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            raise ClaimLost(self.path)
+
+    def _finish(self, state, result):
+        item = dict(self.item)
+        item["result"] = result
+        if state == "pending":
+            item["attempts"] += 1
+            if item["attempts"] >= self.queue.max_attempts:
+                state = "failed"
+        # take the claim out of the reaper's reach before changing its state
+        finishing = self.path + ".finishing"
+        try:
+            os.rename(self.path, finishing)
+        except FileNotFoundError:
+            logging.warning("Claim {} was reaped before it finished".format(item["id"]))
+            return
+        self.queue._write(state, self.queue._itemName(item["id"]), item)
+        os.remove(finishing)
+
+    def done(self, result=None):
+        self._finish("done", result)
+
+    def fail(self, result=None):
+        """Puts the item back to pending, or to failed after max_attempts"""
+        self._finish("pending", result)
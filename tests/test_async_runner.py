@@ -0,0 +1,45 @@
+import asyncio
+import sys
+
+import pytest
+
+from brats_toolkit.util.async_runner import (
+    AsyncContainerRunner,
+    Watchdog,
+    WatchdogError,
+)
+
+
+def run(command, logPath, watchdog=None):
+    return asyncio.run(AsyncContainerRunner().run(command, logPath, watchdog))
+
+
+def test_progress_bar_without_newline_is_logged(tmp_path):
+    # a progress bar redrawn with \r, far longer than the stream limit
+    script = "import sys\nfor i in range(50000): sys.stdout.write('\\r%05d' % i)\n"
+    logPath = tmp_path / "output.log"
+    returncode = run([sys.executable, "-c", script], str(logPath))
+    assert returncode == 0
+    output = logPath.read_bytes()
+    assert len(output) == 50000 * 6
+    assert output.endswith(b"\r49999")
+
+
+def test_long_line_is_logged_in_pieces(tmp_path):
+    script = "print('x' * 300000)"
+    logPath = tmp_path / "output.log"
+    assert run([sys.executable, "-c", script], str(logPath)) == 0
+    assert logPath.read_bytes() == b"x" * 300000 + b"\n"
+
+
+def test_fatal_output_after_carriage_returns_stops_the_process(tmp_path):
+    script = (
+        "import sys, time\n"
+        "sys.stdout.write('\\r10%' * 30000 + '\\rCUDA out of memory\\n')\n"
+        "sys.stdout.flush()\n"
+        "time.sleep(60)\n"
+    )
+    logPath = tmp_path / "output.log"
+    with pytest.raises(WatchdogError, match="CUDA out of memory"):
+        run([sys.executable, "-c", script], str(logPath), Watchdog())
+    assert b"[watchdog] stopping" in logPath.read_bytes()
@@ -0,0 +1,164 @@
+import asyncio
+import os.path as op
+
+import pytest
+
+from brats_toolkit.util import own_itk as oitk
+from brats_toolkit.util.async_runner import (
+    AsyncContainerRunner,
+    WatchdogError,
+    Watchdog,
+)
+from brats_toolkit.util.container_runtime import (
+    ContainerRuntime,
+    DockerCLIRuntime,
+    FakeRuntime,
+    container_name,
+    get_runtime,
+    resource_flags,
+)
+
+PARAMS = {
+    "runtime": "runc",
+    "id": "example/image:1.0",
+    "command": "python predict.py --fast",
+    "mountpoint": "/data",
+}
+
+
+def run(runtime, cid, params, directory, logPath, watchdog=None, name=None):
+    command = runtime.command(cid, params, directory, name=name)
+    return asyncio.run(
+        runtime.run(
+            AsyncContainerRunner(),
+            cid,
+            params,
+            directory,
+            command,
+            logPath,
+            watchdog=watchdog,
+            name=name,
+        )
+    )
+
+
+def test_get_runtime():
+    assert isinstance(get_runtime(), DockerCLIRuntime)
+    assert isinstance(get_runtime("fake"), FakeRuntime)
+    runtime = FakeRuntime()
+    assert get_runtime(runtime) is runtime
+    with pytest.raises(ValueError):
+        get_runtime("podman")
+
+
+def test_container_name_is_valid():
+    assert container_name("mic-dkfz/v2", "ab12") == "brats_mic-dkfz_v2_ab12"
+
+
+def test_resource_flags():
+    params = {"cpus": 4, "memory": "8g", "shm_size": "1g"}
+    assert resource_flags(params, cpuset="0,1") == [
+        "--cpus=4",
+        "--memory=8g",
+        "--memory-swap=8g",
+        "--shm-size=1g",
+        "--cpuset-cpus=0,1",
+    ]
+    assert resource_flags({}) == []
+
+
+def test_docker_cli_command():
+    command = DockerCLIRuntime().command(
+        "test", PARAMS, "/tmp/case", cpuset="2", name="brats_test_1"
+    )
+    assert command == [
+        "docker",
+        "run",
+        "--rm",
+        "--name",
+        "brats_test_1",
+        "--cpuset-cpus=2",
+        "-v",
+        "/tmp/case:/data",
+        "example/image:1.0",
+        "python",
+        "predict.py",
+        "--fast",
+    ]
+
+
+def test_docker_cli_command_gpu():
+    params = dict(PARAMS, runtime="nvidia")
+    command = DockerCLIRuntime().command("test", params, "/tmp/case", gpu="1")
+    assert command[3:5] == ["--gpus", "device=1"]
+    command = DockerCLIRuntime().command(
+        "test", params, "/tmp/case", gpu="1", newdocker=False
+    )
+    assert command[3:6] == ["--runtime=nvidia", "-e", "CUDA_VISIBLE_DEVICES=1"]
+
+
+def test_fake_runtime_writes_segmentation(tmp_path):
+    resultsDir = tmp_path / "results"
+    resultsDir.mkdir()
+    returncode = run(
+        FakeRuntime(), "test", PARAMS, str(tmp_path), str(tmp_path / "log")
+    )
+    assert returncode == 0
+    result = resultsDir / "tumor_test_class.nii.gz"
+    assert sorted(set(oitk.get_itk_array(str(result)).ravel())) == [0, 1, 2, 4]
+    assert b"fake container test" in (tmp_path / "log").read_bytes()
+
+
+def test_fake_runtime_func(tmp_path):
+    calls = []
+    runtime = FakeRuntime(func=lambda *args: calls.append(args))
+    assert run(runtime, "test", PARAMS, str(tmp_path), str(tmp_path / "log")) == 0
+    assert calls == [("test", PARAMS, str(tmp_path))]
+
+
+def test_fake_runtime_func_failure(tmp_path):
+    def fail(cid, params, directory):
+        raise RuntimeError("model crashed")
+
+    runtime = FakeRuntime(func=fail)
+    assert run(runtime, "test", PARAMS, str(tmp_path), str(tmp_path / "log")) == 1
+    assert "model crashed" in (tmp_path / "log").read_text()
+
+
+def test_watchdog_stops_hanging_container(tmp_path):
+    params = dict(PARAMS, fake_hang=True)
+    with pytest.raises(WatchdogError, match="timeout"):
+        run(
+            FakeRuntime(),
+            "test",
+            params,
+            str(tmp_path),
+            str(tmp_path / "log"),
+            watchdog=Watchdog(timeout=1),
+        )
+
+
+def test_named_run_kills_container_on_watchdog(tmp_path):
+    killed = []
+
+    class Runtime(FakeRuntime):
+        async def run(self, *args, **kwargs):
+            # the fake runtime has no container, use the generic run with kill
+            return await ContainerRuntime.run(self, *args, **kwargs)
+
+        async def kill(self, name):
+            killed.append(name)
+
+    params = dict(PARAMS, fake_message="CUDA out of memory", fake_hang=True)
+    with pytest.raises(WatchdogError, match="fatal output"):
+        run(
+            Runtime(),
+            "test",
+            params,
+            str(tmp_path),
+            str(tmp_path / "log"),
+            watchdog=Watchdog(),
+            name="brats_test_1",
+        )
+    assert killed == ["brats_test_1"]
+    assert not op.exists(tmp_path / "results" / "tumor_test_class.nii.gz")
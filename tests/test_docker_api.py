@@ -0,0 +1,159 @@
+import asyncio
+import os.path as op
+import shutil
+import tempfile
+
+import pytest
+
+from brats_toolkit.util.async_runner import (
+    AsyncContainerRunner,
+    Watchdog,
+    WatchdogError,
+)
+from brats_toolkit.util.container_runtime import DockerAPIRuntime
+from brats_toolkit.util.docker_api import DockerAPIError, EngineAPIClient
+from brats_toolkit.util.fake_docker_api import FakeEngineAPIServer
+
+PARAMS = {
+    "runtime": "runc",
+    "id": "fake/model:1.0",
+    "command": " ",
+    "mountpoint": "/data",
+}
+
+
+@pytest.fixture
+def server():
+    # unix socket paths are limited to about 100 characters, keep it short
+    socketDir = tempfile.mkdtemp(prefix="brats_api_", dir="/tmp")
+    server = FakeEngineAPIServer(
+        op.join(socketDir, "docker.sock"),
+        missing_images=["fake/missing:1.0"],
+        broken_images=["fake/broken"],
+    )
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(socketDir, ignore_errors=True)
+
+
+@pytest.fixture
+def client(server):
+    return EngineAPIClient(server.socket_path, timeout=30)
+
+
+def run(runtime, params, directory, watchdog=None):
+    command = runtime.command("test", params, directory, name="brats_test_1")
+    return asyncio.run(
+        runtime.run(
+            AsyncContainerRunner(),
+            "test",
+            params,
+            directory,
+            command,
+            op.join(directory, "test.log"),
+            watchdog=watchdog,
+            name="brats_test_1",
+        )
+    )
+
+
+def test_ping(client):
+    assert client.ping()
+    assert not EngineAPIClient("/tmp/no_docker_here.sock").ping()
+
+
+def test_run_creates_starts_follows_and_removes(server, tmp_path):
+    runtime = DockerAPIRuntime(server.socket_path)
+    assert runtime.available()
+    assert run(runtime, PARAMS, str(tmp_path)) == 0
+    assert op.exists(tmp_path / "results" / "tumor_test_class.nii.gz")
+    assert b"fake container test wrote" in (tmp_path / "test.log").read_bytes()
+    assert server.containers == {}
+
+
+def test_run_pulls_missing_image(server, tmp_path):
+    runtime = DockerAPIRuntime(server.socket_path)
+    params = dict(PARAMS, id="fake/missing:1.0")
+    assert run(runtime, params, str(tmp_path)) == 0
+    assert server.missing_images == set()
+
+
+def test_run_returns_exit_code(server, tmp_path):
+    runtime = DockerAPIRuntime(server.socket_path)
+    params = dict(PARAMS, command="--no-such-option")
+    assert run(runtime, params, str(tmp_path)) == 2
+    assert server.containers == {}
+
+
+def test_watchdog_kills_container(server, tmp_path):
+    runtime = DockerAPIRuntime(server.socket_path)
+    params = dict(PARAMS, command="--hang")
+    with pytest.raises(WatchdogError):
+        run(runtime, params, str(tmp_path), watchdog=Watchdog(timeout=1))
+    assert server.containers == {}
+
+
+def test_container_lifecycle(server, client, tmp_path):
+    config = DockerAPIRuntime(client=client).container_config(
+        "test", dict(PARAMS, command="--sleep 60"), str(tmp_path)
+    )
+    container = client.create_container(config, name="brats_test_2")
+    client.start(container)
+    # a running container is only removed with force
+    with pytest.raises(DockerAPIError) as e:
+        client.remove(container)
+    assert e.value.status == 409
+    client.kill(container)
+    assert client.wait(container) != 0
+    client.remove(container)
+    with pytest.raises(DockerAPIError) as e:
+        client.kill(container)
+    assert e.value.status == 404
+
+
+def test_logs(server, client, tmp_path):
+    config = DockerAPIRuntime(client=client).container_config(
+        "test", dict(PARAMS, command="--message hello"), str(tmp_path)
+    )
+    container = client.create_container(config)
+    client.start(container)
+    lines = list(client.logs(container))
+    assert b"hello\n" in lines
+    assert all(line.endswith(b"\n") for line in lines)
+    assert client.wait(container) == 0
+
+
+def test_create_missing_image(client, tmp_path):
+    config = DockerAPIRuntime(client=client).container_config(
+        "test", dict(PARAMS, id="fake/missing:1.0"), str(tmp_path)
+    )
+    with pytest.raises(DockerAPIError) as e:
+        client.create_container(config)
+    assert e.value.status == 404
+
+
+def test_pull(server, client, capsys):
+    messages = list(client.pull("fake/missing:1.0"))
+    assert messages[-1] == {"status": "Status: Downloaded fake/missing"}
+    assert "fake/missing:1.0" not in server.missing_images
+    DockerAPIRuntime(client=client).pull("fake/model:1.0")
+    assert "Status: Downloaded fake/model" in capsys.readouterr().out
+
+
+def test_pull_error(client):
+    with pytest.raises(DockerAPIError, match="not found"):
+        list(client.pull("fake/broken"))
+    with pytest.raises(DockerAPIError):
+        DockerAPIRuntime(client=client).pull("fake/broken:latest")
+
+
+def test_images(client):
+    runtime = DockerAPIRuntime(client=client)
+    assert runtime.image_id("fake/model:1.0") == "sha256:fake/model:1.0"
+    assert runtime.repo_digests("fake/model:1.0") == []
+    assert runtime.repo_digests("fake/missing:1.0") is None
+    with pytest.raises(DockerAPIError) as e:
+        client.inspect_image("fake/missing:1.0")
+    assert e.value.status == 404
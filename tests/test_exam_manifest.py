@@ -0,0 +1,92 @@
+import os
+
+from brats_toolkit.util.exam_manifest import MANIFEST_NAME, ExamManifest
+
+
+def write_exam(tmp_path, name, content=b"x"):
+    exam = tmp_path / "in" / name
+    exam.mkdir(parents=True, exist_ok=True)
+    (exam / "t1.nii.gz").write_bytes(content)
+    return str(exam)
+
+
+def export(manifest, exam):
+    exported = os.path.join(manifest.export_folder, exam)
+    os.makedirs(exported, exist_ok=True)
+    with open(os.path.join(exported, "seg.nii.gz"), "w") as f:
+        f.write("result")
+    return exported
+
+
+def test_pending_submit_complete(tmp_path):
+    folders = [write_exam(tmp_path, "a"), write_exam(tmp_path, "b")]
+    manifest = ExamManifest(str(tmp_path / "out"))
+    pending = manifest.pending(folders)
+    assert sorted(pending) == folders
+    manifest.submit(pending)
+    assert {e["status"] for e in manifest.exams.values()} == {"submitted"}
+    export(manifest, "a")
+    manifest.complete(["a", "b"])
+    assert manifest.exams["a"]["status"] == "done"
+    assert manifest.exams["b"]["status"] == "failed"
+    # the manifest is saved and read back by the next run
+    assert os.path.isfile(tmp_path / "out" / MANIFEST_NAME)
+    again = ExamManifest(str(tmp_path / "out"))
+    assert list(again.pending(folders)) == [folders[1]]
+
+
+def test_done_exam_without_results_is_pending(tmp_path):
+    folder = write_exam(tmp_path, "a")
+    manifest = ExamManifest(str(tmp_path / "out"))
+    manifest.submit(manifest.pending([folder]))
+    manifest.complete(["a"])
+    assert manifest.exams["a"]["status"] == "failed"
+    exported = export(manifest, "a")
+    manifest.exams["a"]["status"] = "done"
+    assert manifest.pending([folder]) == {}
+    os.rename(exported, exported + ".moved")
+    assert list(manifest.pending([folder])) == [folder]
+
+
+def test_changed_inputs_replace_the_results(tmp_path):
+    folder = write_exam(tmp_path, "a")
+    manifest = ExamManifest(str(tmp_path / "out"))
+    manifest.submit(manifest.pending([folder]))
+    exported = export(manifest, "a")
+    manifest.complete(["a"])
+    write_exam(tmp_path, "a", content=b"changed")
+    pending = manifest.pending([folder])
+    assert pending[folder] != manifest.exams["a"]["fingerprint"]
+    manifest.submit(pending)
+    assert not os.path.exists(exported)
+
+
+def test_submit_keeps_results_of_unchanged_exams(tmp_path):
+    folders = [write_exam(tmp_path, "a"), write_exam(tmp_path, "b")]
+    manifest = ExamManifest(str(tmp_path / "out"))
+    manifest.submit(manifest.fingerprints(folders))
+    kept = export(manifest, "a")
+    failed = export(manifest, "b")
+    manifest._mark("b", "failed")
+    # an interrupted run leaves a as submitted, its results stay
+    manifest.submit(manifest.fingerprints(folders))
+    assert os.path.isdir(kept)
+    assert not os.path.exists(failed)
+
+
+def test_status_events_mark_exams(tmp_path):
+    folders = [write_exam(tmp_path, name) for name in ["a", "b", "c"]]
+    manifest = ExamManifest(str(tmp_path / "out"))
+    manifest.submit(manifest.fingerprints(folders))
+    manifest(
+        "ipstatus", {"examid": "a", "ipstatus": "bias correction failed, retrying"}
+    )
+    manifest(
+        "ipstatus", {"examid": "a", "ipstatus": "processing successfully completed"}
+    )
+    manifest("ipstatus", {"examid": "b", "ipstatus": "image processing failed"})
+    manifest("ipstatus", {"examid": "unknown", "ipstatus": "image processing failed"})
+    assert manifest.exams["a"]["status"] == "done"
+    assert manifest.exams["b"]["status"] == "failed"
+    assert manifest.exams["c"]["status"] == "submitted"
+    assert "unknown" not in manifest.exams
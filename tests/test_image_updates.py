@@ -0,0 +1,101 @@
+import json
+import subprocess
+
+import pytest
+
+from brats_toolkit.util.container_runtime import ContainerRuntime
+from brats_toolkit.util.docker_api import DockerAPIError
+from brats_toolkit.util.image_updates import ImageUpdater, parse_reference
+
+IMAGE = "fake/model:1.0"
+OLD = "sha256:" + "a" * 64
+NEW = "sha256:" + "b" * 64
+
+
+class Runtime(ContainerRuntime):
+    """Has the image at digest OLD, pull() returns or raises pulled"""
+
+    def __init__(self, pulled=None):
+        self.pulled = pulled
+        self.pulls = []
+
+    def repo_digests(self, image):
+        return ["fake/model@" + OLD]
+
+    def pull(self, image):
+        self.pulls.append(image)
+        if isinstance(self.pulled, Exception):
+            raise self.pulled
+        return self.pulled
+
+
+def updater(tmp_path, runtime, remote=NEW, **kwargs):
+    def digest(image):
+        if isinstance(remote, Exception):
+            raise remote
+        return remote
+
+    return ImageUpdater(
+        runtime, cache_path=str(tmp_path / "digests.json"), digest=digest, **kwargs
+    )
+
+
+def cached(tmp_path):
+    try:
+        with open(tmp_path / "digests.json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def test_parse_reference():
+    assert parse_reference("ubuntu") == (
+        "registry-1.docker.io",
+        "library/ubuntu",
+        "latest",
+    )
+    assert parse_reference("localhost:5000/brats/seg:2") == (
+        "localhost:5000",
+        "brats/seg",
+        "2",
+    )
+
+
+def test_current_image_is_not_pulled(tmp_path):
+    runtime = Runtime()
+    assert updater(tmp_path, runtime, remote=OLD).update(IMAGE) == "current"
+    assert runtime.pulls == []
+    assert cached(tmp_path)[IMAGE]["digest"] == OLD
+
+
+def test_changed_image_is_pulled_and_cached(tmp_path):
+    runtime = Runtime(pulled=subprocess.CompletedProcess([], 0))
+    update = updater(tmp_path, runtime)
+    assert update.update(IMAGE) == "pulled"
+    assert runtime.pulls == [IMAGE]
+    assert cached(tmp_path)[IMAGE]["digest"] == NEW
+
+
+@pytest.mark.parametrize(
+    "pulled",
+    [subprocess.CompletedProcess([], 1), DockerAPIError(500, "manifest unknown")],
+)
+def test_failed_pull_is_not_cached(tmp_path, pulled):
+    runtime = Runtime(pulled=pulled)
+    update = updater(tmp_path, runtime)
+    assert update.update(IMAGE) == "failed"
+    assert cached(tmp_path) == {}
+    # the next run checks and pulls again
+    assert update.update(IMAGE) == "failed"
+    assert runtime.pulls == [IMAGE, IMAGE]
+
+
+def test_offline_registry_uses_local_image(tmp_path):
+    runtime = Runtime()
+    update = updater(tmp_path, runtime, remote=OSError("no network"))
+    assert update.update(IMAGE) == "offline"
+    assert runtime.pulls == []
+
+
+def test_never_policy_skips(tmp_path):
+    assert updater(tmp_path, Runtime(), policy="never").update(IMAGE) == "skipped"
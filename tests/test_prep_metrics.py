@@ -0,0 +1,133 @@
+import json
+
+import pytest
+
+from brats_toolkit.util.prep_metrics import (
+    EXAM_DONE,
+    EXAM_FAILED,
+    PreprocessingMetrics,
+    stage_label,
+)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        "image processing failed",
+        "Processing aborted",
+        "Error: registration diverged",
+        "ERROR",
+        "failed to read the t1",
+    ],
+)
+def test_failure_messages(message):
+    assert EXAM_FAILED.search(message)
+    assert not EXAM_DONE.search(message)
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        "image processing successfully completed",
+        "bias field correction failed, using the fallback",
+        "error correction of the brain mask",
+        "registering to the SRI atlas",
+    ],
+)
+def test_messages_that_are_no_failure(message):
+    assert not EXAM_FAILED.search(message)
+
+
+def inspected(metrics, exams):
+    metrics("status", {"message": "input inspection finished!", "data": exams})
+
+
+def ipstatus(metrics, exam, message):
+    metrics("ipstatus", {"examid": exam, "ipstatus": message})
+
+
+def test_summary_and_eta():
+    clock = Clock()
+    metrics = PreprocessingMetrics(clock=clock)
+    inspected(metrics, ["a", "b", "c", "d"])
+    summary = metrics.summary()
+    assert summary["exams"] == {"queued": 4, "running": 0, "done": 0, "failed": 0}
+    assert summary["eta_seconds"] is None
+    ipstatus(metrics, "a", "registering to the SRI atlas")
+    clock.now += 60
+    ipstatus(metrics, "a", "skull stripping with ROBEX")
+    clock.now += 40
+    ipstatus(metrics, "a", "image processing successfully completed")
+    ipstatus(metrics, "b", "Error: registration diverged")
+    summary = metrics.summary()
+    assert summary["exams"] == {"queued": 2, "running": 0, "done": 1, "failed": 1}
+    # two exams finished 100s after the first start, two remain
+    assert summary["throughput_per_hour"] == pytest.approx(72)
+    assert summary["eta_seconds"] == pytest.approx(100)
+    assert summary["latency_seconds"]["count"] == 2
+    assert summary["stages"]["registering to the SRI atlas"]["seconds"] == 60
+    assert summary["stages"]["skull stripping with ROBEX"]["mean"] == 40
+    assert metrics.exams["b"]["error"] == "Error: registration diverged"
+
+
+def test_repeated_end_is_ignored():
+    clock = Clock()
+    metrics = PreprocessingMetrics(clock=clock)
+    ipstatus(metrics, "a", "image processing successfully completed")
+    clock.now += 10
+    ipstatus(metrics, "a", "image processing successfully completed")
+    assert metrics.exams["a"]["finished"] == 1000.0
+
+
+def test_stage_labels_are_fixed():
+    assert stage_label("converting DICOM to NIfTI") == "conversion"
+    assert stage_label("registering to the SRI atlas") == "registration"
+    assert stage_label("skull stripping with HD-BET") == "skullstripping"
+    assert stage_label("exporting the results") == "export"
+    assert stage_label("something new 42") == "other"
+
+
+def test_openmetrics(tmp_path):
+    clock = Clock()
+    metrics = PreprocessingMetrics(clock=clock)
+    inspected(metrics, ["a", "b"])
+    for exam in ["a", "b"]:
+        ipstatus(metrics, exam, "registering {} to the SRI atlas".format(exam))
+        clock.now += 30
+        ipstatus(metrics, exam, "image processing successfully completed")
+    text = metrics.openmetrics()
+    assert text.endswith("# EOF\n")
+    assert 'brats_preprocessing_exams{state="done"} 2' in text
+    assert "brats_preprocessing_eta_seconds 0.0" in text
+    assert 'brats_preprocessing_stage_seconds_count{stage="registration"} 2' in text
+    assert 'brats_preprocessing_stage_seconds_sum{stage="registration"} 60.0' in text
+    # one series per fixed label, no matter how many messages there were
+    stageLines = [
+        l for l in text.splitlines() if l.startswith("brats_preprocessing_stage")
+    ]
+    assert len(stageLines) == 2 * 5
+    assert "SRI atlas" not in text
+    path = tmp_path / "metrics" / "prep.prom"
+    metrics.write_openmetrics(str(path))
+    assert path.read_text() == text
+
+
+def test_json_report(tmp_path):
+    clock = Clock()
+    metrics = PreprocessingMetrics(clock=clock)
+    ipstatus(metrics, "a", "registering to the SRI atlas")
+    clock.now += 5
+    ipstatus(metrics, "a", "image processing successfully completed")
+    path = tmp_path / "report.json"
+    metrics.write_json(str(path))
+    report = json.loads(path.read_text())
+    assert report["summary"]["exams"]["done"] == 1
+    assert report["exams"]["a"]["latency"] == 5
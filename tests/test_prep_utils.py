@@ -0,0 +1,53 @@
+import os
+
+from brats_toolkit.preprocessor import _stage_exam, _stage_shard
+from brats_toolkit.util.prep_utils import linkFile
+
+
+def write_exam(folder):
+    folder.mkdir(parents=True)
+    files = []
+    for m in ["t1", "t1c", "t2", "fla"]:
+        path = folder / "{}.nii.gz".format(m)
+        path.write_bytes(b"original " + m.encode())
+        files.append(str(path))
+    return files
+
+
+def shares_data(path, otherPath):
+    return os.stat(path).st_ino == os.stat(otherPath).st_ino
+
+
+def test_link_file_hardlinks_only_if_allowed(tmp_path):
+    (original,) = write_exam(tmp_path / "exam")[:1]
+    staged = str(tmp_path / "staged.nii.gz")
+    how = linkFile(original, staged)
+    assert how in [None, "reflink"]
+    if how is None:
+        assert not os.path.exists(staged)
+        assert linkFile(original, staged, hardlink=True) == "hardlink"
+        assert shares_data(original, staged)
+
+
+def test_staged_exam_does_not_share_the_originals(tmp_path):
+    files = write_exam(tmp_path / "exam")
+    target = tmp_path / "staging" / "exam"
+    target.mkdir(parents=True)
+    assert _stage_exam(files, str(target)) == []
+    for staged in target.iterdir():
+        staged.write_bytes(b"written by the backend")
+    for path in files:
+        assert open(path, "rb").read().startswith(b"original")
+
+
+def test_staged_shard_mounts_instead_of_hardlinking(tmp_path):
+    files = write_exam(tmp_path / "exams" / "exam")
+    shard = tmp_path / "shard"
+    shard.mkdir()
+    mounts = _stage_shard([str(tmp_path / "exams" / "exam")], str(shard), mount=True)
+    for source, staged in mounts:
+        assert source in files
+        assert not shares_data(source, staged)
+    for path in files:
+        for staged in (shard / "exam").iterdir():
+            assert not shares_data(path, str(staged))
@@ -0,0 +1,336 @@
+import asyncio
+import functools
+import os
+import socket
+import threading
+
+import pytest
+
+from brats_toolkit import preprocessor
+from brats_toolkit.preprocessor import (
+    AsyncPreprocessor,
+    Preprocessor,
+    PreprocessorPool,
+)
+from brats_toolkit.util.exam_manifest import MANIFEST_NAME, ExamManifest
+
+
+class StubClient(object):
+    """Answers the emits of a Preprocessor like the backend would, in another thread"""
+
+    def __init__(self, prep, answers):
+        self.prep = prep
+        self.answers = answers
+        self.emitted = []
+
+    def emit(self, event, data=None):
+        self.emitted.append(event)
+        answer = self.answers.get(event)
+        if answer is not None:
+            threading.Thread(target=answer, args=(self.prep,)).start()
+
+
+def status(message, data=None):
+    return lambda prep: prep.sio.handlers["/"]["status"](
+        {"message": message, "data": data}
+    )
+
+
+@pytest.fixture
+def prep(tmp_path):
+    prep = Preprocessor()
+    prep.session = {
+        "exam_import_folder": str(tmp_path / "in"),
+        "exam_export_folder": str(tmp_path / "out"),
+    }
+    return prep
+
+
+def stub(prep, **answers):
+    client = StubClient(prep, answers)
+    prep.sio.emit = client.emit
+    return client
+
+
+def test_process_exams_returns_the_inspected_exams(prep):
+    client = stub(
+        prep,
+        input_inspection=status("input inspection finished!", ["exam1", "exam2"]),
+        brats_processing=status("image processing successfully completed."),
+    )
+    assert prep.process_exams(timeout=10) == ["exam1", "exam2"]
+    assert client.emitted == ["input_inspection", "brats_processing"]
+    # disconnecting after processing, e.g. when closing the session, is no error
+    prep.sio.handlers["/"]["disconnect"]()
+    assert prep._error is None
+
+
+def test_process_exams_timeout(prep):
+    stub(prep)
+    with pytest.raises(TimeoutError):
+        prep.process_exams(timeout=0.1)
+
+
+def test_process_exams_fails_on_disconnect(prep):
+    stub(
+        prep,
+        input_inspection=status("input inspection finished!", ["exam1"]),
+        brats_processing=lambda prep: prep.sio.handlers["/"]["disconnect"](),
+    )
+    with pytest.raises(RuntimeError, match="lost the connection"):
+        prep.process_exams(timeout=10)
+
+
+class AsyncStubClient(object):
+    """Answers the emits of an AsyncPreprocessor like the backend would, in a task"""
+
+    def __init__(self, prep, answers):
+        self.prep = prep
+        self.answers = answers
+        self.emitted = []
+
+    async def emit(self, event, data=None):
+        self.emitted.append(event)
+        answer = self.answers.get(event)
+        if answer is not None:
+            asyncio.ensure_future(answer(self.prep))
+
+
+async def async_session(prep, tmp_path, **answers):
+    (tmp_path / "in").mkdir()
+    (tmp_path / "out").mkdir()
+    prep.session = {
+        "exam_import_folder": str(tmp_path / "in"),
+        "exam_export_folder": str(tmp_path / "out"),
+    }
+    prep._roundLock = asyncio.Lock()
+    client = AsyncStubClient(prep, answers)
+    prep.sio.emit = client.emit
+    return client
+
+
+def exam_files(tmp_path):
+    files = []
+    for m in ["t1", "t1c", "t2", "fla"]:
+        path = tmp_path / "{}.nii.gz".format(m)
+        path.write_bytes(m.encode())
+        files.append(str(path))
+    return files
+
+
+def test_async_submit_moves_results_off_the_loop(tmp_path, monkeypatch):
+    threads = []
+    move = preprocessor._move_results
+
+    def recording_move(exported, outputFolder):
+        threads.append(threading.get_ident())
+        return move(exported, outputFolder)
+
+    monkeypatch.setattr(preprocessor, "_move_results", recording_move)
+
+    async def inspected(prep):
+        exams = os.listdir(prep.session["exam_import_folder"])
+        await prep.sio.handlers["/"]["status"](
+            {"message": "input inspection finished!", "data": exams}
+        )
+
+    async def processed(prep):
+        exported = tmp_path / "out" / "exam1"
+        exported.mkdir()
+        (exported / "result.nii.gz").write_bytes(b"result")
+        await prep.sio.handlers["/"]["ipstatus"](
+            {"examid": "exam1", "ipstatus": "processing successfully completed"}
+        )
+        await prep.sio.handlers["/"]["status"](
+            {"message": "image processing successfully completed."}
+        )
+
+    async def main():
+        prep = AsyncPreprocessor()
+        await async_session(
+            prep, tmp_path, input_inspection=inspected, brats_processing=processed
+        )
+        outputFolder = str(tmp_path / "results" / "exam1")
+        future = await prep.submit(*exam_files(tmp_path), outputFolder=outputFolder)
+        result = await asyncio.wait_for(future, 10)
+        await prep.close_session()
+        return result, threading.get_ident()
+
+    outputFolder, loopThread = asyncio.run(main())
+    assert os.path.exists(os.path.join(outputFolder, "result.nii.gz"))
+    assert threads and loopThread not in threads
+    # the staged exam is removed again
+    assert os.listdir(tmp_path / "in") == []
+
+
+def test_async_inspection_timeout_fails_the_round(tmp_path):
+    async def main():
+        prep = AsyncPreprocessor(inspectionTimeout=0.1)
+        client = await async_session(prep, tmp_path)
+        future = await prep.submit(
+            *exam_files(tmp_path), outputFolder=str(tmp_path / "results" / "exam1")
+        )
+        with pytest.raises(TimeoutError, match="did not inspect"):
+            await asyncio.wait_for(future, 10)
+        await prep.close_session()
+        return client
+
+    client = asyncio.run(main())
+    assert client.emitted == ["input_inspection"]
+    assert os.listdir(tmp_path / "in") == []
+
+
+class FakeSession(object):
+    """Stands in for the backend sessions of the members of a pool"""
+
+    def __init__(self, busyPorts=()):
+        self.busyPorts = set(busyPorts)
+        self.started = []
+
+    def install(self, monkeypatch):
+        for name in ["start_session", "process_exams", "close_session"]:
+            method = getattr(self, name)
+            monkeypatch.setattr(
+                Preprocessor,
+                name,
+                lambda prep, *args, method=method, **kwargs: method(
+                    prep, *args, **kwargs
+                ),
+            )
+
+    def start_session(
+        self, prep, exam_import_folder, exam_export_folder, **sessionArgs
+    ):
+        if prep.port in self.busyPorts:
+            raise RuntimeError("port is already allocated")
+        self.started.append(prep.port)
+        prep.session = {
+            "exam_import_folder": exam_import_folder,
+            "exam_export_folder": exam_export_folder,
+        }
+
+    def process_exams(self, prep, confirm=False):
+        exams = sorted(os.listdir(prep.session["exam_import_folder"]))
+        for exam in exams:
+            os.makedirs(
+                os.path.join(prep.session["exam_export_folder"], exam), exist_ok=True
+            )
+            prep._notify(
+                "ipstatus",
+                {"examid": exam, "ipstatus": "processing successfully completed"},
+            )
+        return exams
+
+    def close_session(self, prep):
+        prep.session = None
+
+
+def write_exams(tmp_path, n):
+    for i in range(n):
+        exam = tmp_path / "exams" / "exam{}".format(i)
+        exam.mkdir(parents=True)
+        (exam / "t1.nii.gz").write_bytes(b"x" * (i + 1))
+    return str(tmp_path / "exams")
+
+
+def test_pool_members_are_attached_quietly(capsys):
+    pool = PreprocessorPool(backends=3)
+    assert capsys.readouterr().out.count("Deprecation Notice") == 1
+    assert len({m.backendName for m in pool.members}) == 3
+    ports = [p for m in pool.members for p in [m.port, m.dashboardPort]]
+    assert len(set(ports)) == 6
+    for member in pool.members:
+        assert member.url == "http://localhost:{}".format(member.port)
+
+
+def test_pool_splits_exams_over_backends(tmp_path, monkeypatch):
+    FakeSession().install(monkeypatch)
+    pool = PreprocessorPool(backends=2)
+    status = pool.batch_preprocess(
+        write_exams(tmp_path, 5),
+        str(tmp_path / "out"),
+        confirm=False,
+        skipUpdate=True,
+        workers=1,
+    )
+    assert sorted(status) == ["exam{}".format(i) for i in range(5)]
+    backends = {s["backend"] for s in status.values()}
+    assert backends == {m.backendName for m in pool.members}
+    for s in status.values():
+        assert s["ipstatus"] == "processing successfully completed"
+    assert sorted(os.listdir(tmp_path / "out")) == sorted([MANIFEST_NAME, *status])
+
+
+def test_pool_retries_on_taken_ports(tmp_path, monkeypatch):
+    pool = PreprocessorPool(backends=1)
+    (member,) = pool.members
+    # another process took the port before the backend started
+    busy = socket.socket()
+    busy.bind(("localhost", 0))
+    busy.listen()
+    takenPort = busy.getsockname()[1]
+    member._use_ports(takenPort, member.dashboardPort)
+    session = FakeSession(busyPorts=[takenPort])
+    session.install(monkeypatch)
+    with busy:
+        status = pool.batch_preprocess(
+            write_exams(tmp_path, 1),
+            str(tmp_path / "out"),
+            confirm=False,
+            skipUpdate=True,
+            workers=1,
+        )
+    assert list(status) == ["exam0"]
+    assert session.started == [member.port]
+    assert member.port != takenPort
+
+
+def test_pool_keeps_given_ports(tmp_path, monkeypatch):
+    busy = socket.socket()
+    busy.bind(("localhost", 0))
+    busy.listen()
+    takenPort = busy.getsockname()[1]
+    FakeSession(busyPorts=[takenPort]).install(monkeypatch)
+    pool = PreprocessorPool(backends=1, ports=[takenPort])
+    with busy, pytest.raises(RuntimeError, match="1 of 1 backends failed"):
+        pool.batch_preprocess(
+            write_exams(tmp_path, 1),
+            str(tmp_path / "out"),
+            confirm=False,
+            skipUpdate=True,
+            workers=1,
+        )
+    assert pool.members[0].port == takenPort
+
+
+def test_batch_records_the_manifest_without_resume(tmp_path, monkeypatch):
+    FakeSession().install(monkeypatch)
+    out = str(tmp_path / "out")
+    Preprocessor().batch_preprocess(
+        write_exams(tmp_path, 2), out, confirm=False, skipUpdate=True, workers=1
+    )
+    manifest = ExamManifest(out)
+    assert {e: s["status"] for e, s in manifest.exams.items()} == {
+        "exam0": "done",
+        "exam1": "done",
+    }
+
+
+def test_pool_resumes_only_changed_exams(tmp_path, monkeypatch):
+    session = FakeSession()
+    session.install(monkeypatch)
+    exams = write_exams(tmp_path, 3)
+    out = str(tmp_path / "out")
+    pool = PreprocessorPool(backends=2)
+    run = functools.partial(
+        pool.batch_preprocess, exams, out, confirm=False, skipUpdate=True, workers=1
+    )
+    assert len(run()) == 3
+    assert run(resume=True) == {}
+    stale = os.path.join(out, "exam1", "stale.nii.gz")
+    open(stale, "w").close()
+    (tmp_path / "exams" / "exam1" / "t1.nii.gz").write_bytes(b"changed")
+    assert list(run(resume=True)) == ["exam1"]
+    # the results of the changed exam were replaced
+    assert not os.path.exists(stale)
+    assert os.path.isdir(os.path.join(out, "exam1"))
@@ -0,0 +1,52 @@
+from brats_toolkit.util.result_cache import ResultCache
+
+PARAMS = {"id": "fake/model:1.0", "command": " ", "fileformat": "gz-b17"}
+
+
+def inputs(tmp_path):
+    paths = {}
+    for m in ["t1", "t1c", "t2", "fla"]:
+        paths[m] = str(tmp_path / "{}.nii.gz".format(m))
+        with open(paths[m], "wb") as f:
+            f.write(m.encode("utf-8"))
+    return paths
+
+
+def test_key_depends_on_the_image_id(tmp_path):
+    ids = {"fake/model:1.0": "sha256:old"}
+    cache = ResultCache(str(tmp_path / "cache"), imageId=ids.get)
+    old = cache.key(inputs(tmp_path), PARAMS)
+    assert old is not None
+    assert (
+        ResultCache(str(tmp_path / "cache"), imageId=ids.get).key(
+            inputs(tmp_path), PARAMS
+        )
+        == old
+    )
+    ids["fake/model:1.0"] = "sha256:new"
+    assert (
+        ResultCache(str(tmp_path / "cache"), imageId=ids.get).key(
+            inputs(tmp_path), PARAMS
+        )
+        != old
+    )
+
+
+def test_unknown_image_id_skips_the_cache(tmp_path):
+    ids = {}
+    cache = ResultCache(str(tmp_path / "cache"), imageId=ids.get)
+    assert cache.key(inputs(tmp_path), PARAMS) is None
+    # asked again once the image is there
+    ids["fake/model:1.0"] = "sha256:pulled"
+    assert cache.key(inputs(tmp_path), PARAMS) is not None
+
+
+def test_store_and_fetch(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), imageId=lambda image: "sha256:x")
+    key = cache.key(inputs(tmp_path), PARAMS)
+    result = tmp_path / "result.nii.gz"
+    result.write_bytes(b"segmentation")
+    assert not cache.fetch(key, str(tmp_path / "out" / "seg.nii.gz"))
+    cache.store(key, str(result), meta={"cid": "test"})
+    assert cache.fetch(key, str(tmp_path / "out" / "seg.nii.gz"))
+    assert (tmp_path / "out" / "seg.nii.gz").read_bytes() == b"segmentation"
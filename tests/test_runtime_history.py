@@ -0,0 +1,22 @@
+from brats_toolkit.util.runtime_history import RuntimeHistory
+
+
+def test_predict_from_similar_runs(tmp_path):
+    history = RuntimeHistory(str(tmp_path / "history.sqlite"))
+    for seconds in [1.0, 2.0, 3.0]:
+        history.record("a", 1000, seconds)
+    assert history.predict("a", 1100) == 2.0
+    assert history.predict("b", 1000) is None
+
+
+def test_predict_scales_per_voxel(tmp_path):
+    history = RuntimeHistory(str(tmp_path / "history.sqlite"))
+    history.record("a", 1000, 2.0)
+    assert history.predict("a", 4000) == 8.0
+
+
+def test_predict_without_usable_sizes(tmp_path):
+    history = RuntimeHistory(str(tmp_path / "history.sqlite"))
+    history.record("a", 0, 2.0)
+    assert history.predict("a", 1000) is None
+    assert history.predict("a", 0) == 2.0
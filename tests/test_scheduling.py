@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from brats_toolkit.util.scheduling import CpusetPool, GpuPool, lpt_makespan
+
+
+def test_cpuset_pool_splits_cpus():
+    pool = CpusetPool(3, cpus=list(range(8)))
+    assert pool.cpusets == ["0,1,2", "3,4,5", "6,7"]
+
+
+def test_gpu_pool_waits_for_a_free_slot():
+    async def main():
+        pool = GpuPool("0,1", slots_per_device=1)
+        first = await pool.acquire()
+        second = await pool.acquire()
+        assert {first, second} == {"0", "1"}
+        waiter = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        pool.release(second)
+        assert await asyncio.wait_for(waiter, 1) == second
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        pool = GpuPool("0", slots_per_device=1)
+        device = await pool.acquire()
+        waiter = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        pool.release(device)
+        assert pool._running == {"0": 0}
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_gives_back_a_handed_over_slot():
+    async def main():
+        pool = GpuPool("0", slots_per_device=1)
+        device = await pool.acquire()
+        waiter = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0)
+        # the slot is handed over, but the waiter is cancelled before it resumes
+        pool.release(device)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert pool._running == {"0": 0}
+        assert await asyncio.wait_for(pool.acquire(), 1) == "0"
+
+    asyncio.run(main())
+
+
+def test_lpt_makespan():
+    assert lpt_makespan([3, 2, 2, 1], 2) == 4
+    assert lpt_makespan([], 2) == 0
+
+
+def test_lpt_makespan_with_gpu_slots():
+    assert lpt_makespan([1, 1, 1], 3, gpu=[True] * 3, gpu_slots=1) == 3
+    assert lpt_makespan([1, 1, 1], 3, gpu=[True, False, False], gpu_slots=1) == 1
+    # without a gpu limit the flags don't matter
+    assert lpt_makespan([1, 1, 1], 3, gpu=[True] * 3) == 1
@@ -0,0 +1,373 @@
+import asyncio
+import json
+import os
+import os.path as op
+import threading
+import time
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from brats_toolkit.segmentor import Segmentor
+from brats_toolkit.util import own_itk as oitk
+from brats_toolkit.util.container_runtime import FakeRuntime
+from brats_toolkit.util.fake_container import fake_segmentation
+from brats_toolkit.util.runtime_history import image_voxels
+
+MODALITIES = ["t1", "t1c", "t2", "fla"]
+
+
+class Recorder(object):
+    """A FakeRuntime func writing the stand-in segmentation after a nap"""
+
+    def __init__(self, seconds=0.0):
+        self.seconds = seconds
+        self.calls = []
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, cid, params, directory):
+        with self.lock:
+            self.calls.append(cid)
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            time.sleep(params.get("fake_sleep", self.seconds))
+            proto = oitk.get_itk_information(op.join(directory, "t1.nii.gz"))
+            outputPath = op.join(
+                directory, "results", "tumor_{}_class.nii.gz".format(cid)
+            )
+            oitk.write_itk_image(fake_segmentation(cid, proto), outputPath)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+@pytest.fixture
+def case(tmp_path):
+    """Writes a small synthetic exam, returns the paths per modality"""
+    caseDir = tmp_path / "case"
+    caseDir.mkdir()
+    rng = np.random.default_rng(0)
+    paths = {}
+    for m in MODALITIES:
+        arr = rng.random((16, 24, 24)).astype(np.float32)
+        paths[m] = str(caseDir / "{}.nii.gz".format(m))
+        sitk.WriteImage(sitk.GetImageFromArray(arr), paths[m])
+    return paths
+
+
+def write_config(tmp_path, members, runtime="runc", **fields):
+    config = {}
+    for cid in members:
+        config[cid] = dict(
+            name=cid,
+            fileformat="gz-b17",
+            runtime=runtime,
+            id="fake/" + cid,
+            command=" ",
+            mountpoint="/data",
+            **fields,
+        )
+    path = tmp_path / "dockers.json"
+    path.write_text(json.dumps(config))
+    return str(path)
+
+
+def segmentor(tmp_path, config, func, **kwargs):
+    kwargs.setdefault("runtime_history", str(tmp_path / "history.sqlite"))
+    return Segmentor(
+        config=config,
+        verbose=False,
+        runtime=FakeRuntime(func=func),
+        scratch_root=str(tmp_path / "scratch"),
+        **kwargs,
+    )
+
+
+def test_mav_fuses_all_members(tmp_path, case):
+    func = Recorder()
+    config = write_config(tmp_path, ["a", "b", "c"])
+    seg = segmentor(tmp_path, config, func, max_parallel=3)
+    outputPath = str(tmp_path / "out" / "mav.nii.gz")
+    assert seg.segment(cid="mav", outputPath=outputPath, **case)
+    assert sorted(func.calls) == ["a", "b", "c"]
+    fused = oitk.get_itk_array(outputPath)
+    assert fused.shape == (16, 24, 24)
+    assert set(np.unique(fused)) <= {0, 1, 2, 4}
+    assert np.count_nonzero(fused) > 0
+    for cid in ["a", "b", "c"]:
+        assert op.exists(tmp_path / "out" / "{}_tumor_seg.nii.gz".format(cid))
+    assert op.exists(tmp_path / "out" / "mav_run_report.json")
+
+
+def test_rerun_reuses_cached_results(tmp_path, case):
+    func = Recorder()
+    config = write_config(tmp_path, ["a", "b"])
+    seg = segmentor(tmp_path, config, func, cache_root=str(tmp_path / "cache"))
+    outputPath = str(tmp_path / "out" / "mav.nii.gz")
+    assert seg.segment(cid="mav", outputPath=outputPath, **case)
+    assert sorted(func.calls) == ["a", "b"]
+    first = oitk.get_itk_array(outputPath)
+    os.remove(outputPath)
+    assert seg.segment(cid="mav", outputPath=outputPath, **case)
+    # no container ran again
+    assert sorted(func.calls) == ["a", "b"]
+    assert np.array_equal(oitk.get_itk_array(outputPath), first)
+
+
+def test_parallel_gpu_slots(tmp_path, case, monkeypatch):
+    # few executor threads, more parallel jobs than threads and gpu slots
+    monkeypatch.setattr(os, "cpu_count", lambda: 1)
+    monkeypatch.setattr(os, "process_cpu_count", lambda: 1, raising=False)
+    func = Recorder(seconds=0.2)
+    members = ["m{}".format(i) for i in range(8)]
+    config = write_config(tmp_path, members, runtime="nvidia")
+    seg = segmentor(tmp_path, config, func, gpu="0", gpu_slots=1, max_parallel=8)
+    outputPath = str(tmp_path / "out" / "all.nii.gz")
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(
+            seg.segment(cid="all", outputPath=outputPath, **case)
+        ),
+        daemon=True,
+    )
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), "segment() hangs"
+    assert results == [True]
+    assert sorted(func.calls) == members
+    # one container at a time on the single gpu slot
+    assert func.peak == 1
+    assert seg.gpuPool._running == {"0": 0}
+
+
+def test_recorded_runtimes_exclude_queueing(tmp_path, case):
+    func = Recorder(seconds=0.5)
+    members = ["a", "b", "c"]
+    config = write_config(tmp_path, members, runtime="nvidia")
+    seg = segmentor(tmp_path, config, func, gpu="0", gpu_slots=1, max_parallel=3)
+    outputPath = str(tmp_path / "out" / "all.nii.gz")
+    assert seg.segment(cid="all", outputPath=outputPath, **case)
+    # the jobs queue for the gpu one after the other, each runs about 0.5s
+    for cid in members:
+        [(_, seconds)] = seg.history.runs(cid)
+        assert 0.5 <= seconds < 1.0
+
+
+def record_runtimes(seg, case, seconds):
+    voxels = image_voxels(case["t1"])
+    for cid in seg.config:
+        seg.history.record(cid, voxels, seconds)
+
+
+def test_budget_stops_late_members_and_frees_slots(tmp_path, case):
+    func = Recorder(seconds=0.6)
+    members = ["a", "b", "c"]
+    config = write_config(tmp_path, members, runtime="nvidia")
+    seg = segmentor(tmp_path, config, func, gpu="0", gpu_slots=1, max_parallel=3)
+    # the history claims all three fit, but they run three times as long
+    record_runtimes(seg, case, 0.2)
+    outputPath = str(tmp_path / "out" / "mav.nii.gz")
+    assert seg.segment(
+        cid="mav", outputPath=outputPath, budget=1.0, min_ensemble=1, **case
+    )
+    assert len(func.calls) < 3
+    assert op.exists(outputPath)
+    # the cancelled members gave their gpu slot back
+    assert seg.gpuPool._running == {"0": 0}
+    func.seconds = 0.0
+    assert seg.segment(cid="all", outputPath=outputPath, **case)
+
+
+def test_budget_selection_counts_gpu_slots(tmp_path, case, caplog):
+    members = ["a", "b", "c"]
+    inputs = {m: case[m] for m in MODALITIES}
+    config = write_config(tmp_path, members, runtime="nvidia")
+    seg = segmentor(tmp_path, config, Recorder(), gpu_slots=1, max_parallel=3)
+    record_runtimes(seg, case, 1.0)
+    # the members share one gpu slot, only two run within the budget
+    assert len(seg._selectEnsemble(inputs, 2.5, 1)) == 2
+    cpuConfig = write_config(tmp_path, members)
+    seg = segmentor(tmp_path, cpuConfig, Recorder(), gpu_slots=1, max_parallel=3)
+    assert len(seg._selectEnsemble(inputs, 2.5, 1)) == 3
+    # the warning reports how many fit before padding to min_ensemble
+    assert len(seg._selectEnsemble(inputs, 0.5, 2)) == 2
+    assert "Only 0 containers fit" in caplog.text
+
+
+def test_plan_counts_gpu_slots(tmp_path, case):
+    config = write_config(tmp_path, ["a", "b", "c"], runtime="nvidia")
+    seg = segmentor(tmp_path, config, Recorder(), gpu_slots=1, max_parallel=3)
+    record_runtimes(seg, case, 1.0)
+    plan = seg.plan([case], cid="all")
+    assert plan["unknown"] == 0
+    # three slots, but the members queue for the single gpu slot
+    assert plan["makespan"] == 3.0
+
+
+def test_runtime_history_is_opt_in(tmp_path, case, monkeypatch):
+    monkeypatch.delenv("BRATS_RUNTIME_HISTORY", raising=False)
+    config = write_config(tmp_path, ["a"])
+    seg = segmentor(tmp_path, config, Recorder(), runtime_history=None)
+    assert seg.history is None
+    assert seg.plan([case], cid="a")["unknown"] == 1
+    monkeypatch.setenv("BRATS_RUNTIME_HISTORY", str(tmp_path / "env.sqlite"))
+    seg = segmentor(tmp_path, config, Recorder(), runtime_history=None)
+    assert seg.history.path == str(tmp_path / "env.sqlite")
+
+
+def test_segment_inside_a_running_loop(tmp_path, case):
+    func = Recorder()
+    config = write_config(tmp_path, ["a"])
+    seg = segmentor(tmp_path, config, func)
+    outputPath = str(tmp_path / "out" / "a.nii.gz")
+
+    async def notebook():
+        # like a Jupyter cell, the sync API is called with a loop running
+        return seg.segment(cid="a", outputPath=outputPath, **case)
+
+    assert asyncio.run(notebook())
+    assert op.exists(outputPath)
+
+
+def test_runtime_start_failure_only_fails_its_member(tmp_path, case):
+    class Runtime(FakeRuntime):
+        async def run(self, runner, cid, *args, **kwargs):
+            if cid == "broken":
+                # docker run could not create the container
+                return 125
+            return await super().run(runner, cid, *args, **kwargs)
+
+    config = write_config(tmp_path, ["a", "b", "broken"])
+    seg = Segmentor(
+        config=config,
+        verbose=False,
+        runtime=Runtime(func=Recorder()),
+        scratch_root=str(tmp_path / "scratch"),
+        runtime_history=False,
+        max_parallel=3,
+    )
+    outputPath = str(tmp_path / "out" / "mav.nii.gz")
+    assert seg.segment(cid="mav", outputPath=outputPath, **case)
+    assert op.exists(outputPath)
+    assert not op.exists(tmp_path / "out" / "broken_tumor_seg.nii.gz")
+
+
+def test_trace_writes_report_and_trace(tmp_path, case):
+    func = Recorder()
+    config = write_config(tmp_path, ["a", "b"])
+    seg = segmentor(tmp_path, config, func, max_parallel=2, trace=True)
+    outputPath = str(tmp_path / "out" / "mav.nii.gz")
+    assert seg.segment(cid="mav", outputPath=outputPath, **case)
+    report = json.loads((tmp_path / "out" / "mav_run_report.json").read_text())
+    assert {"segment", "container_run", "fusion"} <= set(report["stages"])
+    runs = [s for s in report["spans"] if s["name"] == "container_run"]
+    assert sorted(s["attrs"]["cid"] for s in runs) == ["a", "b"]
+    trace = json.loads((tmp_path / "out" / "mav_trace.json").read_text())
+    names = [e["name"] for e in trace["traceEvents"]]
+    assert names.count("container_run") == 2
+
+
+def test_scratch_is_removed_after_failed_run(tmp_path, case):
+    def fail(cid, params, directory):
+        raise RuntimeError("container crashed")
+
+    config = write_config(tmp_path, ["a", "b"])
+    seg = segmentor(tmp_path, config, fail, max_parallel=2)
+    outputPath = str(tmp_path / "out" / "mav.nii.gz")
+    assert not seg.segment(cid="mav", outputPath=outputPath, **case)
+    assert os.listdir(tmp_path / "scratch") == []
+
+
+def test_staging_estimate_counts_running_containers(tmp_path, case, monkeypatch):
+    from brats_toolkit.util import scratch
+
+    required = []
+    monkeypatch.setattr(scratch, "check_free_space", lambda root, r: required.append(r))
+    func = Recorder()
+    config = write_config(tmp_path, ["a", "b", "c"])
+    seg = segmentor(tmp_path, config, func, max_parallel=2)
+    outputPath = str(tmp_path / "out" / "mav.nii.gz")
+    assert seg.segment(cid="mav", outputPath=outputPath, **case)
+    # the inputs on disk, once per container running at the same time
+    assert required == [2 * sum(op.getsize(p) for p in case.values())]
+
+
+class BatchRecorder(object):
+    """A FakeRuntime func segmenting every case folder of a batch mount"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.launches = []
+
+    def __call__(self, cid, params, directory):
+        caseDirs = sorted(d for d in os.listdir(directory) if d.startswith("case_"))
+        self.launches.append(caseDirs)
+        for d in caseDirs:
+            if d in self.failing:
+                continue
+            caseDir = op.join(directory, d)
+            proto = oitk.get_itk_information(op.join(caseDir, "t1.nii.gz"))
+            outputPath = op.join(
+                caseDir, "results", "tumor_{}_class.nii.gz".format(cid)
+            )
+            oitk.write_itk_image(fake_segmentation(cid, proto), outputPath)
+
+
+def write_cases(tmp_path, n):
+    """Writes n small synthetic exams with distinct contents"""
+    cases = []
+    for i in range(n):
+        caseDir = tmp_path / "cases" / "case{}".format(i)
+        caseDir.mkdir(parents=True)
+        rng = np.random.default_rng(i)
+        case = {"outputPath": str(tmp_path / "out" / "case{}.nii.gz".format(i))}
+        for m in MODALITIES:
+            arr = rng.random((8, 12, 12)).astype(np.float32)
+            case[m] = str(caseDir / "{}.nii.gz".format(m))
+            sitk.WriteImage(sitk.GetImageFromArray(arr), case[m])
+        cases.append(case)
+    return cases
+
+
+def test_batch_mount_splits_at_batch_size(tmp_path):
+    func = BatchRecorder()
+    config = write_config(tmp_path, ["b"], batch_mount=True)
+    seg = segmentor(tmp_path, config, func, max_parallel=2)
+    cases = write_cases(tmp_path, 5)
+    assert seg.segment_batch(cases, cid="b", batch_size=2) == [True] * 5
+    assert sorted(len(launch) for launch in func.launches) == [1, 2, 2]
+    for case in cases:
+        assert op.exists(case["outputPath"])
+
+
+def test_batch_mount_runs_only_uncached_cases(tmp_path):
+    func = BatchRecorder()
+    config = write_config(tmp_path, ["b"], batch_mount=True)
+    seg = segmentor(tmp_path, config, func, cache_root=str(tmp_path / "cache"))
+    cases = write_cases(tmp_path, 3)
+    assert seg.segment_batch(cases[:2], cid="b") == [True, True]
+    assert func.launches == [["case_00000", "case_00001"]]
+    for case in cases[:2]:
+        os.remove(case["outputPath"])
+    assert seg.segment_batch(cases, cid="b") == [True, True, True]
+    # only the new case was staged and segmented
+    assert func.launches[1] == ["case_00002"]
+    for case in cases:
+        assert op.exists(case["outputPath"])
+
+
+def test_batch_mount_failing_case_fails_alone(tmp_path):
+    func = BatchRecorder(failing=["case_00001"])
+    config = write_config(tmp_path, ["b"], batch_mount=True)
+    seg = segmentor(tmp_path, config, func, cache_root=str(tmp_path / "cache"))
+    cases = write_cases(tmp_path, 3)
+    assert seg.segment_batch(cases, cid="b") == [True, False, True]
+    assert not op.exists(cases[1]["outputPath"])
+    # the failed case is not cached, a rerun segments it again
+    func.failing = set()
+    assert seg.segment_batch(cases, cid="b") == [True, True, True]
+    assert func.launches[1] == ["case_00001"]
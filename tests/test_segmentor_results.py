@@ -0,0 +1,57 @@
+import os.path as op
+
+import numpy as np
+import SimpleITK as sitk
+
+from brats_toolkit.segmentor import Segmentor
+from brats_toolkit.util import own_itk as oitk
+
+
+def write(path, arr):
+    sitk.WriteImage(sitk.GetImageFromArray(arr), str(path))
+
+
+def segmentor():
+    return Segmentor(verbose=False, runtime="fake", runtime_history=False)
+
+
+def test_count_labels():
+    arr = np.array([[0, 1], [2, 4]], dtype=np.uint8)
+    assert Segmentor._countLabels(arr) == 4
+    assert Segmentor._countLabels(np.zeros((2, 2), dtype=np.uint8)) == 1
+    # huge values of a corrupt result don't allocate a huge bincount
+    corrupt = np.array([0, 2**62], dtype=np.int64)
+    assert Segmentor._countLabels(corrupt) == 2
+    assert Segmentor._countLabels(np.array([0.5, 1.0])) == 2
+
+
+def test_header_check_of_broken_files(tmp_path):
+    broken = tmp_path / "broken.nii.gz"
+    broken.write_bytes(b"not a nifti")
+    assert not Segmentor._headerLooksSane(str(broken))
+    assert not Segmentor._headerLooksSane(str(tmp_path / "missing.nii.gz"))
+    good = tmp_path / "good.nii.gz"
+    write(good, np.zeros((4, 5, 6), dtype=np.uint8))
+    assert Segmentor._headerLooksSane(str(good))
+
+
+def test_multiple_background_results_still_save_one(tmp_path):
+    resultsDir = tmp_path / "results"
+    resultsDir.mkdir()
+    for name in ["tumor_a_class.nii.gz", "tumor_b_class.nii.gz"]:
+        write(resultsDir / name, np.zeros((4, 5, 6), dtype=np.uint8))
+    outputPath = str(tmp_path / "seg.nii.gz")
+    assert segmentor()._handleResult("x", str(resultsDir) + "/", outputPath)
+    assert op.exists(outputPath)
+
+
+def test_most_labels_win(tmp_path):
+    resultsDir = tmp_path / "results"
+    resultsDir.mkdir()
+    labels = np.zeros((4, 5, 6), dtype=np.uint8)
+    labels[1, 1, 1:4] = [1, 2, 4]
+    write(resultsDir / "tumor_a_class.nii.gz", np.zeros_like(labels))
+    write(resultsDir / "tumor_b_class.nii.gz", labels)
+    outputPath = str(tmp_path / "seg.nii.gz")
+    assert segmentor()._handleResult("x", str(resultsDir) + "/", outputPath)
+    assert np.array_equal(oitk.get_itk_array(outputPath), labels)
@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+from brats_toolkit.util import timing
+
+
+def test_span_without_report_is_noop():
+    with timing.span("stage", cid="a") as attrs:
+        attrs["extra"] = 1
+    assert attrs == {"cid": "a", "extra": 1}
+
+
+def test_report_json_schema(tmp_path):
+    jsonPath = tmp_path / "report.json"
+    with timing.run_report("run", jsonPath=str(jsonPath)):
+        with timing.span("stage", cid="a") as attrs:
+            attrs["cases"] = 2
+    report = json.loads(jsonPath.read_text())
+    assert set(report) == {
+        "name",
+        "created",
+        "wall_time",
+        "process_peak_rss_kb",
+        "stages",
+        "spans",
+    }
+    assert report["name"] == "run"
+    assert list(report["stages"]) == ["stage"]
+    (span,) = report["spans"]
+    assert set(span) == {"name", "start", "duration", "lane", "attrs"} | set(
+        timing.PROCESS_COUNTERS
+    )
+    assert span["attrs"] == {"cid": "a", "cases": 2}
+    assert span["duration"] >= 0
+
+
+def test_nested_spans_are_recorded_separately():
+    with timing.run_report("run") as report:
+        with timing.span("outer"):
+            with timing.span("inner"):
+                pass
+            with timing.span("inner"):
+                pass
+    names = sorted(s["name"] for s in report.spans)
+    assert names == ["inner", "inner", "outer"]
+    outer = next(s for s in report.spans if s["name"] == "outer")
+    inner = [s for s in report.spans if s["name"] == "inner"]
+    for s in inner:
+        assert s["start"] >= outer["start"]
+        assert s["start"] + s["duration"] <= outer["start"] + outer["duration"]
+    assert report.summary()["outer"] >= sum(s["duration"] for s in inner)
+
+
+def test_timed_decorator():
+    @timing.timed("work")
+    def work(x):
+        return x * 2
+
+    with timing.run_report("run") as report:
+        assert work(3) == 6
+        assert work(4) == 8
+    assert [s["name"] for s in report.spans] == ["work", "work"]
+    assert report.spans[0]["attrs"] == {"function": "work"}
+    # outside a report the function still works
+    assert work(5) == 10
+
+
+def test_executor_spans_stay_in_report():
+    def stage():
+        with timing.span("in_thread"):
+            pass
+
+    async def main():
+        with timing.run_report("run") as report:
+            await asyncio.gather(
+                timing.run_in_executor(stage), timing.run_in_executor(stage)
+            )
+        return report
+
+    report = asyncio.run(main())
+    assert [s["name"] for s in report.spans] == ["in_thread", "in_thread"]
+
+
+def test_chrome_trace(tmp_path):
+    tracePath = tmp_path / "trace.json"
+    with timing.run_report("run", tracePath=str(tracePath)):
+        with timing.span("stage", cid="a"):
+            pass
+    trace = json.loads(tracePath.read_text())
+    (event,) = trace["traceEvents"]
+    assert event["name"] == "stage"
+    assert event["ph"] == "X"
+    assert event["cat"] == "run"
+    assert event["args"]["cid"] == "a"
+    for k in timing.PROCESS_COUNTERS:
+        assert k in event["args"]
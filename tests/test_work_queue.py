@@ -0,0 +1,109 @@
+import json
+import multiprocessing
+import os
+import time
+
+from brats_toolkit.util.work_queue import WorkQueue, worker_id
+
+
+def work(root, logPath, stale_after=300):
+    """Processes items until the queue is finished, logs the claimed ids"""
+    queue = WorkQueue(root, stale_after=stale_after)
+    worker = worker_id()
+    while True:
+        queue.reap()
+        claim = queue.claim(worker)
+        if claim is None:
+            if queue.finished():
+                return
+            time.sleep(0.05)
+            continue
+        with open(logPath, "a") as log:
+            log.write(claim.item["id"] + "\n")
+        time.sleep(0.01)
+        claim.done(result=worker)
+
+
+def crash(root, logPath, claims):
+    """Claims some items and dies without finishing them"""
+    queue = WorkQueue(root)
+    worker = worker_id()
+    with open(logPath, "a") as log:
+        for _ in range(claims):
+            log.write(queue.claim(worker).item["id"] + "\n")
+    os._exit(1)
+
+
+def start(target, *args):
+    process = multiprocessing.Process(target=target, args=args)
+    process.start()
+    return process
+
+
+def claimed(logs):
+    ids = []
+    for logPath in logs:
+        if os.path.exists(logPath):
+            with open(logPath) as log:
+                ids += log.read().split()
+    return ids
+
+
+def done(root):
+    items = {}
+    for name in os.listdir(os.path.join(root, "done")):
+        with open(os.path.join(root, "done", name)) as f:
+            item = json.load(f)
+        items[item["id"]] = item
+    return items
+
+
+def test_workers_claim_every_item_once(tmp_path):
+    root = str(tmp_path / "queue")
+    queue = WorkQueue(root)
+    ids = [queue.put({"case": i}) for i in range(30)]
+    logs = [str(tmp_path / "worker{}.log".format(k)) for k in range(3)]
+    workers = [start(work, root, logPath) for logPath in logs]
+    for process in workers:
+        process.join(60)
+        assert process.exitcode == 0
+    assert sorted(claimed(logs)) == sorted(ids)
+    assert sorted(done(root)) == sorted(ids)
+    assert queue.finished()
+
+
+def test_claims_of_crashed_worker_are_claimed_again(tmp_path):
+    root = str(tmp_path / "queue")
+    queue = WorkQueue(root)
+    ids = [queue.put({"case": i}) for i in range(10)]
+    crashLog = str(tmp_path / "crashed.log")
+    crashed = start(crash, root, crashLog, 3)
+    crashed.join(60)
+    assert crashed.exitcode == 1
+    lost = claimed([crashLog])
+    assert len(lost) == 3
+    assert queue.counts()["claimed"] == 3
+    logs = [str(tmp_path / "worker{}.log".format(k)) for k in range(2)]
+    workers = [start(work, root, logPath, 1) for logPath in logs]
+    for process in workers:
+        process.join(60)
+        assert process.exitcode == 0
+    # every item was finished exactly once by the surviving workers
+    assert sorted(claimed(logs)) == sorted(ids)
+    items = done(root)
+    assert sorted(items) == sorted(ids)
+    for item_id in lost:
+        assert items[item_id]["attempts"] == 1
+    assert queue.counts() == {"pending": 0, "claimed": 0, "done": 10, "failed": 0}
+
+
+def test_reap_skips_claims_taken_over_by_another_reaper(tmp_path):
+    root = str(tmp_path / "queue")
+    queue = WorkQueue(root, stale_after=0)
+    queue.put({"case": 0})
+    claim = queue.claim("w1")
+    reaping = claim.path + ".reaping.abcdef"
+    os.rename(claim.path, reaping)
+    os.utime(reaping, (0, 0))
+    assert queue.reap() == 0
+    assert os.path.exists(reaping)